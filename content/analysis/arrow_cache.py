@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+
+# Local Arrow IPC cache of the exported Parquet datasets, opened with memory mapping.
+#
+#   from arrow_cache import open_table, scan
+#
+#   table = open_table("CTD", columns=["location_id", "sample_date", "result"])
+#   df = table.to_pandas(types_mapper=pd.ArrowDtype)
+#
+#   with pl.StringCache():
+#       counts = scan("CTD").group_by("parameter").agg(pl.len()).collect()
+#
+# The first call for a dataset version converts every Parquet file once into an uncompressed
+# Arrow IPC (Feather v2) file with the same provider_key=.../year=... layout under
+# <cache_dir>/<dataset>/<created_at>/, created_at being the export time in the dataset's
+# _metadata. Later calls, in this or any other session, only memory map those files: nothing is
+# decoded or copied, polars and pandas (with pd.ArrowDtype columns) use the mapped buffers, and
+# only the pages a query touches are read from disk and count in the RSS of the process. When a
+# dataset is downloaded again with a new created_at, the next call converts the new version and
+# removes the older ones.
+
+# Standard libraries
+import logging
+import os
+import shutil
+from pathlib import Path
+
+# Third party libraries
+import polars as pl
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.fs as fs
+import pyarrow.parquet as pq
+
+# Local modules
+from parquet_query import HIVE_SCHEMA, dataset_dir
+
+logger = logging.getLogger(__name__)
+
+# Folder holding one folder per dataset and one version folder per created_at of the dataset.
+CACHE_DIR = Path(os.getenv("PHYTO_CACHE_DIR", ".cache/arrow"))
+
+# Types of the partition folder names, as pyarrow's hive partitioning.
+PARTITIONING = ds.partitioning(
+    pa.schema([("provider_key", pa.string()), ("year", pa.int32())]), flavor="hive"
+)
+
+# Uncompressed so the record batches can be used straight from the memory map.
+WRITE_OPTIONS = pa.ipc.IpcWriteOptions(compression=None)
+
+
+def dataset_version(dataset: str, data_dir: Path | None = None) -> str:
+    """created_at of a downloaded dataset, as written by parquet_export.py to its _metadata"""
+    path = dataset_dir(dataset, data_dir)
+    try:
+        metadata = pq.read_schema(path / "_metadata").metadata or {}
+    except FileNotFoundError:
+        raise FileNotFoundError(
+            f"{path} has no _metadata, download the whole dataset folder"
+        ) from None
+    if b"created_at" not in metadata:
+        raise ValueError(f"The _metadata of {path} has no created_at")
+    return metadata[b"created_at"].decode("utf-8")
+
+
+def source_files(dataset: str, data_dir: Path | None = None) -> list[Path]:
+    path = dataset_dir(dataset, data_dir)
+    if dataset == "Summary":
+        return sorted(path.glob("*.parquet"))
+    return sorted(path.glob("**/*.parquet"))
+
+
+def convert_file(source: Path, target: Path) -> int:
+    """Write one Parquet file as an uncompressed Arrow IPC file, returns its rows
+
+    Every row group of a Parquet file has its own dictionaries, they are unified into one
+    per column because an IPC file cannot replace a dictionary between record batches. The
+    file is read whole for that, one partition file at a time.
+    """
+    table = pq.ParquetFile(source).read().unify_dictionaries()
+    target.parent.mkdir(parents=True, exist_ok=True)
+    with pa.ipc.new_file(target, table.schema, options=WRITE_OPTIONS) as writer:
+        writer.write_table(table)
+    return table.num_rows
+
+
+def cache_dataset(
+    dataset: str, data_dir: Path | None = None, cache_dir: Path | None = None
+) -> Path:
+    """Folder of the IPC files of the downloaded version of a dataset, converted if needed
+
+    The files are written to a temporary folder renamed when it is complete, so a session
+    that is interrupted or runs at the same time never opens a half written version. Other
+    versions of the dataset in the cache are removed.
+    """
+    version = dataset_version(dataset, data_dir)
+    root = Path(cache_dir or CACHE_DIR) / dataset
+    # created_at without the colons, which are not allowed in Windows folder names
+    target = root / version.replace(":", "")
+    if not target.is_dir():
+        source = dataset_dir(dataset, data_dir)
+        tmp = root / f".{target.name}-{os.getpid()}"
+        shutil.rmtree(tmp, ignore_errors=True)
+        rows = 0
+        try:
+            for file in source_files(dataset, data_dir):
+                relative = file.relative_to(source).with_suffix(".arrow")
+                rows += convert_file(file, tmp / relative)
+        except BaseException:
+            # e.g. an interrupted notebook cell, the kernel keeps running
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        try:
+            tmp.rename(target)
+        except OSError:
+            # another session finished converting the same version first
+            shutil.rmtree(tmp, ignore_errors=True)
+        else:
+            logger.info(f"Cached {rows:,} rows of {dataset} {version} in {target}")
+    evict(dataset, keep=target.name, cache_dir=cache_dir)
+    return target
+
+
+def evict(
+    dataset: str | None = None, keep: str | None = None, cache_dir: Path | None = None
+) -> list[Path]:
+    """Remove the cached versions of a dataset (of every dataset by default) except keep
+
+    The temporary folders of conversions running in other sessions are left. Files still
+    mapped by another session stay readable until it closes them on Linux and macOS, on
+    Windows the files in use are left and removed by a later call.
+    """
+    root = Path(cache_dir or CACHE_DIR)
+    roots = [root / dataset] if dataset else [p for p in root.glob("*") if p.is_dir()]
+    removed = []
+    for dataset_root in roots:
+        if not dataset_root.is_dir():
+            continue
+        for version in dataset_root.iterdir():
+            if version.name == keep or version.name.startswith("."):
+                continue
+            shutil.rmtree(version, ignore_errors=True)
+            removed.append(version)
+            logger.info(f"Removed the stale cache {version}")
+    return removed
+
+
+def open_table(
+    dataset: str,
+    columns: list[str] | None = None,
+    filter: ds.Expression | None = None,
+    data_dir: Path | None = None,
+    cache_dir: Path | None = None,
+) -> pa.Table:
+    """Table of a dataset backed by the memory mapped IPC files of the cache
+
+    columns and filter (e.g. ds.field("year") >= 2015) are applied by pyarrow.dataset, filters
+    on provider_key and year only open the matching partition folders. to_pandas() copies the
+    columns into numpy arrays, to_pandas(types_mapper=pd.ArrowDtype) keeps the mapped buffers.
+    """
+    path = cache_dataset(dataset, data_dir, cache_dir)
+    files = ds.dataset(
+        path,
+        format="ipc",
+        filesystem=fs.LocalFileSystem(use_mmap=True),
+        partitioning=None if dataset == "Summary" else PARTITIONING,
+    )
+    return files.to_table(columns=columns, filter=filter)
+
+
+def scan(
+    dataset: str, data_dir: Path | None = None, cache_dir: Path | None = None
+) -> pl.LazyFrame:
+    """Lazy frame over the memory mapped IPC files of a dataset, as parquet_query.scan()
+
+    The dictionary columns are categoricals with their own categories per file, collect()
+    needs a pl.StringCache() to combine them.
+    """
+    path = cache_dataset(dataset, data_dir, cache_dir)
+    if dataset == "Summary":
+        return pl.scan_ipc(path / "*.arrow", memory_map=True)
+    return pl.scan_ipc(
+        path / "**" / "*.arrow",
+        memory_map=True,
+        hive_partitioning=True,
+        hive_schema=HIVE_SCHEMA,
+    )
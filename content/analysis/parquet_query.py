@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+# Query the exported Parquet datasets without reading them whole.
+#
+#   from parquet_query import query
+#
+#   df = query(
+#       "CTD",
+#       parameter="Chlorophyll",
+#       years=range(2010, 2020),
+#       columns=["location_id", "sample_date", "upper_depth", "result", "units"],
+#   )
+#
+# The datasets are scanned lazily with polars. Filters on provider and year select the
+# provider_key=.../year=... folders to read (hive partition pruning), the other filters are
+# checked against the row group statistics and only the requested columns are read. Recent
+# results are kept in an LRU cache, which is dropped for a dataset when it is exported again.
+
+# Standard libraries
+import os
+from collections.abc import Iterable
+from functools import lru_cache
+from pathlib import Path
+
+# Third party libraries
+import polars as pl
+
+# Folder holding the dataset folders (Bottle, CTD, ...), as downloaded from the S3 bucket.
+DATA_DIR = Path(os.getenv("PHYTO_DATA_DIR", "data"))
+
+DATASETS = [
+    "Bottle",
+    "CTD",
+    "Mooring",
+    "Species_Abundance_Biovolume_Community",
+    "Summary",
+]
+
+# Column matched by parameter=, the bottle dataset names its parameters analytes.
+PARAMETER_COLUMNS = {"Bottle": "analyte_name"}
+
+# Types of the partition folder names, the same as the exported provider_key and year columns.
+HIVE_SCHEMA = {"provider_key": pl.String, "year": pl.Int32}
+
+# Number of query results kept in memory.
+CACHE_SIZE = 32
+
+
+def dataset_dir(dataset: str, data_dir: Path | None = None) -> Path:
+    if dataset not in DATASETS:
+        raise ValueError(f"Unknown dataset {dataset!r}, expected one of {DATASETS}")
+    path = Path(data_dir or DATA_DIR) / dataset
+    if not path.is_dir():
+        raise FileNotFoundError(f"{path} does not exist, download the datasets first")
+    return path
+
+
+def scan(dataset: str, data_dir: Path | None = None) -> pl.LazyFrame:
+    """Lazy frame over every file of a dataset, for queries that query() does not cover
+
+    Filters on the provider_key and year columns only read the matching partition folders.
+    The dictionary columns are categoricals with their own categories per file, collect()
+    needs a pl.StringCache() to combine them.
+    """
+    path = dataset_dir(dataset, data_dir)
+    if dataset == "Summary":
+        return pl.scan_parquet(path / "*.parquet")
+    return pl.scan_parquet(
+        path / "**" / "*.parquet", hive_partitioning=True, hive_schema=HIVE_SCHEMA
+    )
+
+
+def _values(value) -> tuple | None:
+    """A filter value as a tuple of accepted values, None for no filter"""
+    if value is None:
+        return None
+    if isinstance(value, (str, int)) or not isinstance(value, Iterable):
+        return (value,)
+    return tuple(value)
+
+
+def query(
+    dataset: str,
+    parameter: str | Iterable[str] | None = None,
+    area: str | Iterable[str] | None = None,
+    provider: str | Iterable[str] | None = None,
+    location: str | Iterable[str] | None = None,
+    years: int | Iterable[int] | None = None,
+    columns: Iterable[str] | None = None,
+    data_dir: Path | None = None,
+) -> pl.DataFrame:
+    """Rows of a dataset matching every given filter, with only the given columns
+
+    Every filter takes one value or several (e.g. years=range(2010, 2020)). parameter is
+    matched against analyte_name for the bottle dataset. The result is cached, the same query
+    returns the cached frame until the dataset is exported again (its _metadata changes).
+    """
+    path = dataset_dir(dataset, data_dir)
+    try:
+        version = (path / "_metadata").stat().st_mtime_ns
+    except FileNotFoundError:
+        version = None
+    return _query(
+        path,
+        version,
+        dataset,
+        _values(parameter),
+        _values(area),
+        _values(provider),
+        _values(location),
+        _values(years),
+        None if columns is None else tuple(columns),
+    ).clone()
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _query(
+    path: Path,
+    version: int | None,
+    dataset: str,
+    parameter: tuple | None,
+    area: tuple | None,
+    provider: tuple | None,
+    location: tuple | None,
+    years: tuple | None,
+    columns: tuple | None,
+) -> pl.DataFrame:
+    lf = scan(dataset, path.parent)
+    filters = []
+    if provider is not None:
+        # The partition column prunes the folders, the provider column is the exact match
+        # (providers differing only by spaces and underscores share a folder)
+        filters.append(
+            pl.col("provider_key").is_in([p.replace(" ", "_") for p in provider])
+        )
+        filters.append(pl.col("provider").is_in(provider))
+    if years is not None:
+        filters.append(pl.col("year").is_in(years))
+    if parameter is not None:
+        column = PARAMETER_COLUMNS.get(dataset, "parameter")
+        filters.append(pl.col(column).is_in(parameter))
+    if area is not None:
+        filters.append(pl.col("area_id").is_in(area))
+    if location is not None:
+        filters.append(pl.col("location_id").is_in(location))
+    if filters:
+        lf = lf.filter(*filters)
+    if columns is not None:
+        lf = lf.select(columns)
+    # The dictionary columns of every file are read as categoricals, a shared string cache
+    # combines them without re-encoding
+    with pl.StringCache():
+        return lf.collect()
+
+
+def clear_cache() -> None:
+    _query.cache_clear()
+
+
+def cache_info():
+    return _query.cache_info()
@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+
+# Stage timing for the data pipelines (parquet_export.py, studies/uw-salish-cruises/unxtab_UWSalishData_ZC.py).
+#
+#   instrument = Instrumentation("parquet_export")
+#   instrument.configure(log_path="phyto-indicator-data-events.jsonl", profile=["write"])
+#
+#   with instrument.stage("write", dataset="CTD") as timer:
+#       ...
+#       timer.rows += batch.num_rows
+#
+#   for batch in instrument.iterate("fetch", batches(conn, sql, schema), dataset="CTD"):
+#       ...
+#
+# Every finished stage adds its seconds, rows and bytes to the run totals and, with a log_path, is
+# appended to a json lines event log (one {"time", "run", "pid", "event", "stage", "seconds", "rows",
+# "bytes", ...} object per line) that runs and worker processes share. summary() is the table of
+# the totals per stage for the end of the run. Stages running in several threads add up, their
+# seconds can be more than the wall clock time.
+#
+# Stages named in profile are profiled with cProfile (one <run>-<stage>-<pid>.prof per stage and
+# process, written by close() or take_totals(), open with python -m pstats or snakeviz) or with
+# py-spy (an svg flame graph per stage call of the whole process, py-spy has to be installed and
+# allowed to attach to the process).
+
+import cProfile
+import json
+import logging
+import os
+import shutil
+import signal
+import subprocess
+import threading
+import time
+from collections.abc import Iterable, Iterator
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+PROFILERS = ["cprofile", "py-spy"]
+
+# Counters of a stage, the seconds are measured, rows and bytes are added by the stage
+COUNTERS = ("calls", "errors", "seconds", "rows", "bytes")
+
+
+class Instrumentation:
+    """Stage timers, rows/bytes counters and an event log for one pipeline run"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.run = f"{name}-{datetime.now():%Y%m%dT%H%M%S}-{os.getpid()}"
+        self.log_path = None
+        self.profile = set()
+        self.profiler = "cprofile"
+        self.profile_dir = Path(".")
+        self.totals = {}
+        self.lock = threading.Lock()
+        self.log_file = None
+        self.log_pid = None
+        self.profiles = {}
+        # cProfile can only profile one stage at a time, other stages run unprofiled meanwhile
+        self.profiling = threading.Lock()
+        self.py_spy_calls = 0
+
+    def configure(
+        self,
+        log_path: Path | None = None,
+        profile: Iterable[str] = (),
+        profiler: str = "cprofile",
+        profile_dir: Path | None = None,
+        run: str | None = None,
+    ):
+        """Set the event log and the stages to profile ("all" for every stage), the totals are reset
+
+        run keeps the run id of the parent in worker processes, so their events are
+        grouped with the parent's (see ProcessPoolExecutor's initializer). A forked worker
+        starts without the totals of its parent.
+        """
+        if profiler not in PROFILERS:
+            raise ValueError(
+                f"Unknown profiler {profiler!r}, expected one of {PROFILERS}"
+            )
+        if profiler == "py-spy" and profile and shutil.which("py-spy") is None:
+            raise FileNotFoundError(
+                "py-spy is not installed (python -m pip install py-spy)"
+            )
+        self.log_path = Path(log_path) if log_path else None
+        self.profile = set(profile)
+        self.profiler = profiler
+        self.profile_dir = Path(profile_dir or ".")
+        if run is not None:
+            self.run = run
+        self.totals = {}
+        self.profiles = {}
+        if self.profile:
+            self.profile_dir.mkdir(parents=True, exist_ok=True)
+
+    def settings(self) -> tuple:
+        """configure() arguments that reproduce this configuration in a worker process"""
+        return (
+            self.log_path,
+            sorted(self.profile),
+            self.profiler,
+            self.profile_dir,
+            self.run,
+        )
+
+    def event(self, event: str, **fields):
+        """Append an event to the log, e.g. the progress of a run"""
+        if self.log_path is None:
+            return
+        record = {
+            "time": datetime.now().isoformat(),
+            "run": self.run,
+            "pid": os.getpid(),
+            "event": event,
+            **fields,
+        }
+        line = json.dumps(record, default=str) + "\n"
+        with self.lock:
+            # A forked worker gets its own handle, lines of every process are appended whole
+            if self.log_file is None or self.log_pid != os.getpid():
+                self.log_path.parent.mkdir(parents=True, exist_ok=True)
+                self.log_file = open(self.log_path, "a", buffering=1)
+                self.log_pid = os.getpid()
+            self.log_file.write(line)
+
+    def add(self, stage: str, **counters):
+        """Add counters of a stage to the totals, e.g. the totals returned by a worker process"""
+        with self.lock:
+            totals = self.totals.setdefault(stage, dict.fromkeys(COUNTERS, 0))
+            for key, value in counters.items():
+                totals[key] += value
+
+    def take_totals(self) -> dict:
+        """The totals so far, which are reset, for a worker to hand them to the parent's add()
+
+        The cProfile stats so far are written too, worker processes are never closed.
+        """
+        self.dump_profiles()
+        with self.lock:
+            totals, self.totals = self.totals, {}
+        return totals
+
+    def dump_profiles(self):
+        for stage, profile in list(self.profiles.items()):
+            profile.dump_stats(
+                self.profile_dir / f"{self.run}-{stage}-{os.getpid()}.prof"
+            )
+
+    def timer(self, stage: str, **fields) -> "StageTimer":
+        """Timer adding up several blocks (e.g. every batch of a chunk) as one call of a stage"""
+        return StageTimer(self, stage, fields)
+
+    @contextmanager
+    def stage(self, stage: str, **fields) -> Iterator["StageTimer"]:
+        """Time the block as one call of a stage, the block adds to the rows and bytes of the timer
+
+        fields (e.g. the file or dataset) are written with the stage event.
+        """
+        timer = self.timer(stage, **fields)
+        try:
+            with timer.time():
+                yield timer
+        finally:
+            timer.record()
+
+    def timed(self, stage: str):
+        """Decorator timing every call of a function as a call of a stage"""
+
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.stage(stage):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def iterate(
+        self, stage: str, items: Iterable, rows=None, size=None, **fields
+    ) -> Iterator:
+        """Yield the items, timing only the time spent producing them (e.g. fetching batches)
+
+        rows and size are functions of an item, by default the num_rows and nbytes of a
+        record batch or table. The iteration is one call, recorded when it ends.
+        """
+        rows = rows or (lambda item: getattr(item, "num_rows", 1))
+        size = size or (lambda item: getattr(item, "nbytes", 0))
+        timer = self.timer(stage, **fields)
+        iterator = iter(items)
+        items = 0
+        try:
+            while True:
+                with timer.time():
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        break
+                items += 1
+                timer.rows += rows(item)
+                timer.bytes += size(item)
+                yield item
+        finally:
+            timer.record(items=items)
+
+    @contextmanager
+    def profiled(self, stage: str):
+        """Profile the block when the stage is one of the profiled stages"""
+        if not (stage in self.profile or "all" in self.profile):
+            yield
+            return
+        if self.profiler == "py-spy":
+            with self.py_spy(stage):
+                yield
+            return
+        if not self.profiling.acquire(blocking=False):
+            yield
+            return
+        try:
+            profile = self.profiles.setdefault(stage, cProfile.Profile())
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+        finally:
+            self.profiling.release()
+
+    @contextmanager
+    def py_spy(self, stage: str):
+        """Record the process with py-spy while the block runs, stopped with SIGINT to write the svg"""
+        with self.lock:
+            self.py_spy_calls += 1
+            output = (
+                self.profile_dir
+                / f"{self.run}-{stage}-{os.getpid()}-{self.py_spy_calls}.svg"
+            )
+        proc = subprocess.Popen(
+            [
+                "py-spy",
+                "record",
+                "--pid",
+                str(os.getpid()),
+                "--output",
+                str(output),
+                "--threads",
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+        try:
+            yield
+        finally:
+            proc.send_signal(signal.SIGINT)
+            _, stderr = proc.communicate()
+            if proc.returncode not in (0, -signal.SIGINT) and not output.exists():
+                logger.warning(f"py-spy could not profile {stage}: {stderr.strip()}")
+
+    def summary(self) -> str:
+        """Table of the totals per stage"""
+        lines = [
+            f"{'stage':<18}{'calls':>8}{'errors':>8}{'seconds':>12}{'rows':>15}{'MB':>12}{'rows/s':>14}{'MB/s':>10}"
+        ]
+        for stage, totals in self.totals.items():
+            seconds = totals["seconds"]
+            rate = totals["rows"] / seconds if seconds else 0
+            mb = totals["bytes"] / 1e6
+            lines.append(
+                f"{stage:<18}{totals['calls']:>8,}{totals['errors']:>8,}{seconds:>12,.2f}"
+                f"{totals['rows']:>15,}{mb:>12,.1f}{rate:>14,.0f}{mb / seconds if seconds else 0:>10,.1f}"
+            )
+        return "\n".join(lines)
+
+    def close(self):
+        """Write the totals as a summary event, the cProfile stats and close the event log"""
+        self.event("summary", totals=self.totals)
+        self.dump_profiles()
+        with self.lock:
+            if self.log_file is not None:
+                self.log_file.close()
+                self.log_file = None
+
+
+class StageTimer:
+    """Seconds, rows and bytes of one call of a stage, recorded once with record()"""
+
+    def __init__(self, instrumentation: Instrumentation, stage: str, fields: dict):
+        self.instrumentation = instrumentation
+        self.stage = stage
+        self.fields = fields
+        self.seconds = 0.0
+        self.rows = 0
+        self.bytes = 0
+        self.error = None
+
+    @contextmanager
+    def time(self, rows: int = 0, size: int = 0):
+        """Add the time spent in the block, and rows and size in bytes, to the call"""
+        start = time.perf_counter()
+        try:
+            with self.instrumentation.profiled(self.stage):
+                yield self
+        except BaseException as err:
+            self.error = err
+            raise
+        finally:
+            self.seconds += time.perf_counter() - start
+            self.rows += rows
+            self.bytes += size
+
+    def record(self, **fields):
+        """Add the call to the totals and write its event"""
+        self.instrumentation.add(
+            self.stage,
+            calls=1,
+            errors=int(self.error is not None),
+            seconds=self.seconds,
+            rows=self.rows,
+            bytes=self.bytes,
+        )
+        self.instrumentation.event(
+            "stage",
+            stage=self.stage,
+            seconds=round(self.seconds, 6),
+            rows=self.rows,
+            bytes=self.bytes,
+            **({"error": repr(self.error)} if self.error is not None else {}),
+            **self.fields,
+            **fields,
+        )
@@ -0,0 +1,1337 @@
+#!/usr/bin/env python
+
+# Standard libraries
+import argparse
+import hashlib
+import json
+import logging
+import math
+import os
+import resource
+import shutil
+import sys
+import tarfile
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from pathlib import Path
+from urllib.parse import quote
+
+# Third party libraries
+import numexpr as ne
+import psycopg2
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+import zstandard as zstd
+from dotenv import load_dotenv
+from psycopg2.extras import RealDictCursor
+from tqdm import tqdm
+
+# Local modules
+from instrumentation import PROFILERS, Instrumentation
+
+# The rollup store of scripts/rollup.py, the summary dataset is exported from it
+sys.path.append(Path(__file__).resolve().parents[2].joinpath("scripts").as_posix())
+import rollup  # noqa: E402
+
+load_dotenv()
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s %(message)s", datefmt="[%Y-%m-%d %H:%M:%S]"
+)
+logger = logging.getLogger(__name__)
+
+# Sets the maximum number of threads that numexpr can use (pyarrow uses numexpr)
+# to 80% of the number of cores on the machine.
+ne.numexpr_max_threads = int(ne.detect_number_of_cores() * 0.8)
+
+# Number of rows to process at a time.
+BATCH_SIZE = 50_000
+
+# How rows are fetched from the database:
+#   copy    COPY ... TO STDOUT (FORMAT csv) streamed into pyarrow's CSV reader, typed Arrow
+#           batches without python objects per row or cell
+#   cursor  server side cursor with RealDictCursor, a python dict per row (the original path)
+FETCH_METHODS = ["copy", "cursor"]
+
+# Bytes of COPY output parsed into one Arrow record batch by the copy fetch.
+COPY_BLOCK_SIZE = 16 << 20
+
+# Column names to partition data by.
+# The partitioned dataset will be organized into
+# folders based on values of the partitioning column.
+#
+#   ./output
+#   ├── provider=King County
+#   ├── ...
+#   └── provider=Washington Department of Ecology
+PARTITION_COLS = ["provider_key", "year"]
+
+# Rows are sorted by these columns within every file. The files record the sort order and are
+# written with column statistics and a page index, so readers filtering on a location or a
+# date range can skip row groups and pages.
+SORT_COLS = ["location_id", "sample_date"]
+
+# Type of the low cardinality text columns (areas, providers, parameters, units, ...). They are
+# written dictionary encoded and read back as categoricals by pandas and polars.
+CATEGORY = pa.dictionary(pa.int32(), pa.string())
+
+# Layout of the files in each partition folder. Rows are buffered per partition until a
+# full row group can be written and a partition gets a new part file after FILE_ROWS rows.
+# At most MAX_OPEN_FILES files are kept open per dataset, the least recently written one
+# is closed when another partition needs a file (its next rows start a new part file).
+ROW_GROUP_SIZE = 250_000
+FILE_ROWS = 5_000_000
+MAX_OPEN_FILES = 128
+# Buffered rows across all partitions of a writer before the largest buffer is written early.
+MAX_BUFFERED_ROWS = 1_000_000
+
+# Each dataset is exported by WORKERS threads with a database connection each. The view is
+# split into chunks of one provider and a range of years of about CHUNK_ROWS rows (smaller
+# when needed to give every worker several chunks), every chunk is one query with its own
+# partition writers. The _metadata of all chunks is merged at the end.
+WORKERS = 4
+CHUNK_ROWS = 2_000_000
+
+# Directory to store the parquet datasets in.
+# Each SQL file in the SQL_DIR will contain its own
+# dataset within the OUTDIR folder.
+OUTDIR = Path("phyto-indicator-data")
+
+# After the export OUTDIR is packaged into ARCHIVE_DIR, as one archive or one archive per
+# dataset, with a SHA256SUMS file of the archives and a manifest.json of the files in each.
+#   zstd  tar compressed with zstd on all cores
+#   tar   tar without compression, the parquet files are already compressed
+#   gz    tar.gz on a single core (the earlier format)
+ARCHIVE_CODECS = {"zstd": ".tar.zst", "tar": ".tar", "gz": ".tar.gz"}
+ARCHIVE_DIR = Path(OUTDIR.name + "-archives")
+ZSTD_LEVEL = 3
+
+# Json lines log of the timed stages of every run (see instrumentation.py), appended to
+# by each run. cProfile/py-spy output of the --profile stages goes to PROFILE_DIR.
+#   partition_stats  row counts of the partitions (and their checksums with --incremental)
+#   fetch            rows fetched from the database as Arrow record batches
+#   arrow            the part of fetch building record batches from python rows (cursor fetch)
+#   write            partitioned Parquet writes
+#   metadata         footers of the kept files and the _metadata file
+#   archive          the archives and checksums of package_output
+EVENTS_LOG = Path(OUTDIR.name + "-events.jsonl")
+PROFILE_DIR = Path(".cache/profile")
+STAGES = ["partition_stats", "fetch", "arrow", "write", "metadata", "archive"]
+
+instrument = Instrumentation("parquet_export")
+
+# PostgreSQL connection details
+if "PG_HOST" not in os.environ:
+    raise ValueError("Environment variable PG_HOST is not set")
+PG_HOST = os.getenv("PG_HOST")
+if "PG_DATABASE" not in os.environ:
+    raise ValueError("Environment variable PG_DATABASE is not set")
+PG_DATABASE = os.getenv("PG_DATABASE")
+if "PG_USER" not in os.environ:
+    raise ValueError("Environment variable PG_USER is not set")
+PG_USER = os.getenv("PG_USER")
+if "PG_PASSWORD" not in os.environ:
+    raise ValueError("Environment variable PG_PASSWORD is not set")
+PG_PASSWORD = os.getenv("PG_PASSWORD")
+
+
+def clparser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Export data from PostgreSQL to Parquet files. If the summary dataset is selected, data inventory summary will be exported in CSV format."
+    )
+    parser.add_argument(
+        "--filtered",
+        action="store_true",
+        help="Export only filtered parameters for bottle, mooring, and ctd datasets",
+    )
+    parser.add_argument(
+        "--fetch",
+        choices=FETCH_METHODS,
+        default="copy",
+        help="How rows are fetched from the database (default: copy)",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Keep the existing datasets and export again only the partitions whose row count or checksum changed",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=WORKERS,
+        help=f"Database connections used per dataset (default: {WORKERS})",
+    )
+    parser.add_argument(
+        "--row-group-size",
+        type=int,
+        default=ROW_GROUP_SIZE,
+        help=f"Rows per Parquet row group (default: {ROW_GROUP_SIZE:,})",
+    )
+    parser.add_argument(
+        "--file-rows",
+        type=int,
+        default=FILE_ROWS,
+        help=f"Rows per file before a partition gets a new part file (default: {FILE_ROWS:,})",
+    )
+    parser.add_argument(
+        "--archive",
+        choices=list(ARCHIVE_CODECS),
+        default="zstd",
+        help="Codec of the archives written to the archive folder (default: zstd)",
+    )
+    parser.add_argument(
+        "--archive-per-dataset",
+        action="store_true",
+        help="Write one archive per dataset, built in parallel, instead of one archive of everything",
+    )
+    parser.add_argument(
+        "--events",
+        type=Path,
+        default=EVENTS_LOG,
+        help=f"Json lines log the timings of the stages are appended to (default: {EVENTS_LOG})",
+    )
+    parser.add_argument(
+        "--profile",
+        nargs="+",
+        choices=STAGES + ["all"],
+        default=[],
+        help="Stages to profile",
+    )
+    parser.add_argument(
+        "--profiler",
+        choices=PROFILERS,
+        default="cprofile",
+        help=f"Profiler of the --profile stages, the output goes to {PROFILE_DIR} (default: cprofile)",
+    )
+    parser.add_argument(
+        "dataset",
+        type=str,
+        choices=["bottle", "mooring", "ctd", "species", "summary", "all"],
+        help="Dataset to export",
+    )
+    return parser
+
+
+def get_connection():
+    return psycopg2.connect(
+        host=PG_HOST,
+        database=PG_DATABASE,
+        user=PG_USER,
+        password=PG_PASSWORD,
+    )
+
+
+def select_sql(
+    sql: str, schema: pa.Schema, where: str = "1=1", order_by: list[str] | None = None
+) -> str:
+    """The query with the partition columns added and its columns in schema order
+
+    Boolean columns are cast, the views hold flags such as detected as 'True'/'False' text.
+    Text columns in order_by are sorted with the "C" collation, the byte order that Parquet
+    statistics are compared in.
+    """
+    columns = ",\n".join(
+        f'"{field.name}"::boolean as "{field.name}"'
+        if pa.types.is_boolean(field.type)
+        else f'"{field.name}"'
+        for field in schema
+    )
+    order = ""
+    if order_by:
+        order = "ORDER BY " + ", ".join(
+            f'"{name}" COLLATE "C"'
+            if pa.types.is_string(schema.field(name).type)
+            or pa.types.is_dictionary(schema.field(name).type)
+            else f'"{name}"'
+            for name in order_by
+        )
+    return f"""
+        SELECT
+            {columns}
+        FROM (
+            SELECT
+                *,
+                replace(provider, ' ', '_') as provider_key,
+                extract(year from sample_date)::integer as year
+            FROM (
+                {sql}
+            ) as subquery
+            WHERE {where}
+        ) as export
+        {order}
+    """
+
+
+def partition_path(partition_cols: list[str], key: tuple) -> str:
+    """Hive partition folder of a key, e.g. provider_key=King_County/year=2010"""
+    return "/".join(
+        f"{col}={'__HIVE_DEFAULT_PARTITION__' if value is None else quote(str(value), safe='')}"
+        for col, value in zip(partition_cols, key)
+    )
+
+
+def partition_stats(conn, sql: str, schema: pa.Schema, checksum: bool = False) -> list[tuple]:
+    """Row count (and checksum) of every provider and year of a query, by provider and year
+
+    Rows are (provider, partition path, year, rows, checksum). The checksum is the sum of the
+    hashes of the exported rows, so any changed, added or removed row changes it. It is only
+    computed with checksum=True (None otherwise), hashing every row costs a lot more than the count.
+    """
+    checksum_sql = "sum(hashtext(exported::text))" if checksum else "NULL::bigint"
+    with conn.cursor() as cursor:
+        cursor.execute(
+            f"""
+            SELECT
+                provider,
+                provider_key,
+                year,
+                count(*),
+                {checksum_sql}
+            FROM (
+                {select_sql(sql, schema)}
+            ) as exported
+            GROUP BY 1, 2, 3
+            ORDER BY 1, 3
+            """
+        )
+        return [
+            (
+                provider,
+                partition_path(PARTITION_COLS, (provider_key, year)),
+                year,
+                n,
+                None if row_checksum is None else int(row_checksum),
+            )
+            for provider, provider_key, year, n, row_checksum in cursor.fetchall()
+        ]
+
+
+def plan_chunks(
+    stats: list[tuple], workers: int, partitions: set[str] | None = None
+) -> list[tuple]:
+    """Split partition_stats rows into (provider, first_year, last_year) chunks, largest first
+
+    Consecutive years of a provider are combined until a chunk has enough rows. Rows without a
+    sample date are a chunk of their own per provider (first_year and last_year are None).
+    When partitions is given only those partitions are planned, a partition that is left out
+    ends the chunk before it so no chunk covers its rows.
+    """
+    selected = [
+        row for row in stats if partitions is None or row[1] in partitions
+    ]
+    total = sum(row[3] for row in selected)
+    target = max(1, min(CHUNK_ROWS, math.ceil(total / (workers * 4))))
+    chunks = []
+    chunk = None
+    for provider, path, year, n, _ in stats:
+        if partitions is not None and path not in partitions:
+            chunk = None
+        elif year is None:
+            chunks.append([provider, None, None, n])
+        elif chunk is not None and chunk[0] == provider and chunk[3] < target:
+            chunk[2] = year
+            chunk[3] += n
+        else:
+            chunk = [provider, year, year, n]
+            chunks.append(chunk)
+    chunks.sort(key=lambda chunk: chunk[3], reverse=True)
+    return [tuple(chunk[:3]) for chunk in chunks]
+
+
+def read_partition_checksums(dataset_dir: Path, file_schema: pa.Schema) -> dict | None:
+    """Rows and checksum per partition path stored in the _metadata of an earlier export
+
+    None when there are none or the earlier export wrote its files with another schema.
+    """
+    try:
+        stored_schema = pq.read_schema(dataset_dir / "_metadata")
+        if not stored_schema.equals(file_schema, check_metadata=False):
+            return None
+        metadata = stored_schema.metadata or {}
+        return {
+            path: tuple(value)
+            for path, value in json.loads(metadata[b"partitions"]).items()
+        }
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def chunk_where(conn, chunk: tuple | None) -> str:
+    """SQL condition for the rows of a chunk, None is every row
+
+    The values are inlined because COPY does not take query parameters. The conditions are
+    written so the (provider, sample_date) index of the views can be used.
+    """
+    if chunk is None:
+        return "1=1"
+    provider, first_year, last_year = chunk
+    condition = "provider is null" if provider is None else "provider = %(provider)s"
+    if first_year is None:
+        condition += " and sample_date is null"
+    else:
+        condition += (
+            " and sample_date >= make_date(%(first_year)s, 1, 1)"
+            " and sample_date < make_date(%(end_year)s, 1, 1)"
+        )
+    with conn.cursor() as cursor:
+        return cursor.mogrify(
+            condition,
+            {
+                "provider": provider,
+                "first_year": first_year,
+                "end_year": None if last_year is None else last_year + 1,
+            },
+        ).decode()
+
+
+def cursor_batches(conn, sql: str, schema: pa.Schema) -> Iterator[pa.RecordBatch]:
+    """Fetch BATCH_SIZE rows at a time from a server side cursor, one python dict per row"""
+    # Building the record batches from the python rows is timed on its own as the arrow stage
+    arrow = instrument.timer("arrow")
+    with conn.cursor(
+        name="phyto_db_large_export", cursor_factory=RealDictCursor
+    ) as cursor:
+        try:
+            cursor.execute(sql)
+            while True:
+                rows = cursor.fetchmany(BATCH_SIZE)
+                if not rows:
+                    break
+                with arrow.time(rows=len(rows)):
+                    batch_dict = {
+                        key: [row.get(key, None) for row in rows]
+                        for key in schema.names
+                    }
+                    batch = pa.RecordBatch.from_pydict(batch_dict, schema=schema)
+                arrow.bytes += batch.nbytes
+                yield batch
+        finally:
+            arrow.record()
+
+
+def copy_batches(conn, sql: str, schema: pa.Schema) -> Iterator[pa.RecordBatch]:
+    """Stream the rows of a query as typed Arrow record batches
+
+    The server writes the rows with COPY ... TO STDOUT (FORMAT csv) into a pipe from a
+    background thread, pyarrow's streaming CSV reader parses the other end straight into
+    Arrow columns of the schema types.
+    """
+    read_fd, write_fd = os.pipe()
+
+    def copy():
+        with os.fdopen(write_fd, "wb") as sink, conn.cursor() as cursor:
+            cursor.copy_expert(
+                f"COPY ({sql}) TO STDOUT WITH (FORMAT csv, HEADER true)", sink
+            )
+
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        copying = pool.submit(copy)
+        try:
+            with os.fdopen(read_fd, "rb") as source:
+                yield from pacsv.open_csv(
+                    source,
+                    read_options=pacsv.ReadOptions(block_size=COPY_BLOCK_SIZE),
+                    convert_options=pacsv.ConvertOptions(
+                        column_types=schema,
+                        # COPY writes NULL as an unquoted empty field and empty strings as ""
+                        null_values=[""],
+                        strings_can_be_null=True,
+                        quoted_strings_can_be_null=False,
+                        true_values=["t"],
+                        false_values=["f"],
+                    ),
+                )
+        except Exception as err:
+            # A failed COPY (e.g. a bad query) shows up here as an empty or truncated stream
+            copy_error = copying.exception()
+            if copy_error is not None and not isinstance(copy_error, BrokenPipeError):
+                raise copy_error from err
+            raise
+        copying.result()
+
+
+class PartitionedWriter:
+    """Write record batches into a hive partitioned dataset in a single pass
+
+    Every partition (e.g. provider_key=King_County/year=2010) keeps an open ParquetWriter
+    and a buffer of rows, so a partition ends up with one file of full row groups instead of
+    a small file for every batch that touched it. The footers of the written files are
+    collected in metadata_collector with their paths relative to the dataset root, ready for
+    pq.write_metadata.
+    """
+
+    def __init__(
+        self,
+        root: Path,
+        schema: pa.Schema,
+        partition_cols: list[str],
+        row_group_size: int = ROW_GROUP_SIZE,
+        file_rows: int = FILE_ROWS,
+        max_open_files: int = MAX_OPEN_FILES,
+        max_buffered_rows: int = MAX_BUFFERED_ROWS,
+        compression: str = "snappy",
+        basename_template: str = "part-{i}.parquet",
+        sorting_columns: list[str] | None = None,
+    ):
+        self.root = Path(root)
+        self.partition_cols = partition_cols
+        # The partition columns are not stored in the files
+        self.file_schema = pa.schema(
+            [field for field in schema if field.name not in partition_cols],
+            metadata=schema.metadata,
+        )
+        self.row_group_size = row_group_size
+        self.file_rows = file_rows
+        self.max_open_files = max_open_files
+        self.max_buffered_rows = max_buffered_rows
+        self.compression = compression
+        self.basename_template = basename_template
+        # Recorded in the row groups, the rows have to arrive in this order
+        self.sorting_columns = (
+            pq.SortingColumn.from_ordering(
+                self.file_schema, [(name, "ascending") for name in sorting_columns]
+            )
+            if sorting_columns
+            else None
+        )
+        self.metadata_collector = []
+        # partition key -> pending record batches and their row count
+        self.buffers = {}
+        self.buffered_rows = 0
+        # partition key -> (ParquetWriter, relative path, rows written), least recently used first
+        self.writers = OrderedDict()
+        self.file_counts = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write_batch(self, batch: pa.RecordBatch):
+        """Split a batch by partition, full row groups are written as soon as they are buffered"""
+        if batch.num_rows == 0:
+            return
+        table = pa.Table.from_batches([batch])
+        groups = (
+            table.select(self.partition_cols)
+            .append_column("__row", pa.array(range(table.num_rows), pa.int64()))
+            .group_by(self.partition_cols, use_threads=False)
+            .aggregate([("__row", "list")])
+        )
+        rows = groups.column("__row_list")
+        keys = zip(*(groups.column(col).to_pylist() for col in self.partition_cols))
+        for i, key in enumerate(keys):
+            part = table.take(rows[i].values).select(self.file_schema.names)
+            pending, n_rows = self.buffers.get(key, ([], 0))
+            pending.extend(part.to_batches())
+            n_rows += part.num_rows
+            self.buffers[key] = (pending, n_rows)
+            self.buffered_rows += part.num_rows
+            if n_rows >= self.row_group_size:
+                self.flush(key)
+        # Many small partitions could buffer most of the dataset, write the largest one early
+        while self.buffered_rows > self.max_buffered_rows:
+            self.flush(max(self.buffers, key=lambda key: self.buffers[key][1]))
+
+    def flush(self, key: tuple):
+        """Write the buffered rows of a partition in row groups of row_group_size rows"""
+        pending, n_rows = self.buffers.pop(key, ([], 0))
+        self.buffered_rows -= n_rows
+        # Every batch has its own dictionaries, the chunks of a write share one per column
+        table = pa.Table.from_batches(pending, schema=self.file_schema).unify_dictionaries()
+        offset = 0
+        while offset < table.num_rows:
+            writer, path, file_rows = self.writer(key)
+            n_rows = min(table.num_rows - offset, self.file_rows - file_rows)
+            chunk = table.slice(offset, n_rows)
+            writer.write_table(chunk, row_group_size=self.row_group_size)
+            offset += n_rows
+            file_rows += n_rows
+            self.writers[key] = (writer, path, file_rows)
+            if file_rows >= self.file_rows:
+                self.close_file(key)
+
+    def writer(self, key: tuple):
+        """The open file of a partition, a new part file is started if it has none"""
+        if key in self.writers:
+            self.writers.move_to_end(key)
+            return self.writers[key]
+        while len(self.writers) >= self.max_open_files:
+            self.close_file(next(iter(self.writers)))
+        n = self.file_counts.get(key, 0)
+        self.file_counts[key] = n + 1
+        path = f"{partition_path(self.partition_cols, key)}/{self.basename_template.format(i=n)}"
+        (self.root / path).parent.mkdir(parents=True, exist_ok=True)
+        writer = pq.ParquetWriter(
+            self.root / path,
+            self.file_schema,
+            compression=self.compression,
+            write_statistics=True,
+            write_page_index=True,
+            sorting_columns=self.sorting_columns,
+        )
+        self.writers[key] = (writer, path, 0)
+        return self.writers[key]
+
+    def close_file(self, key: tuple):
+        writer, path, _ = self.writers.pop(key)
+        writer.close()
+        metadata = writer.writer.metadata
+        metadata.set_file_path(path)
+        self.metadata_collector.append(metadata)
+
+    def close(self):
+        """Write what is still buffered and close every file"""
+        for key in list(self.buffers):
+            self.flush(key)
+        for key in list(self.writers):
+            self.close_file(key)
+
+
+def postgres_to_parquet(
+    dataset_name: str,
+    sql: str,
+    schema: pa.Schema,
+    fetch: str = "copy",
+    row_group_size: int = ROW_GROUP_SIZE,
+    file_rows: int = FILE_ROWS,
+    workers: int = WORKERS,
+    incremental: bool = False,
+) -> None:
+    """Export a query to a Parquet dataset partitioned by provider and year
+
+    With incremental=True the row count and checksum of every partition are compared with the
+    ones stored in the _metadata of the existing dataset. Only changed partitions are exported
+    again, partitions that no longer exist are removed, and the _metadata is rebuilt from the
+    new files and the footers of the files that were kept. The checksums are only computed and
+    stored by incremental exports, and a full export with one worker runs no planning query.
+    """
+    dataset_dir = OUTDIR / dataset_name
+    logger.info(f"Processing data for {dataset_dir}")
+
+    metadata = {
+        "dataset_name": dataset_name,
+        "project": "Phytoplankton Vital Signs Indicator Project: Phase 2",
+        "sponsor": "Puget Sound Partnership",
+        "institutions": "GSI Environmental Inc., University of Washington, Washington Department of Ecology",
+        "principal_investigator": "Dr. Brandon Sackmann (bssackmann@gsi-net.com)",
+        "data_manager": "Caleb Grant (cgrant@gsi-net.com)",
+        "created_at": datetime.now().isoformat(),
+    }
+    schema_with_metadata = schema.with_metadata(
+        {k: str(v).encode("utf-8") for k, v in metadata.items()}
+    )
+    file_schema = pa.schema(
+        [field for field in schema_with_metadata if field.name not in PARTITION_COLS],
+        metadata=schema_with_metadata.metadata,
+    )
+
+    previous = read_partition_checksums(dataset_dir, file_schema) if incremental else None
+    if incremental and previous is None:
+        logger.info(f"No partition checksums for this schema in {dataset_dir}, exporting everything")
+
+    # Create the dataset directory
+    if previous is None and dataset_dir.exists() and dataset_dir.is_dir():
+        shutil.rmtree(dataset_dir)
+    dataset_dir.mkdir(parents=True, exist_ok=True)
+
+    batches = {"copy": copy_batches, "cursor": cursor_batches}[fetch]
+
+    start = time.perf_counter()
+    stats = []
+    if incremental or workers > 1:
+        conn = get_connection()
+        try:
+            with instrument.stage("partition_stats", dataset=dataset_name) as timer:
+                stats = partition_stats(conn, sql, schema, checksum=incremental)
+                timer.rows = sum(row[3] for row in stats)
+        finally:
+            conn.close()
+    # Providers that only differ by spaces and underscores share a partition
+    checksums = {}
+    if incremental:
+        for _, path, _, n, checksum in stats:
+            rows, total = checksums.get(path, (0, 0))
+            checksums[path] = (rows + n, total + checksum)
+
+    if previous is None:
+        kept = set()
+        chunks = plan_chunks(stats, workers) if workers > 1 else [None]
+    else:
+        changed = {path for path, value in checksums.items() if previous.get(path) != value}
+        removed = set(previous) - set(checksums)
+        kept = set(checksums) - changed
+        logger.info(
+            f"{len(changed)} changed, {len(removed)} removed and {len(kept)} unchanged partitions"
+        )
+        for path in changed | removed:
+            shutil.rmtree(dataset_dir / path, ignore_errors=True)
+        chunks = plan_chunks(stats, workers, partitions=changed)
+    logger.info(
+        f"Querying database ({fetch} fetch, {len(chunks)} chunks, {workers} connections)..."
+    )
+    logger.info(f"Writing results to parquet in {dataset_dir}")
+
+    # Every worker thread keeps its own connection for the chunks it runs
+    local = threading.local()
+    connections = []
+
+    def export_chunk(i: int, chunk: tuple | None) -> tuple[list, int]:
+        if not hasattr(local, "conn"):
+            local.conn = get_connection()
+            connections.append(local.conn)
+        num_rows = 0
+        write = instrument.timer("write", dataset=dataset_name, chunk=i)
+        try:
+            # The chunk index in the file names keeps chunks that share a partition apart
+            with PartitionedWriter(
+                dataset_dir,
+                schema_with_metadata,
+                PARTITION_COLS,
+                row_group_size=row_group_size,
+                file_rows=file_rows,
+                basename_template=f"part-{i}-{{i}}.parquet",
+                sorting_columns=SORT_COLS,
+            ) as writer:
+                sql_chunk = select_sql(
+                    sql, schema, chunk_where(local.conn, chunk), order_by=SORT_COLS
+                )
+                for batch in instrument.iterate(
+                    "fetch", batches(local.conn, sql_chunk, schema), dataset=dataset_name, chunk=i
+                ):
+                    with write.time(rows=batch.num_rows, size=batch.nbytes):
+                        writer.write_batch(batch)
+                    num_rows += batch.num_rows
+                # What is still buffered is written when the files are closed
+                with write.time():
+                    writer.close()
+        finally:
+            write.record()
+        return writer.metadata_collector, num_rows
+
+    num_rows = 0
+    metadata_collector = []
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool, tqdm(
+            total=len(chunks), desc=f"Processing chunks ({dataset_name})", unit=" chunk"
+        ) as pbar:
+            futures = [
+                pool.submit(export_chunk, i, chunk) for i, chunk in enumerate(chunks)
+            ]
+            try:
+                for future in as_completed(futures):
+                    collector, chunk_rows = future.result()
+                    metadata_collector.extend(collector)
+                    num_rows += chunk_rows
+                    pbar.update(1)
+            except BaseException:
+                # Do not start the remaining chunks of a failed export
+                for future in futures:
+                    future.cancel()
+                raise
+    finally:
+        for conn in connections:
+            conn.close()
+    seconds = time.perf_counter() - start
+
+    with instrument.stage("metadata", dataset=dataset_name) as timer:
+        # Footers of the files in the partitions that were kept from the earlier export
+        for path in kept:
+            for file in (dataset_dir / path).glob("*.parquet"):
+                file_metadata = pq.read_metadata(file)
+                file_metadata.set_file_path(file.relative_to(dataset_dir).as_posix())
+                metadata_collector.append(file_metadata)
+        # Same file order for every run, whichever chunk finished first
+        metadata_collector.sort(key=lambda metadata: metadata.row_group(0).column(0).file_path)
+        partitions = {}
+        if incremental:
+            partitions[b"partitions"] = json.dumps(checksums, sort_keys=True).encode("utf-8")
+        pq.write_metadata(
+            schema=file_schema.with_metadata({**file_schema.metadata, **partitions}),
+            where=f"{dataset_dir}/_metadata",
+            metadata_collector=metadata_collector,
+        )
+        timer.rows = sum(metadata.num_rows for metadata in metadata_collector)
+    logger.info(f"Metadata written to {dataset_dir / '_metadata'}")
+
+    logger.info("Dataset export complete")
+    # ru_maxrss is KiB on linux, it is the peak of the whole process (all export jobs)
+    logger.info(
+        f"  {num_rows} rows in {seconds:.1f}s ({num_rows / seconds:,.0f} rows/s, {fetch} fetch), "
+        f"peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:,.0f} MB"
+    )
+    meta = pq.read_metadata(dataset_dir / "_metadata")
+    ds = pq.ParquetDataset(dataset_dir)
+    logger.info(f"  num_files      : {len(ds.files)}")
+    logger.info(f"  format_version : {meta.format_version}")
+    logger.info(f"  num_columns    : {meta.num_columns}")
+    logger.info(f"  num_row_groups : {meta.num_row_groups}")
+    logger.info(f"  num_rows       : {meta.num_rows}")
+
+    for key, value in meta.metadata.items():
+        if "schema" not in key.decode("utf-8") and key != b"partitions":
+            logger.info(f"  {str(key.decode('utf-8')):<15}: {value.decode('utf-8')}")
+
+
+class HashingFile:
+    """File object wrapper that hashes the bytes read from or written through it"""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.fileobj.read(size)
+        self.sha256.update(data)
+        self.size += len(data)
+        return data
+
+    def write(self, data) -> int:
+        self.sha256.update(data)
+        self.size += len(data)
+        return self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+
+def write_archive(path: Path, dataset_dirs: list[Path], codec: str, threads: int = -1) -> dict:
+    """Write the files of the datasets to a tar archive in a single pass
+
+    The members are named phyto-indicator-data/<dataset>/..., so extracting any set of
+    archives gives the same folder. The archive and every member are hashed while they are
+    written, returns the size and sha256 of both.
+    """
+    members = {}
+    with open(path, "wb") as raw:
+        archive = HashingFile(raw)
+        if codec == "zstd":
+            # threads=-1 compresses on every core
+            stream = zstd.ZstdCompressor(level=ZSTD_LEVEL, threads=threads).stream_writer(
+                archive, closefd=False
+            )
+            mode = "w|"
+        else:
+            stream = archive
+            mode = "w|gz" if codec == "gz" else "w|"
+        with tarfile.open(fileobj=stream, mode=mode) as tar:
+            for dataset_dir in dataset_dirs:
+                for file in sorted(p for p in dataset_dir.rglob("*") if p.is_file()):
+                    arcname = f"{OUTDIR.name}/{file.relative_to(OUTDIR).as_posix()}"
+                    info = tar.gettarinfo(file, arcname)
+                    with open(file, "rb") as f:
+                        member = HashingFile(f)
+                        tar.addfile(info, member)
+                    members[arcname] = {"bytes": member.size, "sha256": member.sha256.hexdigest()}
+        if stream is not archive:
+            stream.close()
+    return {
+        "bytes": archive.size,
+        "sha256": archive.sha256.hexdigest(),
+        "datasets": [dataset_dir.name for dataset_dir in dataset_dirs],
+        "files": members,
+    }
+
+
+def package_output(codec: str = "zstd", per_dataset: bool = False, workers: int = WORKERS) -> None:
+    """Package OUTDIR into ARCHIVE_DIR with a SHA256SUMS of the archives and a manifest.json
+
+    With per_dataset every dataset gets its own archive and the archives are written in
+    parallel, a dataset can then be downloaded, verified and extracted on its own. The
+    manifest lists the size and sha256 of every file in every archive.
+    """
+    if ARCHIVE_DIR.exists():
+        shutil.rmtree(ARCHIVE_DIR)
+    ARCHIVE_DIR.mkdir(parents=True)
+    dataset_dirs = sorted(path for path in OUTDIR.iterdir() if path.is_dir())
+    suffix = ARCHIVE_CODECS[codec]
+    if per_dataset:
+        archives = {f"{path.name}{suffix}": [path] for path in dataset_dirs}
+    else:
+        archives = {f"{OUTDIR.name}{suffix}": dataset_dirs}
+    workers = max(1, min(workers, len(archives)))
+    # The zstd threads are shared between the archives written at the same time
+    threads = -1 if workers == 1 else max(1, (os.cpu_count() or 1) // workers)
+
+    logger.info(f"Packaging {OUTDIR} into {len(archives)} {codec} archives in {ARCHIVE_DIR}...")
+    start = time.perf_counter()
+
+    def archive(name: str, paths: list[Path]) -> dict:
+        with instrument.stage("archive", archive=name, codec=codec) as timer:
+            result = write_archive(ARCHIVE_DIR / name, paths, codec, threads)
+            timer.rows = len(result["files"])
+            timer.bytes = result["bytes"]
+        return result
+
+    manifest = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(archive, name, paths): name for name, paths in archives.items()
+        }
+        for future in as_completed(futures):
+            name = futures[future]
+            manifest[name] = future.result()
+            logger.info(f"Size of {ARCHIVE_DIR / name}: {manifest[name]['bytes'] / 1e6:,.1f} MB")
+    seconds = time.perf_counter() - start
+
+    # sha256sum -c SHA256SUMS in ARCHIVE_DIR verifies the downloaded archives
+    with open(ARCHIVE_DIR / "SHA256SUMS", "w") as f:
+        for name in sorted(manifest):
+            f.write(f"{manifest[name]['sha256']}  {name}\n")
+    with open(ARCHIVE_DIR / "manifest.json", "w") as f:
+        json.dump(
+            {
+                "created_at": datetime.now().isoformat(),
+                "codec": codec,
+                "archives": dict(sorted(manifest.items())),
+            },
+            f,
+            indent=1,
+        )
+    total = sum(archive["bytes"] for archive in manifest.values())
+    logger.info(f"Packaging complete in {seconds:.1f}s, {total / 1e6:,.1f} MB in {len(manifest)} archives")
+
+
+def mooring_export(filtered: bool = False, **options) -> None:
+    dataset_name = "Mooring"
+    schema = pa.schema(
+        [
+            ("area_id", CATEGORY),
+            ("location_id", pa.string()),
+            ("loc_desc", pa.string()),
+            ("loc_type", CATEGORY),
+            ("x_coord", pa.float64()),
+            ("y_coord", pa.float64()),
+            ("srid", pa.int64()),
+            ("coord_sys", CATEGORY),
+            ("loc_method", CATEGORY),
+            ("provider", CATEGORY),
+            ("study_id", CATEGORY),
+            ("study_name", CATEGORY),
+            ("study_loc_id", pa.string()),
+            ("sample_doc", pa.string()),
+            ("sample_date", pa.timestamp("us")),
+            ("coll_scheme", CATEGORY),
+            ("sample_material", CATEGORY),
+            ("sample_id", pa.string()),
+            ("sample_desc", pa.string()),
+            ("upper_depth", pa.float64()),
+            ("lower_depth", pa.float64()),
+            ("depth_units", CATEGORY),
+            ("comments", pa.string()),
+            ("parameter", CATEGORY),
+            ("meas_method", CATEGORY),
+            ("replicate", pa.string()),
+            ("result", pa.float64()),
+            ("units", CATEGORY),
+            ("detected", pa.bool_()),
+            ("qualifiers", pa.string()),
+            ("qa_flags", pa.uint8()),
+            ("validator_flags", pa.string()),
+            ("qa_level", CATEGORY),
+            ("data_quality", CATEGORY),
+            ("provider_key", pa.string()),
+            ("year", pa.int32()),
+        ]
+    )
+
+    sql = """
+        SELECT
+            *
+        FROM app.mooring
+    """
+    if filtered:
+        sql += """
+            WHERE
+                parameter in (
+                    'Turbidity',
+                    'Chlorophyll',
+                    'Fluorescence adjusted',
+                    'Chlorophyll Fluorescence Adjusted',
+                    'Beam Transmission',
+                    'Chlorophyll Fluorescence'
+                )
+        """
+
+    postgres_to_parquet(dataset_name=dataset_name, sql=sql, schema=schema, **options)
+
+
+def ctd_export(filtered: bool = False, **options) -> None:
+    dataset_name = "CTD"
+    schema = pa.schema(
+        [
+            ("area_id", CATEGORY),
+            ("location_id", pa.string()),
+            ("loc_desc", pa.string()),
+            ("loc_type", CATEGORY),
+            ("x_coord", pa.float64()),
+            ("y_coord", pa.float64()),
+            ("srid", pa.int64()),
+            ("coord_sys", CATEGORY),
+            ("loc_method", CATEGORY),
+            ("provider", CATEGORY),
+            ("study_id", CATEGORY),
+            ("study_name", CATEGORY),
+            ("study_loc_id", pa.string()),
+            ("sample_doc", pa.string()),
+            ("sample_date", pa.timestamp("us")),
+            ("coll_scheme", CATEGORY),
+            ("sample_material", CATEGORY),
+            ("sample_id", pa.string()),
+            ("sample_desc", pa.string()),
+            ("upper_depth", pa.float64()),
+            ("lower_depth", pa.float64()),
+            ("depth_units", CATEGORY),
+            ("comments", pa.string()),
+            ("parameter", CATEGORY),
+            ("meas_method", CATEGORY),
+            ("replicate", pa.string()),
+            ("result", pa.float64()),
+            ("units", CATEGORY),
+            ("detected", pa.bool_()),
+            ("qualifiers", pa.string()),
+            ("qa_flags", pa.uint8()),
+            ("validator_flags", pa.string()),
+            ("qa_level", CATEGORY),
+            ("data_quality", CATEGORY),
+            ("provider_key", pa.string()),
+            ("year", pa.int32()),
+        ]
+    )
+
+    sql = """
+        SELECT
+            *
+        FROM app.ctd
+    """
+    if filtered:
+        sql += """
+            WHERE
+                parameter in (
+                    'Turbidity',
+                    'Chlorophyll',
+                    'Fluorescence adjusted',
+                    'Chlorophyll Fluorescence Adjusted',
+                    'Beam Transmission',
+                    'Chlorophyll Fluorescence'
+                )
+        """
+
+    postgres_to_parquet(dataset_name=dataset_name, sql=sql, schema=schema, **options)
+
+
+def bottle_export(filtered: bool = False, **options) -> None:
+    dataset_name = "Bottle"
+    schema = pa.schema(
+        [
+            ("area_id", CATEGORY),
+            ("location_id", pa.string()),
+            ("loc_desc", pa.string()),
+            ("loc_type", CATEGORY),
+            ("loc_geom", pa.string()),
+            ("x_coord", pa.float64()),
+            ("y_coord", pa.float64()),
+            ("srid", pa.int64()),
+            ("coord_sys", CATEGORY),
+            ("loc_method", CATEGORY),
+            ("provider", CATEGORY),
+            ("study_id", CATEGORY),
+            ("study_name", CATEGORY),
+            ("sample_doc", pa.string()),
+            ("sample_date", pa.timestamp("us")),
+            ("coll_scheme", CATEGORY),
+            ("sample_material", CATEGORY),
+            ("sample_id", pa.string()),
+            ("sample_desc", pa.string()),
+            ("original_sample_id", pa.string()),
+            ("upper_depth", pa.float64()),
+            ("lower_depth", pa.float64()),
+            ("depth_units", CATEGORY),
+            ("split_type", CATEGORY),
+            ("sample_no", pa.string()),
+            ("lab", CATEGORY),
+            ("lab_pkg", pa.string()),
+            ("material", CATEGORY),
+            ("material_analyzed", CATEGORY),
+            ("labsample", pa.string()),
+            ("lab_rep", pa.string()),
+            ("method_code", CATEGORY),
+            ("method_desc", CATEGORY),
+            ("chem_class", CATEGORY),
+            ("cas_rn", CATEGORY),
+            ("analyte", CATEGORY),
+            ("analyte_name", CATEGORY),
+            ("result", pa.float64()),
+            ("qualifiers", pa.string()),
+            ("qa_flags", pa.uint8()),
+            ("lab_flags", pa.string()),
+            ("validator_flags", pa.string()),
+            ("detected", pa.bool_()),
+            ("detection_limit", pa.float64()),
+            ("quantification_limit", pa.float64()),
+            ("reporting_limit", pa.float64()),
+            ("units", CATEGORY),
+            ("meas_basis", CATEGORY),
+            ("fraction", CATEGORY),
+            ("dilution_factor", pa.float64()),
+            ("data_quality", CATEGORY),
+            ("qa_level", CATEGORY),
+            ("date_analyzed", pa.timestamp("us")),
+            ("date_extracted", pa.timestamp("us")),
+            ("doc_file", pa.string()),
+            ("comments", pa.string()),
+            ("provider_key", pa.string()),
+            ("year", pa.int32()),
+        ]
+    )
+
+    sql = """
+        SELECT
+            *
+        FROM app.bottle
+    """
+    if filtered:
+        sql += """
+            WHERE
+                analyte_name in (
+                    'Beam Transmission',
+                    'Turbidity',
+                    'Chlorophyll a',
+                    'Chlorophyll Concentration',
+                    'Chlorophyll Average'
+                )
+        """
+
+    postgres_to_parquet(dataset_name=dataset_name, sql=sql, schema=schema, **options)
+
+def species_export(filtered: bool = False, **options) -> None:
+    dataset_name = "Species_Abundance_Biovolume_Community"
+    schema = pa.schema(
+        [
+            ("area_id", CATEGORY),
+            ("location_id", pa.string()),
+            ("loc_desc", pa.string()),
+            ("loc_type", CATEGORY),
+            ("x_coord", pa.float64()),
+            ("y_coord", pa.float64()),
+            ("srid", pa.int64()),
+            ("coord_sys", CATEGORY),
+            ("loc_method", CATEGORY),
+            ("provider", CATEGORY),
+            ("study_name", CATEGORY),
+            ("study_loc_id", pa.string()),
+            ("sample_doc", pa.string()),
+            ("sample_date", pa.timestamp('us')),
+            ("coll_scheme", CATEGORY),
+            ("sample_material", CATEGORY),
+            ("sample_id", pa.string()),
+            ("sample_desc", pa.string()),
+            ("upper_depth", pa.float64()),
+            ("lower_depth", pa.float64()),
+            ("depth_units", CATEGORY),
+            ("taxon_code", pa.string()),
+            ("species", pa.string()),
+            ("common_name", pa.string()),
+            ("sex", CATEGORY),
+            ("life_stage", CATEGORY),
+            ("parameter", CATEGORY),
+            ("replicate", pa.string()),
+            ("result", pa.float64()),
+            ("units", CATEGORY),
+            ("qualifiers", pa.string()),
+            ("comments", pa.string()),
+            ("provider_key", pa.string()),
+            ("year", pa.int32()),
+        ]
+    )
+    sql = """
+        SELECT
+            *
+        FROM app.sp_abund
+    """
+    postgres_to_parquet(dataset_name=dataset_name, sql=sql, schema=schema, **options)
+
+
+def summary_export() -> None:
+    dataset_name = "Summary"
+    schema = pa.schema(
+        [
+            ("provider", pa.string()),
+            ("data_type", pa.string()),
+            ("document_title", pa.string()),
+            ("document_files", pa.string()),
+            ("years_sampled", pa.string()),
+            ("coll_scheme", pa.string()),
+            ("parameter", pa.string()),
+            ("units", pa.string()),
+            ("n_measurements", pa.int64()),
+            ("min", pa.float64()),
+            ("max", pa.float64()),
+            ("25th_percentile", pa.float64()),
+            ("median", pa.float64()),
+            ("75th_percentile", pa.float64()),
+        ]
+    )
+    # The app.summary_expanded rows of the rollup store, brought up to date with the database
+    # first so they are never older than the data. Without a view refreshed since the last update
+    # that is one catalog query, otherwise only loaded or changed studies are queried.
+    conn = get_connection()
+    try:
+        rollup.update(conn)
+    finally:
+        conn.close()
+    summary_file = rollup.ROLLUP_DIR / "summary.parquet"
+    if not summary_file.exists():
+        raise FileNotFoundError(
+            f"{summary_file} does not exist, the rollup found no studies in the database"
+        )
+    table = pq.read_table(summary_file).select(schema.names).cast(schema)
+
+    dataset_dir = OUTDIR / dataset_name
+    logger.info(f"Processing data for {dataset_dir} from {summary_file}")
+    if dataset_dir.exists() and dataset_dir.is_dir():
+        shutil.rmtree(dataset_dir)
+    dataset_dir.mkdir(parents=True, exist_ok=True)
+
+    metadata = {
+        "dataset_name": dataset_name,
+        "project": "Phytoplankton Vital Signs Indicator Project: Phase 2",
+        "sponsor": "Puget Sound Partnership",
+        "institutions": "GSI Environmental Inc., University of Washington, Washington Department of Ecology",
+        "principal_investigator": "Dr. Brandon Sackmann (bssackmann@gsi-net.com)",
+        "data_manager": "Caleb Grant (cgrant@gsi-net.com)",
+        "created_at": datetime.now().isoformat(),
+    }
+    schema_with_metadata = schema.with_metadata(
+        {k: str(v).encode("utf-8") for k, v in metadata.items()}
+    )
+    metadata_collector = []
+    pq.write_to_dataset(
+        table=table.replace_schema_metadata(schema_with_metadata.metadata),
+        root_path=dataset_dir,
+        compression="snappy",
+        use_threads=True,
+        metadata_collector=metadata_collector,
+    )
+    pq.write_metadata(
+        schema=schema_with_metadata,
+        where=f"{dataset_dir}/_metadata",
+        metadata_collector=metadata_collector,
+    )
+    logger.info(f"Summary export complete, {table.num_rows} rows")
+
+
+def main():
+    args = clparser().parse_args()
+    _bottle_export = False
+    _mooring_export = False
+    _ctd_export = False
+    _species_export = False
+    _summary_export = False
+    if args.dataset == "bottle" or args.dataset == "all":
+        _bottle_export = True
+    if args.dataset == "mooring" or args.dataset == "all":
+        _mooring_export = True
+    if args.dataset == "ctd" or args.dataset == "all":
+        _ctd_export = True
+    if args.dataset == "species" or args.dataset == "all":
+        _species_export = True
+    if args.dataset == "summary" or args.dataset == "all":
+        _summary_export = True
+
+    logger.info("Starting export...")
+    logger.info(f"Summary Export : {_summary_export}")
+    logger.info(f"Bottle Export  : {_bottle_export}")
+    logger.info(f"Mooring Export : {_mooring_export}")
+    logger.info(f"CTD Export     : {_ctd_export}")
+    logger.info(f"Species Export : {_species_export}")
+
+    logger.info(f"Fetch method   : {args.fetch}")
+
+    logger.info(f"Incremental    : {args.incremental}")
+
+    logger.info(f"Archive        : {args.archive}{' per dataset' if args.archive_per_dataset else ''}")
+
+    logger.info(f"Events log     : {args.events}")
+    instrument.configure(
+        log_path=args.events, profile=args.profile, profiler=args.profiler, profile_dir=PROFILE_DIR
+    )
+    instrument.event("start", dataset=args.dataset, fetch=args.fetch, workers=args.workers)
+
+    if OUTDIR.exists() and OUTDIR.is_dir() and not args.incremental:
+        shutil.rmtree(OUTDIR)
+    OUTDIR.mkdir(parents=True, exist_ok=True)
+
+    start_time = datetime.now()
+    
+    jobs = []
+    export_args = {
+        "filtered": args.filtered,
+        "fetch": args.fetch,
+        "row_group_size": args.row_group_size,
+        "file_rows": args.file_rows,
+        "workers": args.workers,
+        "incremental": args.incremental,
+    }
+    
+    if _summary_export:
+        jobs.append(("summary", summary_export, {}))
+    if _bottle_export:
+        jobs.append(("bottle", bottle_export, export_args))
+    if _mooring_export:
+        jobs.append(("mooring", mooring_export, export_args))
+    if _ctd_export:
+        jobs.append(("ctd", ctd_export, export_args))
+    if _species_export:
+        jobs.append(("species", species_export, export_args))
+        
+    if jobs:
+        max_workers = min(len(jobs), 4)
+        logger.info(f"Running {len(jobs)} exports jobs with up to {max_workers} concurrent workers...")
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(func, **func_args): name
+                for name, func, func_args in jobs
+            }
+
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    future.result()
+                    logger.info(f"{name} export finished successfully")
+                except Exception as e:
+                    logger.exception(f"{name} export failed: {e}")
+                    raise
+
+    end_time = datetime.now()
+    logger.info(f"Export completed in {(end_time - start_time) / 60}")
+
+    package_output(
+        codec=args.archive, per_dataset=args.archive_per_dataset, workers=args.workers
+    )
+
+    logger.info(f"Stage timings (rows are files for archive):\n{instrument.summary()}")
+    instrument.close()
+
+
+if __name__ == "__main__":
+    try:
+        conn = psycopg2.connect(
+            host=PG_HOST, database=PG_DATABASE, user=PG_USER, password=PG_PASSWORD
+        )
+    except Exception as err:
+        raise err
+
+    try:
+        main()
+    except Exception as err:
+        raise err
+    finally:
+        conn.close()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+# QA flags of measurements as one bitmask, derived in bulk with polars when the data is loaded.
+#
+# The database keeps the flags of a result in the meas_value composite (undetected, estimated,
+# rejected, greater_than). qa_flags packs them into one small integer, a bit per flag. The
+# views and the Parquet export project it with the detected and qualifiers columns of its 16
+# possible values (scripts/sql/qa_flags.sql), instead of working them out per row with nested
+# CASE expressions on every refresh.
+#
+#   lf = lf.with_columns(qa_flags_from_qualifiers(pl.col("qualifier")).alias("qa_flags"))
+#   lf = lf.with_columns(detected(pl.col("qa_flags")), qualifiers(pl.col("qa_flags")))
+#
+# Result text such as "<0.5", ">100" or "1.2 J" is split into its value and qualifier columns with
+# split_result. Everything is vectorized, nothing is evaluated per row in python.
+#
+#   python qa_flags.py   checks QUALIFIER_RULES against QUALIFIER_EXAMPLES
+
+# Third party libraries
+import polars as pl
+
+# Bits of qa_flags, one per flag of the meas_value composite
+UNDETECTED = 1
+ESTIMATED = 2
+REJECTED = 4
+GREATER_THAN = 8
+FLAGS = {
+    "undetected": UNDETECTED,
+    "estimated": ESTIMATED,
+    "rejected": REJECTED,
+    "greater_than": GREATER_THAN,
+}
+QA_FLAGS_TYPE = pl.UInt8
+
+# Qualifier code of every flag, in the order the views concatenate them
+QUALIFIER_CODES = {UNDETECTED: "U", ESTIMATED: "J", REJECTED: "R", GREATER_THAN: ">"}
+
+# qualifiers value of every qa_flags value, null when no flag is set
+QUALIFIERS = {
+    flags: "".join(code for bit, code in QUALIFIER_CODES.items() if flags & bit) or None
+    for flags in range(16)
+}
+
+
+def whole_code(code: str) -> str:
+    """Pattern of a qualifier code that is a whole token of the text
+
+    A token starts at the start of the text, a space, a comma or a < or > sign and ends at the
+    end of the text, a space or a comma, so the U of "UNK" or the E of "EST" is not a code.
+    """
+    return rf"(?:^|[\s,<>])(?:{code})(?:$|[\s,])"
+
+
+# Regular expressions matched against the qualifier text of a provider, by flag. The
+# defaults follow the King County bottle rules (<MDL undetected, J estimated, R but not RDL
+# rejected, E above the instrument's maximum) plus the U, ND, < and > codes of other providers.
+# The letter codes count when they are a token of their own or combined with each other ("UJ").
+QUALIFIER_RULES = {
+    "undetected": "<|" + whole_code("ND|[UJRE]*U[UJRE]*"),
+    "estimated": whole_code("[UJRE]*J[UJRE]*"),
+    "rejected": whole_code("[UJRE]*R[UJRE]*"),
+    "greater_than": ">|" + whole_code("[UJRE]*E[UJRE]*"),
+}
+
+# qa_flags that QUALIFIER_RULES must give for qualifier texts seen in the provider data
+QUALIFIER_EXAMPLES = {
+    "<": UNDETECTED,
+    "<MDL": UNDETECTED,
+    "<RDL": UNDETECTED,
+    "U": UNDETECTED,
+    "ND": UNDETECTED,
+    "J": ESTIMATED,
+    "UJ": UNDETECTED | ESTIMATED,
+    "<J": UNDETECTED | ESTIMATED,
+    "J, R": ESTIMATED | REJECTED,
+    "R": REJECTED,
+    "RDL": 0,
+    "E": GREATER_THAN,
+    ">": GREATER_THAN,
+    "UNK": 0,
+    "EST": 0,
+    "DUP": 0,
+    "": 0,
+}
+
+# A result as text: an optional < or >, the number and optional qualifier codes after it
+RESULT_PATTERN = r"^\s*(?P<sign>[<>])?\s*(?P<value>[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)?\s*(?P<codes>[A-Za-z][A-Za-z ,]*)?\s*$"
+
+
+def qa_flags_from_booleans(
+    undetected: pl.Expr,
+    estimated: pl.Expr,
+    rejected: pl.Expr,
+    greater_than: pl.Expr,
+) -> pl.Expr:
+    """qa_flags of the four flags as boolean columns, a null flag is not set"""
+    flags = [
+        (flag.fill_null(False).cast(QA_FLAGS_TYPE) * bit)
+        for flag, bit in (
+            (undetected, UNDETECTED),
+            (estimated, ESTIMATED),
+            (rejected, REJECTED),
+            (greater_than, GREATER_THAN),
+        )
+    ]
+    return pl.sum_horizontal(flags).cast(QA_FLAGS_TYPE)
+
+
+def qa_flags_from_qualifiers(
+    qualifier: pl.Expr, rules: dict[str, str] | None = None
+) -> pl.Expr:
+    """qa_flags of qualifier text (e.g. "<MDL", "J", "UJ") by the regular expressions of rules
+
+    rules maps flag names to patterns, the flags without a pattern are never set.
+    """
+    rules = QUALIFIER_RULES if rules is None else rules
+    text = qualifier.fill_null("")
+    return qa_flags_from_booleans(
+        *[
+            text.str.contains(rules[name]) if name in rules else pl.lit(False)
+            for name in FLAGS
+        ]
+    )
+
+
+def split_result(
+    frame: pl.LazyFrame | pl.DataFrame,
+    column: str,
+    value: str = "value",
+    qualifier: str = "qualifier",
+) -> pl.LazyFrame | pl.DataFrame:
+    """frame with the value (Float64) and qualifier text of the results written as text in column
+
+    "<0.5" is 0.5 with the qualifier "<", "1.2 J" is 1.2 with "J" and "ND" has no value and
+    the qualifier "ND". A plain number has a null qualifier, text that does not fit the
+    pattern (e.g. "1,2") is null in both. The pattern is matched once into a temporary
+    struct column, every field read straight from the match would match it again.
+    """
+    parts = f"{column}_parts"
+    text = pl.concat_str(
+        pl.col(parts).struct.field("sign").fill_null(""),
+        pl.col(parts).struct.field("codes").str.strip_chars().fill_null(""),
+    )
+    return (
+        frame.with_columns(
+            pl.col(column).str.extract_groups(RESULT_PATTERN).alias(parts)
+        )
+        .with_columns(
+            pl.col(parts)
+            .struct.field("value")
+            .cast(pl.Float64, strict=False)
+            .alias(value),
+            text.alias(qualifier),
+        )
+        .with_columns(
+            pl.when(pl.col(qualifier) != "").then(pl.col(qualifier)).alias(qualifier)
+        )
+        .drop(parts)
+    )
+
+
+def check_rules(rules: dict[str, str] | None = None) -> dict[str, tuple[int, int]]:
+    """QUALIFIER_EXAMPLES that rules (QUALIFIER_RULES by default) get wrong, as (expected, actual)"""
+    df = pl.DataFrame(
+        {
+            "qualifier": list(QUALIFIER_EXAMPLES),
+            "expected": list(QUALIFIER_EXAMPLES.values()),
+        }
+    ).with_columns(qa_flags_from_qualifiers(pl.col("qualifier"), rules).alias("actual"))
+    return {
+        row["qualifier"]: (row["expected"], row["actual"])
+        for row in df.filter(pl.col("expected") != pl.col("actual")).iter_rows(
+            named=True
+        )
+    }
+
+
+def detected(qa_flags: pl.Expr) -> pl.Expr:
+    """detected of qa_flags, every result not flagged undetected"""
+    return ((qa_flags & UNDETECTED) == 0).alias("detected")
+
+
+def qualifiers(qa_flags: pl.Expr) -> pl.Expr:
+    """qualifiers of qa_flags, the codes of its flags (e.g. "UJ"), null when none is set"""
+    return qa_flags.replace_strict(
+        list(QUALIFIERS), list(QUALIFIERS.values()), return_dtype=pl.String
+    ).alias("qualifiers")
+
+
+if __name__ == "__main__":
+    mismatches = check_rules()
+    for qualifier, (expected, actual) in mismatches.items():
+        print(f"{qualifier!r}: qa_flags {actual}, expected {expected}")
+    if mismatches:
+        raise SystemExit(1)
+    print(f"QUALIFIER_RULES match all {len(QUALIFIER_EXAMPLES)} QUALIFIER_EXAMPLES")
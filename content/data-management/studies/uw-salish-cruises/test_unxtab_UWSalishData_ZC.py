@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# test_unxtab_UWSalishData_ZC.py
+#
+# PURPOSE
+#   Compatibility tests of the native un-xtab engine (unxtab_frame) against untabbed csvs of un-xtab.py checked in to
+#   unxtab_expected/. Synthetic upcast/downcast files of all three templates are made with scripts/benchmarks/synthetic.py,
+#   un-xtabbed with --engine native and compared byte for byte with the expected files:
+#       - section1 (header_as_column_1..3, the units and ctd_status rows) and section2_downcast (header_as_column_1..2)
+#       - section2_upcast, the flag/comment row headers at offsets from the pressure column
+#       - a section1 and a section2_upcast file with an extra leading column, so pressure, depth and the offset row headers
+#         are resolved one column further (these are also added to the files to check)
+#
+#   python -m pytest content/data-management/studies/uw-salish-cruises
+#
+# NOTES
+#   1. The expected files are written by running this file. It un-xtabs the same synthetic files with --engine subprocess
+#       (the un-xtab.py cmd line script) and copies its output to unxtab_expected/:
+#       - python test_unxtab_UWSalishData_ZC.py
+#   2. Where un-xtab.py is not installed --reference writes them with reference_unxtab below instead, a plain csv module
+#       reading of the same _m.csv and _m.cfg files. The checked in files were written that way, regenerate them with
+#       un-xtab.py and review the diff before relying on them for --engine native.
+#   3. source_path is the absolute path of the file, the temporary directory is removed from it in the compared output.
+# ==========================================================================
+
+import argparse
+import configparser
+import csv
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+import unxtab_UWSalishData_ZC as unxtab
+
+# synthetic.py has the generators of the benchmark inputs
+sys.path.insert(0, str(Path(__file__).resolve().parents[4] / 'scripts' / 'benchmarks'))
+from synthetic import write_salish_csv
+
+EXPECTED_DIR = Path(__file__).resolve().parent / 'unxtab_expected'
+
+# file name: (template, data rows, extra leading column), the cast type and section 2 template come from the file name
+CASES = {
+    'ss1998_downcast.csv': ('section1', 12, False),
+    'ss1999_upcast.csv': ('section1', 12, True),
+    'ss2016_downcast.csv': ('section2_downcast', 12, False),
+    'ss2016_upcast.csv': ('section2_upcast', 4, False),
+    'ss2017_upcast.csv': ('section2_upcast', 4, True),
+}
+
+
+def write_case(directory, name):
+    """Write the synthetic file of a case, returns its path"""
+    template, rows, extra_column = CASES[name]
+    path = directory / name
+    write_salish_csv(path, template, rows, seed=len(name))
+    if extra_column:
+        lines = path.read_text().splitlines()
+        lines = ['Ship,' + lines[0]] + ['RV1,' + line for line in lines[1:]]
+        path.write_text('\n'.join(lines) + '\n')
+    return path
+
+
+def unxtab_case(directory, name, engine):
+    """Un-xtab the synthetic file of a case, returns the result and the untabbed csv without the directory in source_path"""
+    file = write_case(directory, name)
+    section = unxtab.unxtab_section1_file if CASES[name][0] == 'section1' else unxtab.unxtab_section2_file
+    result = section(file, engine=engine)
+    output = result['output_path']
+    if not output.exists():
+        return result, None
+    return result, output.read_bytes().replace((str(directory.resolve()) + os.sep).encode(), b'')
+
+
+def reference_unxtab(m_csv, m_cfg, untabbed):
+    """un-xtab a _m.csv with its _m.cfg row by row with the csv module, for when un-xtab.py is not installed
+
+    Row r and column c of the cfg are 1 based and the header is row 1. Every data column group of every data row is
+    one output row: the row headers, the header_as_column_N values and the column_header_label_N values.
+    """
+    parser = configparser.ConfigParser(interpolation=None)
+    parser.optionxform = str
+    parser.read(m_cfg)
+    cfg = parser[parser.sections()[0]]
+
+    def numbers(value):
+        result = []
+        for part in value.split(','):
+            start, _, end = part.strip().partition('-')
+            result.extend(range(int(start), int(end or start) + 1))
+        return result
+
+    with open(m_csv, newline='') as f:
+        rows = list(csv.reader(f))
+    row_headers = numbers(cfg['row_headers'])
+    group_count = int(cfg.get('column_group_count', '1'))
+    labels = [cfg[f'column_header_label_{i}'] for i in range(1, group_count + 1)]
+    header_as_columns = []
+    i = 1
+    while f'header_as_column_{i}' in cfg:
+        row, col_in_group, name = [v.strip() for v in cfg[f'header_as_column_{i}'].split(',')]
+        header_as_columns.append((int(row), int(col_in_group), name))
+        i += 1
+    data_cols = numbers(cfg['data_columns'])
+    header_row = rows[int(cfg.get('row_headers_row', '1')) - 1]
+
+    with open(untabbed, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow([header_row[c - 1] for c in row_headers] + [name for _, _, name in header_as_columns] + labels)
+        for r in numbers(cfg['data_rows']):
+            for g in range(0, len(data_cols), group_count):
+                group = data_cols[g:g + group_count]
+                writer.writerow(
+                    [rows[r - 1][c - 1] for c in row_headers]
+                    + [rows[row - 1][group[col - 1] - 1] for row, col, _ in header_as_columns]
+                    + [rows[r - 1][c - 1] for c in group]
+                )
+
+
+@pytest.mark.parametrize('name', CASES)
+def test_native_matches_unxtab(tmp_path, name):
+    result, output = unxtab_case(tmp_path, name, engine='native')
+    assert result['returncode'] == 0, result['stderr']
+    assert output == (EXPECTED_DIR / f'untabbed_{Path(name).stem}_m.csv').read_bytes()
+
+
+@pytest.mark.parametrize('name', CASES)
+def test_moved_pressure_column_is_checked(tmp_path, name):
+    result, _ = unxtab_case(tmp_path, name, engine='native')
+    assert result['files_to_check'] == ([name] if CASES[name][2] else [])
+
+
+def clparser():
+    parser = argparse.ArgumentParser(description='Write the expected untabbed csvs of the un-xtab compatibility tests')
+    parser.add_argument(
+        '--reference',
+        action='store_true',
+        help='write them with reference_unxtab when un-xtab.py fails (e.g. it is not installed)',
+    )
+    return parser
+
+
+def main():
+    args = clparser().parse_args()
+    EXPECTED_DIR.mkdir(exist_ok=True)
+    for name in CASES:
+        with tempfile.TemporaryDirectory() as directory:
+            directory = Path(directory)
+            result, output = unxtab_case(directory, name, engine='subprocess')
+            if result['returncode'] != 0:
+                if not args.reference:
+                    sys.exit(f'un-xtab.py failed on {name}: {result["stderr"]}')
+                m_csv = directory / f'{Path(name).stem}_m.csv'
+                reference_unxtab(m_csv, m_csv.with_suffix('.cfg'), result['output_path'])
+                output = result['output_path'].read_bytes().replace((str(directory.resolve()) + os.sep).encode(), b'')
+            (EXPECTED_DIR / result['output_path'].name).write_bytes(output)
+            print('wrote', EXPECTED_DIR / result['output_path'].name)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,7 +3,7 @@
 # unxtab_salish_cfg_file_generation.ipynb
 #
 # PURPOSE
-#   Loop through the "Salish_Cruises" directory to read in all UW salish ctd/bottle data and create a .cfg file for each file.  
+#   Loop through the "Salish_Cruises" directory to read in all UW salish ctd/bottle data and create a .cfg file for each file.
 #   Also will execute the un-xtab.py cmd line script to successfully flip all original data into long useable format
 #
 # PROJECT
@@ -14,11 +14,51 @@
 #   2. There are two sections built into this script to handle the different groupings of source data.  SECTION 1 handles all the older data,
 #       The original csv files from 1998 to 2015 both upcase and downcast files are the same format.  SECTION 2 handles all the newer data,
 #       The original xlsx files from 2016 to 2023. But processes upcast and downcast differently due to the data templates being different.
-#   3. This script creates multiple intermediary files in order to get to the unxtabbed final result as long as the source data is a csv 
-#       it will process file for the old data in section 1, in section 2 it converts the <filename.xlsx> to <filename.csv> then:
+#   3. This script creates multiple intermediary files in order to get to the unxtabbed final result as long as the source data is a csv
+#       it will process file for the old data in section 1, in section 2 it reads the <filename.xlsx> directly (no <filename.csv>) then:
 #       - first it creates the <filename>_m.csv version of the file to add the metadata like the source file etc.
 #       - next it creates the <filename_m>.cfg
 #       - and finally it will create a untabbed_<filename_m>.csv that will be what we use to join the data in the sql loading script
+#   4. Every upcast/downcast file is handled independently, so SECTION 1 and SECTION 2 files are all submitted to one pool of
+#       worker processes. Use --workers to set the pool size (default 1 runs the files one at a time like the original script):
+#       - python unxtab_UWSalishData_ZC.py --workers 8
+#   5. The un-xtab step can run in process (--engine native): the metadata version of the file is melted straight from
+#       memory into untabbed_<filename_m>.csv using the same .cfg settings (with the \r\n line endings of un-xtab.py's
+#       csv.writer), so the <filename>_m.csv is not written. --engine verify runs both and adds any file whose outputs are not
+#       byte for byte identical to the files to check. The default stays --engine subprocess, the original un-xtab.py cmd
+#       line script, until a verify run over every Salish file matches.
+#   6. Runs are incremental. A sqlite manifest (unxtab_manifest.sqlite in the Salish_Cruises directory, see --manifest) records the
+#       sha256 hash, mtime, cfg settings and output path of every upcast/downcast file that was un-xtabbed successfully. On later
+#       runs only new or changed files are un-xtabbed and reported. Use --force to rebuild everything.
+#   7. SECTION 2 reads the 2016+ *upcast.xlsx/*downcast.xlsx workbooks directly with a read only (row streaming) openpyxl sheet
+#       reader that writes polars batches to a temporary <filename>_xlsx.arrow ipc file, which is scanned lazily like the csvs
+#       and removed once the file is un-xtabbed. The Xlsx2csv conversion to an intermediate csv is no longer needed. Folders that
+#       only have the converted csv (no workbook) are still read from the csv.
+#   8. The metadata columns (source_path, source_filename, cast_type) are added as literal columns to a lazy scan of the file, the
+#       strip, "None" station filter and un-xtab all stay lazy and are streamed to the untabbed csv with sink_csv, so a file is never
+#       fully held in memory. scripts/benchmarks/salish_prepare.py compares this against the original eager read_csv version.
+#   9. The cfg columns are no longer hardcoded (11, 14, 17 and the upcast 21,22,...,64 row headers). Each file's header is
+#       fingerprinted and resolved against the TEMPLATES registry by column name (pressure, depth and the upcast flag/comment
+#       columns), resolved layouts are cached in the templates table of the manifest. Files whose header does not fit their
+#       template are rejected before they are read or un-xtabbed and listed at the end of the run with the files to check.
+#   10. --output parquet writes every file's un-xtab result into one hive partitioned parquet dataset instead of the untabbed csvs:
+#       - <directory>/untabbed_parquet/year=YYYY/cast_type=<upcast|downcast>/<filename>.parquet (see --parquet-dir)
+#       - every file has the columns of PARQUET_SCHEMA in that order: the row headers named in the template's columns (cruise,
+#         station, cast_no, date, time, latitude, longitude) and its pressure and depth columns under one name, the other row
+#         headers (e.g. Bottle, Instrument or the upcast flags) as json text in other_row_headers, missing columns as typed nulls
+#       - result_value is a float (text values are kept in result_text), units and ctd_status are null when the template has none
+#       - qa_flags is the U/J/R/> bitmask of the qualifiers in result_text ("<0.5" undetected, "1.2 J" estimated), computed once
+#         here with qa_flags.py instead of per row in the database views. detected and qualifiers follow from it
+#       - read it back in one go with pl.scan_parquet('untabbed_parquet/**/*.parquet', hive_partitioning=True), collected in a
+#         pl.StringCache() for the categoricals of the different files. The run ends by scanning it like that and lists any file
+#         without PARQUET_SCHEMA (parts written by older runs are rewritten like changed files)
+#   11. Every file is timed per stage (header, read, cfg_write, unxtab, see STAGES) with instrumentation.py from content/data-management.
+#       Each stage call is appended with its seconds, rows and bytes to a json lines events log (<directory>/unxtab_events.jsonl, see
+#       --events) shared by the worker processes, and a table of the totals per stage is printed at the end of the run. The console
+#       shows one line per file, the un-xtab stdout/stderr only when it failed. --profile <stage> profiles stages with cProfile
+#       (or --profiler py-spy) into <directory>/unxtab_profile.
+#   12. test_unxtab_UWSalishData_ZC.py compares --engine native with untabbed csvs of un-xtab.py in unxtab_expected/ for
+#       synthetic files of every template (python -m pytest in this folder, see its NOTES to write the expected files again).
 #
 # AUTHOR(S)
 #   Zach Casler (ZC)
@@ -28,18 +68,44 @@
 # ---------- -------------------------------------------------------------
 # 2024-06-27 script completed everything ran successfully on ZC's personal computer
 # 2024-08-10 script converted to run off of server paths and ran successfully
+# 2026-10-17 per file processing moved into functions so SECTION 1 and SECTION 2 can run in a process pool (--workers)
+# 2026-10-17 added the in process un-xtab engine (--engine native) to replace the per file un-xtab.py subprocess
+# 2026-10-17 added the sqlite manifest so only new or changed files are reprocessed (--force to rebuild everything)
+# 2026-10-17 SECTION 2 reads the xlsx workbooks directly instead of converting them to csv first
+# 2026-10-17 metadata, strip and filter steps moved to a lazy scan_csv pipeline streamed with sink_csv
+# 2026-10-17 cfg columns resolved by name from a fingerprinted template registry, unknown headers rejected up front
+# 2026-10-17 added --output parquet, one year/cast_type partitioned parquet dataset with typed result columns
+# 2026-10-17 per file prints replaced by stage timings in a json lines events log and an end of run summary table
+# 2026-10-17 parquet output gets the qa_flags bitmask and the numbers of qualified text results
+# 2026-10-17 --engine subprocess is the default again until --engine verify matches on every file, native writes \r\n lines
+# 2026-10-17 xlsx batches streamed to a temporary arrow ipc file instead of being held in memory, headers read with data_only
+# 2026-10-17 every parquet file projected onto one fixed PARQUET_SCHEMA so the dataset scans without allow_missing_columns
+# 2026-10-17 added the un-xtab compatibility tests of the native engine for all three templates
 # ==========================================================================
 
 
 #generate un-tab.py cfg files for all uw salish data
 #import pandas as pd
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+from datetime import date, datetime, time
 import polars as pl
+import pyarrow as pa
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 import subprocess
 #import re
-from xlsx2csv import Xlsx2csv
+from openpyxl import load_workbook
 import sys
 
+# instrumentation.py and qa_flags.py are shared with parquet_export.py in content/data-management
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+from instrumentation import PROFILERS, Instrumentation
+from qa_flags import QA_FLAGS_TYPE, qa_flags_from_qualifiers, split_result
+
 pl.Config.set_fmt_str_lengths(45)
 
 
@@ -53,10 +119,663 @@ def cmd_format_path(path_obj):
 #set salish data path directory
 directory = Path('../../../../Data_Inventory/_University_of_Washington/Salish_Cruises')
 
+# timed stages of every file, appended to the events log with their rows and bytes (see --events and instrumentation.py)
+#   header     reading the header and matching it to its template
+#   read       reading, stripping and filtering the rows to count them (lazy for csvs, the same plan runs again in unxtab)
+#   cfg_write  the un-xtab cfg settings and file
+#   unxtab     un-xtab into the untabbed csv or the parquet dataset
+STAGES = ['header', 'read', 'cfg_write', 'unxtab']
+instrument = Instrumentation('unxtab_salish')
+
+
+def cruise_year(folder):
+    """Year of a cruise "Data" folder, e.g. Salish-2016_Data -> 2016"""
+    folder_parts = folder.name.split('-')
+    return int(folder_parts[1].split('_')[0])
+
+
+def get_cruise_folders(directory, min_year=None, max_year=None):
+    """Return the cruise "Data" folders whose year is within min_year and max_year (inclusive)"""
+    # Get a list of directories in the specified directory
+    folders = [f for f in directory.iterdir() if f.is_dir() and f.name.endswith("Data")]
+
+    filtered_folders = []
+    for folder in folders:
+        year = cruise_year(folder)
+        # Debug: Print each folder and the extracted year
+        # print(f"Folder: {folder.name}, Extracted Year: {year}")
+        if min_year is not None and year < min_year:
+            continue
+        if max_year is not None and year > max_year:
+            continue
+        filtered_folders.append(folder)
+    return filtered_folders
+
+
+def write_cfg(curr_cfg_filepath, section, cfg):
+    """Write the un-xtab cfg file, one key=value line per cfg setting"""
+    with open(curr_cfg_filepath, 'w') as cfg_file:
+        cfg_file.write(f"[{section}]\n")
+        for key, value in cfg.items():
+            cfg_file.write(f"{key}={value}\n")
+
+
+def parse_cfg_numbers(value):
+    """Turn a cfg row/column spec like '1-12,21,22' into a list of 1 based numbers"""
+    numbers = []
+    for part in str(value).split(','):
+        part = part.strip()
+        if '-' in part:
+            start, end = part.split('-')
+            numbers.extend(range(int(start), int(end) + 1))
+        elif part:
+            numbers.append(int(part))
+    return numbers
+
+
+def unxtab_frame(curr_df, cfg):
+    """Native polars version of un-xtab.py, melts curr_df into long format using the cfg settings
+
+    Rows and columns in the cfg are 1 based and count the header as row 1 like un-xtab.py does
+    (so row r of the file is curr_df row r - 2). Output columns are the row headers, then each
+    header_as_column_N, then the column_header_label_N values, ordered by data row then data column.
+
+    curr_df can be a DataFrame or a LazyFrame, a LazyFrame is returned so the result can be streamed
+    to disk with sink_csv. Only the column header rows are collected to look up the header values.
+    """
+    lf = curr_df.lazy().with_columns(pl.all().cast(pl.String))
+    columns = lf.collect_schema().names()
+
+    data_cols = parse_cfg_numbers(cfg['data_columns'])
+    data_rows = parse_cfg_numbers(cfg['data_rows'])
+    row_headers = parse_cfg_numbers(cfg['row_headers'])
+    row_headers_row = int(cfg.get('row_headers_row', 1))
+    group_count = int(cfg.get('column_group_count', 1))
+    labels = [cfg[f'column_header_label_{i}'] for i in range(1, group_count + 1)]
+    header_as_columns = []
+    i = 1
+    while f'header_as_column_{i}' in cfg:
+        row, col_in_group, name = [v.strip() for v in cfg[f'header_as_column_{i}'].split(',')]
+        header_as_columns.append((int(row), int(col_in_group), name))
+        i += 1
+
+    # row 1 is the csv header, every other header row is one of the first rows of the frame
+    last_header_row = max([row_headers_row] + [row for row, _, _ in header_as_columns])
+    header_df = lf.head(last_header_row - 1).collect() if last_header_row > 1 else None
+
+    def header_value(row, col):
+        return columns[col - 1] if row == 1 else header_df.item(row - 2, col - 1)
+
+    # data columns are handled in groups of column_group_count adjacent columns
+    groups = [data_cols[g:g + group_count] for g in range(0, len(data_cols), group_count)]
+    row_header_names = [header_value(row_headers_row, col) for col in row_headers]
+
+    # one struct per column group with its header values and data values, exploding the list of
+    # structs gives every group of a data row in order without having to sort the long result.
+    # positional aliases so row headers can also be data columns
+    long_values = pl.concat_list(
+        [
+            pl.struct(
+                *[
+                    pl.lit(header_value(row, group[col_in_group - 1]), dtype=pl.String).alias(name)
+                    for row, col_in_group, name in header_as_columns
+                ],
+                *[pl.col(columns[col - 1]).alias(label) for label, col in zip(labels, group)],
+            )
+            for group in groups
+        ]
+    ).alias('__long')
+
+    if data_rows == list(range(data_rows[0], data_rows[-1] + 1)):
+        lf = lf.slice(data_rows[0] - 2, len(data_rows))
+    else:
+        lf = lf.with_row_index('__row').filter(pl.col('__row').is_in([r - 2 for r in data_rows]))
+
+    return (
+        lf.select(
+            *[pl.col(columns[col - 1]).alias(f'__rh{i}') for i, col in enumerate(row_headers)],
+            long_values,
+        )
+        .explode('__long')
+        .unnest('__long')
+        .select(
+            *[pl.col(f'__rh{i}').alias(name) for i, name in enumerate(row_header_names)],
+            *[pl.col(name) for _, _, name in header_as_columns],
+            *[pl.col(label) for label in labels],
+        )
+    )
+
+
+def run_unxtab(curr_df, cfg, curr_file_new_name, curr_cfg_filepath, engine='subprocess'):
+    """Un-xtab the metadata version of a file into untabbed_<filename_m>.csv
+
+    engine='native' melts curr_df in process with unxtab_frame, engine='subprocess' writes the _m.csv
+    and runs un-xtab.py on it. Returns a dict with the returncode, stdout and stderr of the run.
+    """
+    untabbed_filepath = curr_file_new_name.parent / ('untabbed_' + curr_file_new_name.name)
+
+    if engine == 'native':
+        try:
+            sink_csv(unxtab_frame(curr_df, cfg), untabbed_filepath, line_terminator=UNXTAB_LINE_TERMINATOR)
+        except Exception as e:
+            return {'returncode': 1, 'stdout': '', 'stderr': repr(e), 'output_path': untabbed_filepath}
+        return {'returncode': 0, 'stdout': f'wrote {untabbed_filepath.name}', 'stderr': '', 'output_path': untabbed_filepath}
+
+    # EXPORT INTO NEW CSV SO WE CAN RUN UNXTAB ON THIS VERSION OF FILE W Orig filepath
+    # and file name and cast type NEW FILE = same name + "_m" for metadata
+    sink_csv(curr_df.lazy(), curr_file_new_name)
+
+    #init cmd line run for current file
+    cmd = ['~/houston-dc-jobs/data-management/bin/un-xtab.py','-c']
+
+    # # building cmd line to pass into subprocess
+    cmd.append(f"'{curr_cfg_filepath.as_posix()}'")
+    cmd.append(f"'{curr_file_new_name.as_posix()}'")
+    cmd.append(f"'{untabbed_filepath.as_posix()}'")
+    cmd = [' '.join(cmd)]
+    instrument.event('unxtab_cmd', file=curr_file_new_name.name, cmd=cmd[0])
+
+    # output is captured so that files running in parallel workers do not interleave on the console
+    unxtab_run = subprocess.run(cmd, shell=True, capture_output=True, text=True)
+    return {
+        'returncode': unxtab_run.returncode,
+        'stdout': unxtab_run.stdout,
+        'stderr': unxtab_run.stderr,
+        'output_path': untabbed_filepath,
+    }
+
+
+def verify_unxtab(curr_df, cfg, curr_file_new_name, curr_cfg_filepath):
+    """Run both engines and check the native output is byte for byte the same as un-xtab.py's"""
+    untabbed_filepath = curr_file_new_name.parent / ('untabbed_' + curr_file_new_name.name)
+    result = run_unxtab(curr_df, cfg, curr_file_new_name, curr_cfg_filepath, engine='subprocess')
+    if result['returncode'] != 0:
+        return result
+    expected = untabbed_filepath.read_bytes()
+    native = run_unxtab(curr_df, cfg, curr_file_new_name, curr_cfg_filepath, engine='native')
+    if native['returncode'] != 0:
+        return native
+    native['matches_unxtab'] = untabbed_filepath.read_bytes() == expected
+    return native
+
+
+# Columns of every file of the parquet dataset, in this order (year and cast_type are the partition folders)
+PARQUET_SCHEMA = {
+    'source_path': pl.String,
+    'source_filename': pl.String,
+    'cruise': pl.String,
+    'station': pl.String,
+    'cast_no': pl.String,
+    'date': pl.String,
+    'time': pl.String,
+    'latitude': pl.String,
+    'longitude': pl.String,
+    'pressure': pl.String,
+    'depth': pl.String,
+    'other_row_headers': pl.String,
+    'col_name': pl.String,
+    'units': pl.Categorical,
+    'ctd_status': pl.Categorical,
+    'result_value': pl.Float64,
+    'result_text': pl.String,
+    'qa_flags': QA_FLAGS_TYPE,
+}
+
+
+def parquet_part_path(parquet_dir, file):
+    """File of the hive partitioned dataset for one source file: <parquet_dir>/year=YYYY/cast_type=<cast>/<stem>.parquet"""
+    return parquet_dir / f'year={cruise_year(file.parent)}' / f'cast_type={cast_type_of(file)}' / f'{file.stem}.parquet'
+
+
+def write_parquet_part(long_lf, parquet_path, layout):
+    """Write one file's un-xtab output to the parquet dataset with typed result columns
+
+    result_value is a float (values that are not numbers are kept as text in result_text, the number of
+    text such as "<0.5" or "1.2 J" is still the result_value), qa_flags is the bitmask of the qualifiers
+    of result_text (see qa_flags.py), units and ctd_status are categoricals and null filled for
+    templates that do not have them. cast_type is left out of the file because it is a partition column
+    (in the path) like year. The row headers are renamed by the columns of the layout's template and
+    every file gets exactly the columns of PARQUET_SCHEMA, so the files of all templates scan as one.
+    """
+    parquet_path.parent.mkdir(parents=True, exist_ok=True)
+    names = long_lf.collect_schema().names()
+    renames = {**TEMPLATES[layout['template']]['columns'], layout['pressure']: 'pressure', layout['depth']: 'depth'}
+    renames = {col: name for col, name in renames.items() if col in names}
+    other_row_headers = [
+        col for col in names
+        if col not in renames and col not in PARQUET_SCHEMA and col != 'cast_type'
+    ]
+    value = pl.col('result_value').str.strip_chars()
+    number = value.cast(pl.Float64, strict=False)
+    long_lf = long_lf.with_columns(
+        number.alias('result_value'),
+        pl.when(number.is_null() & (value != '')).then(value).alias('result_text'),
+        *[
+            (pl.col(col) if col in names else pl.lit(None, pl.String)).cast(pl.Categorical).alias(col)
+            for col in ('units', 'ctd_status')
+        ],
+    ).drop('cast_type')
+    # only the text results are matched against the result pattern, numbers have a null result_text
+    long_lf = split_result(long_lf, 'result_text', value='text_value', qualifier='text_qualifier')
+    long_lf = long_lf.with_columns(
+        pl.col('result_value').fill_null(pl.col('text_value')),
+        qa_flags_from_qualifiers(pl.col('text_qualifier')).alias('qa_flags'),
+    ).drop('text_value', 'text_qualifier')
+    long_lf = long_lf.rename(renames).with_columns(
+        (pl.struct(other_row_headers).struct.json_encode() if other_row_headers else pl.lit(None)).alias('other_row_headers')
+    )
+    present = long_lf.collect_schema().names()
+    long_lf = long_lf.select([
+        (pl.col(col) if col in present else pl.lit(None)).cast(dtype).alias(col) for col, dtype in PARQUET_SCHEMA.items()
+    ])
+    sink_parquet(long_lf, parquet_path)
+
+
+def parquet_part_is_current(parquet_path):
+    """True if a file of the parquet dataset exists and has exactly the columns of PARQUET_SCHEMA, in that order"""
+    try:
+        return list(pl.read_parquet_schema(parquet_path).items()) == list(PARQUET_SCHEMA.items())
+    except (FileNotFoundError, pl.exceptions.ComputeError):
+        return False
+
+
+def check_parquet_dataset(parquet_dir):
+    """Read the whole parquet dataset back in one scan, returns (rows, files without PARQUET_SCHEMA)
+
+    The files are checked first by their footers, a scan over files with different columns fails.
+    """
+    files = sorted(parquet_dir.glob('**/*.parquet'))
+    mismatched = [file for file in files if not parquet_part_is_current(file)]
+    if not files or mismatched:
+        return 0, mismatched
+    rows = pl.scan_parquet(parquet_dir / '**' / '*.parquet', hive_partitioning=True).select(pl.len()).collect().item()
+    return rows, mismatched
+
+
+def unxtab_file(curr_df, cfg, curr_file_new_name, curr_cfg_filepath, engine, parquet_path=None, layout=None):
+    """Un-xtab one file with the chosen engine, with parquet_path the result is written to the parquet dataset
+
+    layout is the file's resolved template layout (see resolve_layout), it names the parquet columns.
+
+    The native engine writes the parquet file straight from memory, the subprocess and verify engines
+    convert the untabbed csv written by un-xtab.py.
+    """
+    if parquet_path is not None and engine == 'native':
+        try:
+            write_parquet_part(unxtab_frame(curr_df, cfg), parquet_path, layout)
+        except Exception as e:
+            return {'returncode': 1, 'stdout': '', 'stderr': repr(e), 'output_path': parquet_path}
+        return {'returncode': 0, 'stdout': f'wrote {parquet_path.name}', 'stderr': '', 'output_path': parquet_path}
+
+    if engine == 'verify':
+        result = verify_unxtab(curr_df, cfg, curr_file_new_name, curr_cfg_filepath)
+    else:
+        result = run_unxtab(curr_df, cfg, curr_file_new_name, curr_cfg_filepath, engine=engine)
+    if parquet_path is not None and result['returncode'] == 0:
+        write_parquet_part(pl.scan_csv(result['output_path'], infer_schema_length=0), parquet_path, layout)
+        result['output_path'] = parquet_path
+    return result
+
+def open_manifest(manifest_path):
+    """Open (and create if needed) the sqlite manifest of processed source files"""
+    conn = sqlite3.connect(manifest_path)
+    conn.execute(
+        """
+        create table if not exists files (
+            source_path text primary key,
+            source_hash text not null,
+            source_mtime real not null,
+            source_size integer not null,
+            cfg text,
+            output_path text,
+            returncode integer,
+            processed_at text
+        )
+        """
+    )
+    conn.execute(
+        """
+        create table if not exists templates (
+            fingerprint text not null,
+            template text not null,
+            template_hash text not null,
+            columns text not null,
+            layout text not null,
+            first_seen text,
+            primary key (fingerprint, template)
+        )
+        """
+    )
+    return conn
+
+
+def file_hash(file):
+    """sha256 of the file contents, read in chunks"""
+    sha = hashlib.sha256()
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def manifest_is_current(conn, file, force=False, output='csv'):
+    """True if the file was already processed successfully to the output format and has not changed since
+
+    mtime and size are checked first so unchanged files are not re-hashed, a touched file
+    with the same hash is still current (the stored mtime is refreshed).
+    """
+    if force:
+        return False
+    file = file.resolve()
+    row = conn.execute(
+        'select source_hash, source_mtime, source_size, output_path, returncode from files where source_path = ?',
+        (str(file),),
+    ).fetchone()
+    if row is None:
+        return False
+    source_hash, source_mtime, source_size, output_path, returncode = row
+    if returncode != 0 or (output_path and not Path(output_path).exists()):
+        return False
+    if output_path and Path(output_path).suffix != f'.{output}':
+        return False
+    if output == 'parquet' and output_path and not parquet_part_is_current(Path(output_path)):
+        # written before the dataset had its current PARQUET_SCHEMA
+        return False
+    stat = file.stat()
+    if stat.st_mtime == source_mtime and stat.st_size == source_size:
+        return True
+    if file_hash(file) != source_hash:
+        return False
+    with conn:
+        conn.execute('update files set source_mtime = ? where source_path = ?', (stat.st_mtime, str(file)))
+    return True
+
+
+def update_manifest(conn, file, cfg=None, output_path=None, returncode=0):
+    """Record the current hash/mtime of a processed source file with its cfg settings and output path"""
+    file = file.resolve()
+    stat = file.stat()
+    with conn:
+        conn.execute(
+            'insert or replace into files values (?, ?, ?, ?, ?, ?, ?, ?)',
+            (
+                str(file),
+                file_hash(file),
+                stat.st_mtime,
+                stat.st_size,
+                json.dumps(cfg) if cfg is not None else None,
+                str(output_path) if output_path is not None else None,
+                returncode,
+                datetime.now().isoformat(),
+            ),
+        )
+
+#### TEMPLATE REGISTRY ####
+# Every upcast/downcast file follows one of the templates below. The header of each file is fingerprinted (sha1 of the column
+# names) and resolved against its template BY COLUMN NAME: the data columns start at the pressure column, depth has to be the
+# column right after it, and the upcast flag/comment row headers are offsets from pressure. Resolved layouts are cached in the
+# templates table of the manifest so a known header is not resolved again. A file whose header does not fit its template is
+# rejected from the header alone, before the file is read or un-xtabbed, and added to the files to check. A file that fits
+# with pressure somewhere else than pressure_column (where the original scripts expected it) is un-xtabbed but also checked.
+METADATA_COLUMNS = ['source_path', 'source_filename', 'cast_type']
+
+TEMPLATES = {
+    # SECTION 1: all pre 2016 csvs (up and downcasts are in same data structure)
+    'section1': {
+        'pressure': ['Pressure'],
+        'pressure_column': 11,
+        # row headers with a column of their own in the parquet dataset (see PARQUET_SCHEMA)
+        'columns': {'Cruise': 'cruise', 'Station': 'station', 'Date': 'date', 'Time': 'time', 'Lat': 'latitude', 'Lon': 'longitude'},
+        'extra_row_headers': [],
+        'data_rows_start': 4, #SET MANUALLY
+        'cfg': {
+            'row_headers_row': '1',
+            'column_header_rows': '1-3', # known that there are only 3 SET MANUALLY
+            'column_group_count': '1',
+            'column_header_label_1': 'result_value',
+            'header_as_column_1': '1,1,col_name',
+            'header_as_column_2': '2,1,units',
+            'header_as_column_3': '3,1,ctd_status',
+        },
+    },
+    # SECTION 2: post 2015 DOWNCAST data ONLY
+    'section2_downcast': {
+        'pressure': ['prDM: Pressure  Digiquartz', 'prdM: Pressure  Strain Gauge'], # some files named it pressure strain gauge...
+        'pressure_column': 14,
+        'columns': {
+            'Cruise': 'cruise', 'Station': 'station', 'cast_no': 'cast_no', 'Date': 'date', 'Time': 'time',
+            'Latitude': 'latitude', 'Longitude': 'longitude',
+        },
+        'extra_row_headers': [],
+        'data_rows_start': 3, #SET MANUALLY
+        'cfg': {
+            'row_headers_row': '1',
+            'column_header_rows': '1-2', # known that there are only 2 SET MANUALLY
+            'column_group_count': '1',
+            'column_header_label_1': 'result_value',
+            'header_as_column_1': '1,1,col_name',
+            'header_as_column_2': '2,1,units',
+        },
+    },
+    # SECTION 2: post 2015 UPCAST data ONLY
+    'section2_upcast': {
+        'pressure': ['CTDPRS_DBAR'],
+        'pressure_column': 17,
+        'columns': {
+            'EXPOCODE': 'cruise', 'STATION_NO': 'station', 'CASTNO': 'cast_no', 'DATE': 'date', 'TIME': 'time',
+            'LATITUDE': 'latitude', 'LONGITUDE': 'longitude',
+        },
+        # all the flag and comment columns added to the row headers (were columns 21,22,25,...,64 with pressure at 17)
+        'extra_row_headers': [4, 5, 8, 9, 15, 16, 22, 23, 27, 34, 39, 43, 45, 47],
+        'data_rows_start': 2, #SET MANUALLY
+        'cfg': {
+            'row_headers_row': '1',
+            'column_header_rows': '1',
+            'column_group_count': '1',
+            'column_header_label_1': 'result_value',
+            'header_as_column_1': '1,1,col_name',
+        },
+    },
+}
+
+
+def read_header(file):
+    """Column names of a csv or the first sheet of a workbook, nothing past the header row is read"""
+    if file.suffix == '.xlsx':
+        wb = load_workbook(file, read_only=True, data_only=True)
+        try:
+            return dedupe_headers(next(wb.worksheets[0].iter_rows(max_row=1, values_only=True), ()))
+        finally:
+            wb.close()
+    return pl.scan_csv(file, infer_schema_length=0).collect_schema().names()
+
+
+def header_fingerprint(header):
+    """sha1 of the column names, the same header always gets the same fingerprint"""
+    return hashlib.sha1('\n'.join(header).encode()).hexdigest()
+
+
+def template_hash(template):
+    """sha1 of a template's rules so cached layouts are dropped when the rules change"""
+    return hashlib.sha1(json.dumps(TEMPLATES[template], sort_keys=True).encode()).hexdigest()
+
+
+def resolve_layout(template, header):
+    """Resolve the un-xtab columns of a header against a template by column name
+
+    Returns (layout, None) or (None, reason the header does not fit the template). Column numbers
+    are 1 based and include the metadata columns added in front of the file's columns.
+    """
+    rules = TEMPLATES[template]
+    columns = METADATA_COLUMNS + [col.strip() for col in header]
+    pressure = next((col for col in rules['pressure'] if col in columns), None)
+    if pressure is None:
+        return None, f'no PRESSURE column ({" or ".join(rules["pressure"])})'
+    data_cols_start = columns.index(pressure) + 1 # +1 because index is 0 based
+    # we want pressure in the row header and data to include as primary key, depth right after it in the row headers
+    row_headers_end = data_cols_start + 1
+    if row_headers_end > len(columns) or 'depth' not in columns[row_headers_end - 1].lower():
+        return None, 'no DEPTH column right after PRESSURE'
+    extra_row_headers = [data_cols_start + offset for offset in rules['extra_row_headers']]
+    if extra_row_headers and extra_row_headers[-1] > len(columns):
+        return None, f'only {len(columns)} columns, flag/comment row headers go up to column {extra_row_headers[-1]}'
+    layout = {
+        'template': template,
+        'pressure': pressure,
+        'depth': columns[row_headers_end - 1],
+        'extra_row_headers': [columns[i - 1] for i in extra_row_headers],
+        'data_columns': f'{data_cols_start}-{len(columns)}',
+        'row_headers': ','.join([f'1-{row_headers_end}'] + [str(i) for i in extra_row_headers]),
+    }
+    return layout, None
+
+
+def match_template(template, header, known_layouts=None):
+    """Look up the header fingerprint in the cached layouts, resolving it by name if it is new
+
+    Returns (fingerprint, layout, reason) where layout is None if the header does not fit the template
+    """
+    fingerprint = header_fingerprint(header)
+    layout = (known_layouts or {}).get((fingerprint, template))
+    if layout is not None:
+        return fingerprint, layout, None
+    layout, reason = resolve_layout(template, header)
+    return fingerprint, layout, reason
+
+
+def layout_cfg(layout, n_rows):
+    """un-xtab cfg settings for a resolved layout with n_rows rows (not counting the header)"""
+    rules = TEMPLATES[layout['template']]
+    cfg = {
+        'data_columns': layout['data_columns'],
+        'data_rows': f'{rules["data_rows_start"]}-{n_rows + 1}', # +1 to account for header being a row in excel
+        'row_headers': layout['row_headers'],
+    }
+    cfg.update(rules['cfg'])
+    return cfg
+
+
+def load_templates(conn):
+    """Cached layouts from the manifest keyed by (fingerprint, template), skipping layouts of changed templates"""
+    known_layouts = {}
+    for fingerprint, template, cached_hash, layout in conn.execute(
+        'select fingerprint, template, template_hash, layout from templates'
+    ):
+        if template in TEMPLATES and cached_hash == template_hash(template):
+            known_layouts[(fingerprint, template)] = json.loads(layout)
+    return known_layouts
+
+
+def save_template(conn, fingerprint, header, layout):
+    """Cache a resolved layout in the manifest"""
+    with conn:
+        conn.execute(
+            'insert or replace into templates values (?, ?, ?, ?, ?, ?)',
+            (
+                fingerprint,
+                layout['template'],
+                template_hash(layout['template']),
+                json.dumps(header),
+                json.dumps(layout),
+                datetime.now().isoformat(),
+            ),
+        )
+
+
+def rejected_result(file, template, fingerprint, reason):
+    """Result for a file whose header does not fit its template, nothing else is read or un-xtabbed"""
+    print(f'CURRENT FILE: {file.name} header {fingerprint[:12]} does not fit the {template} template, {reason}. SKIPPED, PLEASE CHECK FILE')
+    return {
+        'file': file.name,
+        'source_path': file,
+        'rejected': reason,
+        'fingerprint': fingerprint,
+        'files_to_check': [file.name],
+    }
+
+
+def check_pressure_column(file, layout):
+    """Files to check for a layout whose pressure column is not where the template expects it
+
+    The layout was resolved by name so the file is still un-xtabbed, but its columns moved.
+    """
+    expected = TEMPLATES[layout['template']]['pressure_column']
+    data_cols_start = int(layout['data_columns'].split('-')[0])
+    if data_cols_start == expected:
+        return []
+    print(f'CURRENT FILE: {file.name} has PRESSURE at column {data_cols_start} instead of {expected}, resolved by name. PLEASE CHECK FILE')
+    return [file.name]
+
+
+ROW_INDEX = '__source_row'
+
+# un-xtab.py writes its output with csv.writer, whose lines end in \r\n
+UNXTAB_LINE_TERMINATOR = '\r\n'
+
+
+def cast_type_of(file):
+    """Determine cast based on file name"""
+    if 'downcast' in file.name.lower():
+        return 'downcast'
+    elif 'upcast' in file.name.lower():
+        return 'upcast'
+    return 'N/A'
+
+
+def add_metadata_columns(lf, file):
+    """Add source_path, source_filename and cast_type as literal columns in front of the file's columns"""
+    return lf.select(
+        pl.lit(str(file)).alias('source_path'),
+        pl.lit(file.name).alias('source_filename'),
+        pl.lit(cast_type_of(file)).alias('cast_type'),
+        pl.all(),
+    )
+
+
+def scan_source(file):
+    """LazyFrame of every cell as text plus the source row number in ROW_INDEX (used by filter_data_rows)
+
+    csvs are scanned (nothing is read until the frame is collected or sunk), xlsx workbooks are first streamed by read_xlsx
+    into the ipc file at xlsx_ipc_path, which is scanned the same way (remove it with xlsx_ipc_path(file).unlink())
+    """
+    if file.suffix == '.xlsx':
+        # not memory mapped, so the ipc file can be removed on windows once the frame is sunk
+        return pl.scan_ipc(read_xlsx(file, xlsx_ipc_path(file)), memory_map=False, row_index_name=ROW_INDEX)
+    return pl.scan_csv(file, infer_schema_length=0, row_index_name=ROW_INDEX)
+
+
+def filter_data_rows(lf, predicate, n_metadata_rows=0):
+    """Filter rows with predicate but always keep the first n_metadata_rows (units/status rows), drops ROW_INDEX
+
+    the row number comes from the scan so the plan stays streamable (head/slice/concat plans are not)
+    """
+    return lf.filter((pl.col(ROW_INDEX) < n_metadata_rows) | predicate).drop(ROW_INDEX)
+
+
+def sink_csv(lf, path, line_terminator='\n'):
+    """Stream a LazyFrame to csv, plans the streaming engine can not run yet are collected first"""
+    try:
+        lf.sink_csv(path, line_terminator=line_terminator)
+    except pl.exceptions.InvalidOperationError:
+        lf.collect().write_csv(path, line_terminator=line_terminator)
+
+
+def sink_parquet(lf, path):
+    """Stream a LazyFrame to parquet, plans the streaming engine can not run yet are collected first"""
+    try:
+        lf.sink_parquet(path)
+    except pl.exceptions.InvalidOperationError:
+        lf.collect().write_parquet(path)
+
+
+def count_rows(lf):
+    """Number of rows after filtering, only the columns the filters need are read"""
+    return lf.select(pl.len()).collect().item()
+
 ## BELOW is the working subprocess in a loop for all csvs
 
 # %%
-# Looping for creating all un-xtab.py cmd line statements in a format to use for subprocesses 
+# Looping for creating all un-xtab.py cmd line statements in a format to use for subprocesses
 # WORKING RUNS THROUGH ALL CSVS AND UNTABBS CURRENT FILE WITH A SUBPROCESS CMD LINE
 #
 #   20240613 -- Successfully ran through all pre 2016 data files took approx 8 minutes to unxtab all of the files
@@ -66,166 +785,136 @@ directory = Path('../../../../Data_Inventory/_University_of_Washington/Salish_Cr
 #### SECTION 1 ####
 
 # csv handling
-# Get a list of directories in the specified directory
-folders = [f for f in directory.iterdir() if f.is_dir() and f.name.endswith("Data")]
-
-# Filter folders where the year in the name is 2016 or greater
-filtered_folders = []
-for folder in folders:
-    folder_parts = folder.name.split('-')
-    year = int(folder_parts[1].split('_')[0])
-    # Debug: Print each folder and the extracted year
-    # print(f"Folder: {folder.name}, Extracted Year: {year}")
-    if year is not None and year <= 2015:
-        filtered_folders.append(folder)
-
-folder_count = 0
-file_count = 0
-# Print the list of filtered directories
-# print("\nFiltered directories (2015 or less):")
-for folder in filtered_folders:  #gets all pre 2016 folders
-    folder_count += 1
-
-    for file in folder.glob("*.csv"): # only checks the files that end in ".csv"
-        
-        if file.name.endswith(("downcast.csv","upcast.csv")): #only checks upcast and downcast csvs
-            file = file.resolve()
-
-            #init cmd line run for current file
-            cmd = ['~/houston-dc-jobs/data-management/bin/un-xtab.py','-c']
-
-            file_count += 1
-            print(f'folder_count {folder_count}')
-            print(f'file count {file_count}')
-            print(f'curr filename {file.name}')
-
-            #read and insert meta data
-            curr_df = pl.read_csv(file)
-
-            # Determine cast based on file name
-            if 'downcast' in file.name.lower():
-                cast_type = 'downcast'
-            elif 'upcast' in file.name.lower():
-                cast_type = 'upcast'
-            else:
-                cast_type = 'N/A'
-            curr_df = curr_df.insert_column(0, pl.Series('cast_type', [cast_type]*len(curr_df)))
-
-            # insert source filename and path as new columns
-            curr_df = curr_df.insert_column(0, pl.Series('source_filename', [file.name]*len(curr_df)))
-            curr_df = curr_df.insert_column(0, pl.Series('source_path', [str(file)]*len(curr_df)))
-
-            # strip column heaeders of any white spaces
-            curr_df = curr_df.rename({col: col.strip() for col in curr_df.columns})
-
-            # Strip whitespace from each cell in the DataFrame
-            curr_df = curr_df.with_columns([pl.col(col).str.strip_chars().alias(col) for col in curr_df.columns])
-
-            # filter out any "None" Stations to be ignored on import
-            metadata_rows = curr_df.head(2) #get the meta data rows
-            curr_df = curr_df.slice(2) # remove the meta data rows so we dont duplicate them
-            curr_df = curr_df.filter(pl.col('Station') != 'None') # filter out any rows with a 'None' station to be ignored on import
-            curr_df = pl.concat([metadata_rows,curr_df])
-
-            curr_file_new_name = file.parent / f'{file.stem}_m.csv'
-            # EXPORT INTO NEW CSV SO WE CAN RUN UNXTAB ON THIS VERSION OF FILE W Orig filepath 
-            # and file name and cast type NEW FILE = same name + "_m" for metadata
-            curr_df.write_csv(curr_file_new_name)
-
-            curr_cfg_filepath = file.parent / f'{file.stem}_m.cfg' # save proper cfg file name
-
-            # CFG file generation below
-            if 'Pressure' in curr_df.columns:
-                if (curr_df.get_column_index('Pressure') + 1) != 11: # +1 because index is 0 based
-                    print(f'CURRENT FILE: {file.name} Does not have PRESSURE at expected INDEX, using value of 11 anyway. PLEASE CHECK FILE')
-                data_cols_start = 11
-                if (curr_df.get_column_index('Depth') + 1) != 12: # +1 because index is 0 based
-                    print(f'CURRENT FILE: {file.name} Does not have DEPTH at expected INDEX, using value of 11 anyway. PLEASE CHECK FILE')
-                data_cols_start = 11
-            else:
-                print(f'CURRENT FILE: {file.name} Does not have PRESSURE in the HEADERS at all, using value of 11 anyway. PLEASE CHECK FILE')
-                data_cols_start = 11
-                if 'Depth' not in curr_df.columns: # check for depth as well
-                    print(f'CURRENT FILE: {file.name} Does not have DEPTH in the HEADERS at all, using value of 11 anyway. PLEASE CHECK FILE')
-                    data_cols_start = 11
-           
-            print('start col    ',data_cols_start)
-            data_cols_end = curr_df.width
-            print('end col      ',data_cols_end)
-            data_rows_start = 4 #SET MANUALLY
-            print('start row    ', data_rows_start)
-            data_rows_end = len(curr_df) + 1 # +1 to account for header being a row in excel
-            print('end row      ',data_rows_end)
-            #SET MANUALLY (Should be same value as start col if pressure is first col) --we want pressure in the row header and data to include as primary key
-            row_headers_end = data_cols_start + 1 # add one to get depth in the row headers but still pull pressure and depth as variables
-            print('row hdr end  ',row_headers_end)
-
-            #cfg generation for all csv (up and downcasts are in same data structure) (pre 2016 data ONLY)
-            if file.suffix == '.csv':
-                with open(curr_cfg_filepath, 'w') as cfg_file:
-                    cfg_file.write(f"[{file.stem}_m]\n")
-                    cfg_file.write(f"data_columns={data_cols_start}-{data_cols_end}\n")
-                    cfg_file.write(f"data_rows={data_rows_start}-{data_rows_end}\n")
-                    cfg_file.write(f"row_headers=1-{row_headers_end}\n")
-                    cfg_file.write(f"row_headers_row=1\n")
-                    cfg_file.write(f"column_header_rows=1-3\n") # known that there are only 3 SET MANUALLY
-                    cfg_file.write(f"column_group_count=1\n")
-                    cfg_file.write(f"column_header_label_1=result_value\n")
-                    cfg_file.write(f"header_as_column_1=1,1,col_name\n")
-                    cfg_file.write(f"header_as_column_2=2,1,units\n")
-                    cfg_file.write(f"header_as_column_3=3,1,ctd_status")
-            else:
-                print(f"file:{file.name} failed, filetype not csv")
-            
-            # # building cmd line to pass into subprocess
-            cmd.append(f"'{curr_cfg_filepath.as_posix()}'")
-            cmd.append(f"'{curr_file_new_name.as_posix()}'")
-            cmd.append(f"'{(curr_file_new_name.parent / ('untabbed_' + curr_file_new_name.name)).as_posix()}'")
-            cmd = [' '.join(cmd)]
-            print('curr cmd list: ', cmd)
-            
-            unxtab_run = subprocess.run(cmd, shell=True)
-
-            # Print the output of current subprocess
-            print('direct output:', unxtab_run)
-            print("stdout:", unxtab_run.stdout)
-            print("stderr:", unxtab_run.stderr)
-            print("Return code:", unxtab_run.returncode)
-
-            print('-----------------end------------------')
+def unxtab_section1_file(file, engine='subprocess', known_layouts=None, parquet_dir=None):
+    """SECTION 1: add metadata, write the cfg and un-xtab one pre 2016 upcast/downcast csv
+
+    known_layouts are the cached template layouts (see load_templates), the header is checked against the
+    section1 template first and the file is rejected without being read if it does not fit.
+    With parquet_dir the result goes to the parquet dataset instead of the untabbed csv.
+    Returns a dict with the filename, the un-xtab returncode/stdout/stderr and the list of files to check
+    """
+    file = file.resolve()
+
+    # match the header to the template before reading anything else
+    with instrument.stage('header', file=file.name):
+        header = read_header(file)
+        fingerprint, layout, reason = match_template('section1', header, known_layouts)
+    if layout is None:
+        return rejected_result(file, 'section1', fingerprint, reason)
+    files_to_check = check_pressure_column(file, layout)
+
+    # the scan, strip and filter are lazy, they run when the rows are counted (and again in the un-xtab)
+    with instrument.stage('read', file=file.name) as timer:
+        #scan the file (lazy, nothing is read until the row count and un-xtab below)
+        curr_lf = scan_source(file)
+
+        # strip column heaeders of any white spaces
+        curr_lf = curr_lf.rename({col: col.strip() for col in curr_lf.collect_schema().names()})
+
+        # Strip whitespace from each cell in the DataFrame
+        curr_lf = curr_lf.with_columns(pl.exclude(ROW_INDEX).str.strip_chars())
+
+        # filter out any "None" Stations to be ignored on import, keeping the 2 meta data rows
+        curr_lf = filter_data_rows(curr_lf, pl.col('Station') != 'None', n_metadata_rows=2)
+
+        # insert source path, filename and cast type as new columns
+        curr_lf = add_metadata_columns(curr_lf, file)
+        n_rows = count_rows(curr_lf)
+        timer.rows = n_rows
+        timer.bytes = file.stat().st_size
+
+    # metadata version of the file, only written to disk when un-xtab.py needs it (engine='subprocess')
+    curr_file_new_name = file.parent / f'{file.stem}_m.csv'
+
+    curr_cfg_filepath = file.parent / f'{file.stem}_m.cfg' # save proper cfg file name
+
+    # CFG file generation below
+    with instrument.stage('cfg_write', file=file.name) as timer:
+        cfg = layout_cfg(layout, n_rows)
+        timer.fields['cfg'] = cfg
+        if file.suffix == '.csv':
+            write_cfg(curr_cfg_filepath, f'{file.stem}_m', cfg)
+        else:
+            print(f"file:{file.name} failed, filetype not csv")
+
+    parquet_path = parquet_part_path(parquet_dir, file) if parquet_dir is not None else None
+    with instrument.stage('unxtab', file=file.name, engine=engine) as timer:
+        result = unxtab_file(curr_lf, cfg, curr_file_new_name, curr_cfg_filepath, engine, parquet_path, layout)
+        timer.rows = n_rows
+    result.update({
+        'file': file.name, 'source_path': file, 'cfg': cfg, 'files_to_check': files_to_check,
+        'fingerprint': fingerprint, 'header': header, 'layout': layout,
+    })
+    return result
 
 
 
 # %%
 ## BELOW IS EVERYTHING FOR 2016 and up files where downcast and upcast are different formats and all are stored in xlsx
 
-# successfully converted all xlsx files to csv only clean ones that end in downcast or upcast # DO NOT NEED TO RUN AGAIN
-# DO NOT NEED TO RUN AGAIN UNLESS we have new data to convert then just uncomment the below code chunk
-
-
-# folders = [f for f in directory.iterdir() if f.is_dir() and f.name.endswith("Data")]
-# # Filter folders where the year in the name is 2016 or greater to get just the new .xlsx data
-# filtered_folders = []
-# for folder in folders:
-#     folder_parts = folder.name.split('-')
-#     year = int(folder_parts[1].split('_')[0])
-#     # Debug: Print each folder and the extracted year
-#     # print(f"Folder: {folder.name}, Extracted Year: {year}")
-#     if year is not None and year >= 2016:
-#         filtered_folders.append(folder)
-
-# # Print the list of filtered directories
-# # print("\nFiltered directories (2016 or greater):")
-# for folder in filtered_folders:
-#     #print(folder.name)
-#     for file in folder.glob("*.xlsx"):
-#         if file.name.endswith(("downcast.xlsx","upcast.xlsx")):
-#             curr_filepath = file
-#             print(curr_filepath)
-#             csv_output = str(file.parent / f'{file.stem}.csv')
-#             print(csv_output)
-#             Xlsx2csv(curr_filepath, outputencoding="utf-8").convert(outfile=csv_output, sheetid=1)
-#             # Xlsx2csv().convert() redundant line dont need
+# successfully converted all xlsx files to csv only clean ones that end in downcast or upcast
+# The intermediate csv is no longer needed: read_xlsx() streams the first sheet of the workbook into an arrow ipc file with
+# every value as a string, the same as reading the Xlsx2csv output back with infer_schema_length=0.
+
+def xlsx_ipc_path(file):
+    """Temporary arrow ipc file read_xlsx streams a workbook into, next to the workbook like the _m.csv and _m.cfg"""
+    return file.parent / f'{file.stem}_xlsx.arrow'
+
+
+def xlsx_value_to_str(value):
+    """Format an openpyxl cell value the way it was written to the converted csv"""
+    if value is None or value == '':
+        return None
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d' if value.time() == time(0) else '%Y-%m-%d %H:%M:%S')
+    if isinstance(value, (date, time)):
+        return value.isoformat()
+    return str(value)
+
+
+def dedupe_headers(headers):
+    """Name duplicate headers <name>_duplicated_<n> like pl.read_csv does"""
+    seen = {}
+    columns = []
+    for header in headers:
+        header = '' if header is None else str(header)
+        if header in seen:
+            columns.append(f'{header}_duplicated_{seen[header]}')
+            seen[header] += 1
+        else:
+            columns.append(header)
+            seen[header] = 0
+    return columns
+
+
+def read_xlsx(file, ipc_path, batch_size=10_000):
+    """Stream the first sheet of a workbook into an arrow ipc file of strings, returns ipc_path
+
+    The sheet is opened read only so rows are streamed from the xml, only batch_size rows are
+    held as python objects at a time before they are turned into a polars batch and written
+    as one record batch of the ipc file, so the whole sheet is never in memory.
+    """
+    wb = load_workbook(file, read_only=True, data_only=True)
+    try:
+        rows = wb.worksheets[0].iter_rows(values_only=True)
+        columns = dedupe_headers(next(rows, ()))
+        schema = {col: pl.String for col in columns}
+        width = len(columns)
+        with pa.ipc.new_file(ipc_path, pl.DataFrame(schema=schema).to_arrow().schema) as writer:
+            batch = []
+            for row in rows:
+                row = [xlsx_value_to_str(value) for value in row[:width]]
+                batch.append(row + [None] * (width - len(row)))
+                if len(batch) >= batch_size:
+                    writer.write_table(pl.DataFrame(batch, schema=schema, orient='row').to_arrow())
+                    batch = []
+            if batch:
+                writer.write_table(pl.DataFrame(batch, schema=schema, orient='row').to_arrow())
+    finally:
+        wb.close()
+    return ipc_path
 
 
 # SUCCESSFUlly RAN ALL XLSX CONVERTED TO CSVS if name ended in upcast or downcast
@@ -239,201 +928,272 @@ for folder in filtered_folders:  #gets all pre 2016 folders
 # 20240619 - ran without untabbing and successfully created all metata data versions of csv up and down casts
 # 20240621 - ran through all 2016+ upcast and downcast files, created cfg files and successfully untabbed all files
 
-#init counter variables
-folder_count = 0
-file_count = 0
-
-# Loop through each file in the directory
-
-folders = [f for f in directory.iterdir() if f.is_dir() and f.name.endswith("Data")]
-
-# Filter folders where the year in the name is 2016 or greater
-filtered_folders = []
-for folder in folders:
-    folder_parts = folder.name.split('-')
-    year = int(folder_parts[1].split('_')[0])
-    # Debug: Print each folder and the extracted year
-    # print(f"Folder: {folder.name}, Extracted Year: {year}")
-    if year is not None and year >= 2016:
-        filtered_folders.append(folder)
-
-
-#init list to store filenames that need to be checked
-files_to_check = []
-for folder in filtered_folders:
-    folder_count += 1
-    print(f'folder_count {folder_count}')
-    print(f'folder name: {folder.name}')
+def unxtab_section2_file(file, engine='subprocess', known_layouts=None, parquet_dir=None):
+    """SECTION 2: add metadata, write the cfg and un-xtab one 2016+ upcast/downcast xlsx (or csv converted from xlsx)
+
+    known_layouts are the cached template layouts (see load_templates), the header is checked against the
+    downcast or upcast template first and the file is rejected without being read if it does not fit.
+    With parquet_dir the result goes to the parquet dataset instead of the untabbed csv.
+    Returns a dict with the filename, the un-xtab returncode/stdout/stderr and the list of files to check
+    """
+    file = file.resolve()
+
+    # downcast and upcast are different templates, match the header before reading anything else
+    template = 'section2_downcast' if file.stem.endswith('downcast') else 'section2_upcast'
+    with instrument.stage('header', file=file.name):
+        header = read_header(file)
+        fingerprint, layout, reason = match_template(template, header, known_layouts)
+    if layout is None:
+        return rejected_result(file, template, fingerprint, reason)
+    files_to_check = check_pressure_column(file, layout)
+
+    try:
+        # the strip and filter are lazy, they run when the rows are counted (and again in the un-xtab)
+        with instrument.stage('read', file=file.name) as timer:
+            #read the file (lazy, workbooks are streamed into a temporary ipc file by read_xlsx first)
+            curr_lf = scan_source(file)
+            # drop null rows that are appended to the end for some reason
+            curr_lf = curr_lf.filter(~pl.all_horizontal(pl.exclude(ROW_INDEX).is_null()))
 
-    for file in folder.glob("*.csv"): # only checks the files that end in ".csv"
-        
-        if file.name.endswith(("downcast.csv","upcast.csv")): #only checks upcast and downcast csvs
-        #if file.name.endswith(("April2016_labupcast.csv")): # Testing statement for just 1 file
-            file = file.resolve()
-            #init cmd line run for current file
-            cmd = ['~/houston-dc-jobs/data-management/bin/un-xtab.py','-c']
+            # strip column heaeders of any white spaces
+            curr_lf = curr_lf.rename({col: col.strip() for col in curr_lf.collect_schema().names()})
+            # change cast to cast_no so it doesnt break sql
+            curr_lf = curr_lf.rename({col: col.replace("Cast", "cast_no") for col in curr_lf.collect_schema().names() if "Cast" in col})
 
-            file_count += 1
-            print(f'file count {file_count}')
-            print(f'curr filename {file.name}')
+            # Strip whitespace from each cell in the DataFrame
+            curr_lf = curr_lf.with_columns(pl.exclude(ROW_INDEX).str.strip_chars())
 
-            #read and insert meta data
-            curr_df = pl.read_csv(file,infer_schema_length=0)
-            # drop null rows that are appended to the end for some reason
-            curr_df = curr_df.filter(~pl.all_horizontal(pl.all().is_null()))
-            # Determine cast based on file name
-            if 'downcast' in file.name.lower():
-                cast_type = 'downcast'
-            elif 'upcast' in file.name.lower():
-                cast_type = 'upcast'
+            if template == 'section2_downcast':
+                # filter out any "None" Stations to be ignored on import, keeping the meta data row
+                curr_lf = filter_data_rows(curr_lf, pl.col('Station') != 'None', n_metadata_rows=1)
+            else:
+                # IF UPCAST remove all rows with no station logged, the upcast template has a DIFFERENT CFG
+                curr_lf = filter_data_rows(curr_lf, pl.col('STATION_NO') != 'None')
+
+            # insert source path, filename and cast type as new columns
+            curr_lf = add_metadata_columns(curr_lf, file)
+            n_rows = count_rows(curr_lf)
+            timer.rows = n_rows
+            timer.bytes = file.stat().st_size
+
+        curr_cfg_filepath = file.parent / f'{file.stem}_m.cfg' # save proper cfg file name
+
+        # CFG file generation below
+        with instrument.stage('cfg_write', file=file.name) as timer:
+            cfg = layout_cfg(layout, n_rows)
+            timer.fields['cfg'] = cfg
+            if file.suffix in ('.csv', '.xlsx'):
+                write_cfg(curr_cfg_filepath, f'{file.stem}_m', cfg)
             else:
-                cast_type = 'N/A'
+                print(f"file:{file.name} failed, filetype not csv or xlsx")
 
-            curr_df = curr_df.insert_column(0, pl.Series('cast_type', [cast_type]*len(curr_df)))
+        # metadata version of the file (same filename name + "_m"), only written to disk when un-xtab.py needs it
+        curr_file_new_name = file.parent / f'{file.stem}_m.csv'
 
-            # insert source filename and path as new columns
-            curr_df = curr_df.insert_column(0, pl.Series('source_filename', [file.name]*len(curr_df)))
-            curr_df = curr_df.insert_column(0, pl.Series('source_path', [str(file)]*len(curr_df)))
+        parquet_path = parquet_part_path(parquet_dir, file) if parquet_dir is not None else None
+        with instrument.stage('unxtab', file=file.name, engine=engine) as timer:
+            result = unxtab_file(curr_lf, cfg, curr_file_new_name, curr_cfg_filepath, engine, parquet_path, layout)
+            timer.rows = n_rows
+    finally:
+        # the ipc file of a workbook is only needed until the file is un-xtabbed
+        xlsx_ipc_path(file).unlink(missing_ok=True)
+    result.update({
+        'file': file.name, 'source_path': file, 'cfg': cfg, 'files_to_check': files_to_check,
+        'fingerprint': fingerprint, 'header': header, 'layout': layout,
+    })
+    return result
 
-            # strip column heaeders of any white spaces
-            curr_df = curr_df.rename({col: col.strip() for col in curr_df.columns})
-            # change cast to cast_no so it doesnt break sql
-            curr_df = curr_df.rename({col: col.replace("Cast", "cast_no") for col in curr_df.columns if "Cast" in col})
 
-            # Strip whitespace from each cell in the DataFrame
-            curr_df = curr_df.with_columns([pl.col(col).str.strip_chars().alias(col) for col in curr_df.columns])
-            
-            curr_cfg_filepath = file.parent / f'{file.stem}_m.cfg' # save proper cfg file name
-
-            if file.name.endswith('downcast.csv'):
-                # filter out any "None" Stations to be ignored on import
-                metadata_rows = curr_df.head(1) #get the meta data rows
-                curr_df = curr_df.slice(1) # remove the meta data rows so we dont duplicate them
-                curr_df = curr_df.filter(pl.col('Station') != 'None') # filter out any rows with a 'None' station to be ignored on import
-                curr_df = pl.concat([metadata_rows,curr_df])
-
-                # CFG file generation below
-                if 'prDM: Pressure  Digiquartz' in curr_df.columns: #checks to see if pressure is in the columns
-                    if (curr_df.get_column_index('prDM: Pressure  Digiquartz') + 1) != 14: # +1 for zero index in cols
-                        print(f'CURRENT FILE: {file.name} Does not have PRESSURE at expected INDEX, using value of 14 anyway. PLEASE CHECK FILE')
-                        files_to_check.append(file.name)
-                    if (curr_df.get_column_index('depSM: Depth') + 1) != 15: # +1 for zero index in cols
-                        print(f'CURRENT FILE: {file.name} Does not have DEPTH at expected INDEX, using value of 14 anyway. PLEASE CHECK FILE')
-                        files_to_check.append(file.name) 
-                    data_cols_start = 14
-                elif 'prdM: Pressure  Strain Gauge' in curr_df.columns: # alt check for files where they named it pressure strain gauge...
-                    if (curr_df.get_column_index('prdM: Pressure  Strain Gauge') + 1) != 14: # +1 for zero index in cols
-                        print(f'CURRENT FILE: {file.name} Does not have PRESSURE at expected INDEX, using value of 14 anyway. PLEASE CHECK FILE')
-                        files_to_check.append(file.name)
-                    data_cols_start = 14
-                else:
-                    print(f'CURRENT FILE: {file.name} Does not have PRESSURE in the column HEADERS, using value of 14 anyway. PLEASE CHECK FILE')
-                    files_to_check.append(file.name)
-                    data_cols_start = 14
-                    if 'depSM: Depth' not in curr_df.columns: # check for depth as well
-                        print(f'CURRENT FILE: {file.name} Does not have DEPTH in the column HEADERS, using value of 14 anyway. PLEASE CHECK FILE')
-                        files_to_check.append(file.name)
-                        data_cols_start = 14
-                
-                print('start col    ',data_cols_start)
-                data_cols_end = curr_df.width
-                print('end col      ',data_cols_end)
-                data_rows_start = 3 #SET MANUALLY
-                print('start row    ', data_rows_start)
-                data_rows_end = len(curr_df) + 1 # +1 to account for header being a row in excel
-                print('end row      ',data_rows_end)
-                #SET MANUALLY (Should be same value as start col if pressure is first col) --we want pressure in the row header and data to include as primary key
-                row_headers_end = data_cols_start + 1 # add one to get depth in the row headers but still pull pressure and depth as variables
-                print('row hdr end  ',row_headers_end)
-
-                #check if col 'flag:flag'
-
-                #cfg generation for post 2015 DOWNCAST data ONLY
-                if file.suffix == '.csv':
-                    with open(curr_cfg_filepath, 'w') as cfg_file:
-                        cfg_file.write(f"[{file.stem}_m]\n")
-                        cfg_file.write(f"data_columns={data_cols_start}-{data_cols_end}\n")
-                        cfg_file.write(f"data_rows={data_rows_start}-{data_rows_end}\n")
-                        cfg_file.write(f"row_headers=1-{row_headers_end}\n") ## col 'flag:flag' ??
-                        cfg_file.write(f"row_headers_row=1\n")
-                        cfg_file.write(f"column_header_rows=1-2\n") # known that there are only 2 SET MANUALLY
-                        cfg_file.write(f"column_group_count=1\n")
-                        cfg_file.write(f"column_header_label_1=result_value\n")
-                        cfg_file.write(f"header_as_column_1=1,1,col_name\n")
-                        cfg_file.write(f"header_as_column_2=2,1,units\n")
-                else:
-                    print(f"file:{file.name} failed, filetype not csv")
-                    
-            # IF UPCAST write a DIFFERENT CFG FILE
-            elif file.name.endswith('upcast.csv'):
-                curr_df = curr_df.filter(pl.col('STATION_NO') != 'None') # remove all rows with no station logged
-                
-                # CFG file generation below
-                if 'CTDPRS_DBAR' in curr_df.columns: #checks to see if pressure is in the columns
-                    if (curr_df.get_column_index('CTDPRS_DBAR') + 1) != 17: # +1 for zero index in cols
-                        print(f'CURRENT FILE: {file.name} Does not have PRESSURE at expected INDEX, using value of 17 anyway. PLEASE CHECK FILE')
-                        files_to_check.append(file.name) 
-                    if (curr_df.get_column_index('DEPTH (M)') + 1) != 18: # +1 for zero index in cols
-                        print(f'CURRENT FILE: {file.name} Does not have DEPTH at expected INDEX, using value of 17 anyway. PLEASE CHECK FILE')
-                        files_to_check.append(file.name)
-                    data_cols_start = 17
-                else:
-                    print(f'CURRENT FILE: {file.name} Does not have PRESSURE in the column HEADERS, using value of 17 anyway. PLEASE CHECK FILE')
-                    files_to_check.append(file.name)
-                    data_cols_start = 17
-                    if 'DEPTH (M)' not in curr_df.columns: #checks to see if depth exists in the cols
-                        print(f'CURRENT FILE: {file.name} Does not have DEPTH in the column HEADERS, using value of 17 anyway. PLEASE CHECK FILE')
-                        files_to_check.append(file.name)
-                        data_cols_start = 17
-                
-                print('start col    ',data_cols_start)
-                data_cols_end = curr_df.width
-                print('end col      ',data_cols_end)
-                data_rows_start = 2 #SET MANUALLY
-                print('start row    ', data_rows_start)
-                data_rows_end = len(curr_df) + 1 # +1 to account for header being a row in excel
-                print('end row      ',data_rows_end)
-                #SET MANUALLY (Should be same value as start col if pressure is first col) --we want pressure in the row header and data to include as primary key
-                row_headers_end = data_cols_start + 1 # add one to get depth in the row headers but still pull pressure and depth as variables
-                print('row hdr end  ',row_headers_end)
-
-
-                #cfg generation for post 2015 UPCAST data ONLY
-                if file.suffix == '.csv':
-                    with open(curr_cfg_filepath, 'w') as cfg_file:
-                        cfg_file.write(f"[{file.stem}_m]\n")
-                        cfg_file.write(f"data_columns={data_cols_start}-{data_cols_end}\n") # manually adding all the flag and comment columns to header
-                        cfg_file.write(f"data_rows={data_rows_start}-{data_rows_end}\n")
-                        cfg_file.write(f"row_headers=1-{row_headers_end},21,22,25,26,32,33,39,40,44,51,56,60,62,64\n")
-                        cfg_file.write(f"row_headers_row=1\n")
-                        cfg_file.write(f"column_header_rows=1\n") # known that there are only 2 SET MANUALLY
-                        cfg_file.write(f"column_group_count=1\n")
-                        cfg_file.write(f"column_header_label_1=result_value\n")
-                        cfg_file.write(f"header_as_column_1=1,1,col_name\n")
-                else:
-                    print(f"file:{file.name} failed, filetype not csv")
-
-            # EXPORT INTO NEW CSV SO WE CAN RUN UNXTAB ON THIS VERSION OF FILE W Orig filepath 
-            # file name and cast type. NEW FILE = same filename name + "_m" for metadata
-            curr_file_new_name = file.parent / f'{file.stem}_m.csv'
-            curr_df.write_csv(curr_file_new_name)
-
-            # building cmd line to pass into subprocess
-            cmd.append(f"'{curr_cfg_filepath.as_posix()}'")
-            cmd.append(f"'{curr_file_new_name.as_posix()}'")
-            cmd.append(f"'{(curr_file_new_name.parent / ('untabbed_' + curr_file_new_name.name)).as_posix()}'")
-            cmd = [' '.join(cmd)]
-            print('curr cmd list: ', cmd)
-            
-            unxtab_run = subprocess.run(cmd, shell=True)
-
-            # Print the output of current subprocess
-            print('direct output:', unxtab_run)
-            print("stdout:", unxtab_run.stdout)
-            print("stderr:", unxtab_run.stderr)
-            print("Return code:", unxtab_run.returncode)
-
-            print('-----------------end------------------')
-print('files to check:', files_to_check)
+# %%
+
+#### RUN SECTION 1 AND SECTION 2 ####
+
+def collect_jobs(directory):
+    """Build the (function, file) jobs for every SECTION 1 and SECTION 2 upcast/downcast file"""
+    jobs = []
+    for folder in get_cruise_folders(directory, max_year=2015): #gets all pre 2016 folders
+        for file in folder.glob("*.csv"): # only checks the files that end in ".csv"
+            if file.name.endswith(("downcast.csv","upcast.csv")): #only checks upcast and downcast csvs
+                jobs.append((unxtab_section1_file, file))
+    for folder in get_cruise_folders(directory, min_year=2016): #gets all 2016+ folders
+        workbooks = [f for f in folder.glob("*.xlsx") if f.name.endswith(("downcast.xlsx","upcast.xlsx"))]
+        for file in workbooks:
+        #if file.name.endswith(("April2016_labupcast.xlsx")): # Testing statement for just 1 file
+            jobs.append((unxtab_section2_file, file))
+        # csvs converted from a workbook that is no longer in the folder
+        workbook_stems = {f.stem for f in workbooks}
+        for file in folder.glob("*.csv"): # only checks the files that end in ".csv"
+            if file.name.endswith(("downcast.csv","upcast.csv")) and file.stem not in workbook_stems:
+                jobs.append((unxtab_section2_file, file))
+    return jobs
+
+
+def configure_worker(*settings):
+    """Pool initializer, the worker processes log to the events log of the run with its run id"""
+    instrument.configure(*settings)
+
+
+def run_job(func, file, *args):
+    """Process one file in a worker process, the stage totals of the file go back with its result"""
+    result = func(file, *args)
+    result['stages'] = instrument.take_totals()
+    return result
+
+
+def clparser():
+    parser = argparse.ArgumentParser(
+        description="Generate un-xtab cfg files for all UW Salish upcast/downcast files and un-xtab them."
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help=f"Number of worker processes used to process files at the same time (this machine has {os.cpu_count()} cores). Default: 1",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=["native", "subprocess", "verify"],
+        default="subprocess",
+        help="How to un-xtab each file: in process with polars (native), with the un-xtab.py cmd line script (subprocess), or both and compare the outputs (verify). Default: subprocess",
+    )
+    parser.add_argument(
+        "--directory",
+        type=Path,
+        default=directory,
+        help="Salish_Cruises data directory",
+    )
+    parser.add_argument(
+        "--manifest",
+        type=Path,
+        default=None,
+        help="sqlite manifest of processed files. Default: <directory>/unxtab_manifest.sqlite",
+    )
+    parser.add_argument(
+        "--output",
+        choices=["csv", "parquet"],
+        default="csv",
+        help="Write one untabbed_<filename_m>.csv per file (csv) or one hive partitioned (year, cast_type) parquet dataset with typed result columns (parquet). Default: csv",
+    )
+    parser.add_argument(
+        "--parquet-dir",
+        type=Path,
+        default=None,
+        help="Root of the parquet dataset for --output parquet. Default: <directory>/untabbed_parquet",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Convert and un-xtab every file even if it has not changed since the last run",
+    )
+    parser.add_argument(
+        "--events",
+        type=Path,
+        default=None,
+        help="Json lines log the timings of every file and stage are appended to. Default: <directory>/unxtab_events.jsonl",
+    )
+    parser.add_argument(
+        "--profile",
+        nargs="+",
+        choices=STAGES + ["all"],
+        default=[],
+        help="Stages to profile, the profiles are written to <directory>/unxtab_profile",
+    )
+    parser.add_argument(
+        "--profiler",
+        choices=PROFILERS,
+        default="cprofile",
+        help="Profiler of the --profile stages. Default: cprofile",
+    )
+    return parser
+
+
+def main():
+    args = clparser().parse_args()
+    instrument.configure(
+        log_path=args.events or args.directory / 'unxtab_events.jsonl',
+        profile=args.profile,
+        profiler=args.profiler,
+        profile_dir=args.directory / 'unxtab_profile',
+    )
+    conn = open_manifest(args.manifest or args.directory / 'unxtab_manifest.sqlite')
+    known_layouts = load_templates(conn)
+    parquet_dir = None
+    if args.output == 'parquet':
+        parquet_dir = (args.parquet_dir or args.directory / 'untabbed_parquet').resolve()
+
+    all_jobs = collect_jobs(args.directory)
+    jobs = [(func, file) for func, file in all_jobs if not manifest_is_current(conn, file, args.force, args.output)]
+    print(f'{len(all_jobs) - len(jobs)} upcast/downcast files unchanged since the last run, skipping them')
+    print(f'{len(jobs)} upcast/downcast files to process with {args.workers} worker(s)')
+    instrument.event('start', files=len(jobs), unchanged=len(all_jobs) - len(jobs), workers=args.workers, engine=args.engine, output=args.output)
+
+    file_count = 0
+    files_to_check = []
+    failed_files = {}
+    rejected_files = {}
+
+    def report(result):
+        # totals of the stages run in a worker process
+        for stage, totals in result.pop('stages', {}).items():
+            instrument.add(stage, **totals)
+        if result.get('rejected'):
+            # header did not fit its template, nothing was un-xtabbed and the manifest is not updated so it is checked again next run
+            rejected_files[result['file']] = result['rejected']
+            files_to_check.extend(result['files_to_check'])
+            return
+        # one line per file, the output of the un-xtab run only when it failed
+        print(f'[{file_count}/{len(jobs)}] {result["file"]} return code {result["returncode"]}')
+        if result['returncode'] != 0:
+            print("stdout:", result['stdout'])
+            print("stderr:", result['stderr'])
+        instrument.event('file', file=result['file'], returncode=result['returncode'], output_path=result['output_path'])
+        files_to_check.extend(result['files_to_check'])
+        if result['returncode'] != 0:
+            failed_files[result['file']] = result['returncode']
+        if result.get('matches_unxtab') is False:
+            print(f'CURRENT FILE: {result["file"]} native un-xtab output does not match un-xtab.py. PLEASE CHECK FILE')
+            files_to_check.append(result['file'])
+        update_manifest(conn, result['source_path'], result['cfg'], result['output_path'], result['returncode'])
+        key = (result['fingerprint'], result['layout']['template'])
+        if key not in known_layouts:
+            known_layouts[key] = result['layout']
+            save_template(conn, result['fingerprint'], result['header'], result['layout'])
+
+    if args.workers <= 1:
+        for func, file in jobs:
+            file_count += 1
+            try:
+                report(func(file, args.engine, known_layouts, parquet_dir))
+            except Exception as e:
+                print(f'CURRENT FILE: {file.name} FAILED with {e!r}. PLEASE CHECK FILE')
+                files_to_check.append(file.name)
+    else:
+        with ProcessPoolExecutor(max_workers=args.workers, initializer=configure_worker, initargs=instrument.settings()) as executor:
+            futures = {executor.submit(run_job, func, file, args.engine, known_layouts, parquet_dir): file for func, file in jobs}
+            for future in as_completed(futures):
+                file_count += 1
+                try:
+                    report(future.result())
+                except Exception as e:
+                    print(f'CURRENT FILE: {futures[future].name} FAILED with {e!r}. PLEASE CHECK FILE')
+                    files_to_check.append(futures[future].name)
+
+    print('files to check:', files_to_check)
+    print('un-xtab return codes != 0:', failed_files)
+    print('rejected (header does not fit the template):', rejected_files)
+    if parquet_dir is not None:
+        rows, mismatched = check_parquet_dataset(parquet_dir)
+        print(f'parquet dataset {parquet_dir}: {rows:,} rows')
+        if mismatched:
+            # parts of changed files are rewritten above, these are left from files that were removed or failed
+            print('parquet files without PARQUET_SCHEMA, PLEASE CHECK:', [str(f) for f in mismatched])
+    print('stage timings (seconds are summed over the worker processes):')
+    print(instrument.summary())
+    instrument.close()
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
 
 # End of script
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+# Benchmark code_translations.translate_frame (the vectorized part of apply_translations) on synthetic
+# CTD/bottle rows against translating the same rows one at a time with python dict lookups.
+# No database is needed, the translation tables and their keys are generated.
+#
+#   python scripts/benchmarks/apply_translations.py --rows 5000000
+
+import argparse
+import logging
+import sys
+import time
+from pathlib import Path
+
+import polars as pl
+
+sys.path.append(Path(__file__).resolve().parent.parent.as_posix())
+from code_translations import translate_frame  # noqa: E402
+
+SOURCE = "BENCHMARK"
+
+
+def make_translations(n_codes: int):
+    """Translation tables shaped like get_translations output and their get_translation_keys frame"""
+    codes = [f"P{i:04d}" for i in range(n_codes)]
+    translations = {
+        "x_parameter": pl.DataFrame(
+            {
+                "source": SOURCE,
+                "source_parameter": codes,
+                "parameter": [f"parameter_{i}" for i in range(n_codes)],
+                "description": [f"Parameter {i}" for i in range(n_codes)],
+            }
+        ),
+        "x_unit": pl.DataFrame(
+            {
+                "source": SOURCE,
+                "source_unit": ["mg/L", "ug/L", "deg C", "psu", "m"],
+                "unit": ["mg_l", "ug_l", "deg_c", "psu", "m"],
+            }
+        ),
+        # two column key
+        "x_method": pl.DataFrame(
+            {
+                "source": SOURCE,
+                "source_parameter": codes,
+                "source_method": ["CTD"] * n_codes,
+                "method": [f"method_{i % 7}" for i in range(n_codes)],
+            }
+        ),
+    }
+    keys = pl.DataFrame(
+        {
+            "table_name": ["x_parameter", "x_unit", "x_method"],
+            "key_columns": [
+                ["source_parameter"],
+                ["source_unit"],
+                ["source_parameter", "source_method"],
+            ],
+            "value_column": ["parameter", "unit", "method"],
+        }
+    )
+    return translations, keys
+
+
+def make_data(rows: int, n_codes: int) -> pl.DataFrame:
+    """Raw rows, ~1% of them use a parameter code that has no translation"""
+    i = pl.int_range(rows)
+    return pl.select(
+        sample_id=i,
+        Parameter=pl.when(i % 100 == 0)
+        .then(pl.lit("UNKNOWN"))
+        .otherwise(
+            pl.concat_str(pl.lit("P"), (i % n_codes).cast(pl.String).str.zfill(4))
+        ),
+        Unit=pl.lit(pl.Series(["mg/L", "ug/L", "deg C", "psu", "m"])).gather(i % 5),
+        source_method=pl.lit("CTD"),
+        value=i * 0.1,
+    )
+
+
+def translate_rows(data: pl.DataFrame, translations: dict[str, pl.DataFrame]):
+    """Row by row reference: python dict lookups for every row"""
+    parameter = dict(
+        translations["x_parameter"].select("source_parameter", "parameter").iter_rows()
+    )
+    unit = dict(translations["x_unit"].select("source_unit", "unit").iter_rows())
+    method = {
+        (p, m): v
+        for p, m, v in translations["x_method"]
+        .select("source_parameter", "source_method", "method")
+        .iter_rows()
+    }
+    out = []
+    for row in data.iter_rows(named=True):
+        out.append(
+            {
+                **row,
+                "parameter": parameter.get(row["Parameter"]),
+                "unit": unit.get(row["Unit"]),
+                "method": method.get((row["Parameter"], row["source_method"])),
+            }
+        )
+    return pl.DataFrame(out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=5_000_000)
+    parser.add_argument("--codes", type=int, default=500, help="parameter codes")
+    parser.add_argument(
+        "--row-by-row-rows",
+        type=int,
+        default=200_000,
+        help="rows used for the (slow) row by row reference",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO, format="%(message)s")
+
+    translations, keys = make_translations(args.codes)
+    data = make_data(args.rows, args.codes)
+    mapping = {"source_parameter": "Parameter", "source_unit": "Unit"}
+
+    start = time.perf_counter()
+    translated, untranslated = translate_frame(data, translations, keys, mapping)
+    seconds = time.perf_counter() - start
+    logging.info(
+        "translate_frame  %d rows  %.3fs  %.0f rows/s",
+        len(translated),
+        seconds,
+        len(translated) / seconds,
+    )
+    logging.info("untranslated codes:\n%s", untranslated)
+
+    sample = data.head(args.row_by_row_rows)
+    start = time.perf_counter()
+    expected = translate_rows(sample, translations)
+    seconds = time.perf_counter() - start
+    logging.info(
+        "row by row       %d rows  %.3fs  %.0f rows/s",
+        len(sample),
+        seconds,
+        len(sample) / seconds,
+    )
+    same = translated.head(len(sample)).select(expected.columns).equals(expected)
+    logging.info("same result as row by row: %s", same)
+
+
+if __name__ == "__main__":
+    main()
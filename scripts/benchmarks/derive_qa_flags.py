@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+
+# Benchmark deriving detected and qualifiers of a CTD load (content/data-management/qa_flags.py).
+#
+# "case" is the nested CASE of the app.ctd/app.mooring/app.bottle views written as polars when/then
+# on the four flag columns of every row, "bitmask" packs the flags into qa_flags once and looks
+# detected and qualifiers up from it, "lookup" is only the lookup from a stored qa_flags (what a
+# refresh of the views does now), "text" derives qa_flags from result text such as "<0.5" or "1.2 J".
+# Every variant runs in its own python process so the peak RSS reported is for that variant only.
+#
+#   python scripts/benchmarks/derive_qa_flags.py --rows 5000000 --repeat 3
+
+import argparse
+import logging
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+
+from synthetic import EXPORT_DIR, best_of, report, run_child
+
+sys.path.insert(0, str(EXPORT_DIR))
+from qa_flags import (  # noqa: E402
+    QUALIFIER_CODES,
+    detected,
+    qa_flags_from_booleans,
+    qa_flags_from_qualifiers,
+    qualifiers,
+    split_result,
+)
+
+VARIANTS = ("case", "bitmask", "lookup", "text")
+FLAG_COLS = ("undetected", "estimated", "rejected", "greater_than")
+# Share of the rows with each flag set
+FLAG_RATES = (0.02, 0.05, 0.01, 0.005)
+
+
+def make_file(path: Path, rows: int, seed: int = 0) -> Path:
+    """Write a synthetic CTD long table: results, their four flags, the stored qa_flags and the result text"""
+    rng = np.random.default_rng(seed)
+    flags = {col: rng.random(rows) < rate for col, rate in zip(FLAG_COLS, FLAG_RATES)}
+    df = pl.DataFrame(
+        {
+            "location_id": rng.integers(0, 200, rows).astype(str),
+            "depth": rng.integers(0, 300, rows).astype(np.float64),
+            "parameter": rng.choice(["Temperature", "Salinity", "Chlorophyll"], rows),
+            "result": np.round(rng.gamma(2.0, 3.0, rows), 3),
+            **flags,
+        }
+    ).with_columns(
+        qa_flags_from_booleans(*[pl.col(col) for col in FLAG_COLS]).alias("qa_flags")
+    )
+    # the flags as a provider writes them around the number, e.g. "<0.5" or "1.2 J"
+    codes = {"undetected": "<", "estimated": "J", "rejected": "R", "greater_than": "E"}
+    df = df.with_columns(
+        pl.concat_str(
+            pl.when(pl.col("undetected")).then(pl.lit("<")).otherwise(pl.lit("")),
+            pl.col("result").cast(pl.String),
+            *[
+                pl.when(pl.col(col))
+                .then(pl.lit(" " + codes[col]))
+                .otherwise(pl.lit(""))
+                for col in FLAG_COLS[1:]
+            ],
+        ).alias("result_text")
+    )
+    df.write_parquet(path)
+    return path
+
+
+def derive_case(lf: pl.LazyFrame) -> pl.LazyFrame:
+    """detected and qualifiers as the views worked them out, a CASE per flag of every row"""
+    any_flag = pl.any_horizontal(*[pl.col(col) for col in FLAG_COLS])
+    codes = [
+        pl.when(pl.col(col)).then(pl.lit(code)).otherwise(pl.lit(""))
+        for col, code in zip(FLAG_COLS, QUALIFIER_CODES.values())
+    ]
+    return lf.select(
+        (~pl.col("undetected")).alias("detected"),
+        pl.when(any_flag).then(pl.concat_str(codes)).alias("qualifiers"),
+    )
+
+
+def derive_bitmask(lf: pl.LazyFrame) -> pl.LazyFrame:
+    flags = qa_flags_from_booleans(*[pl.col(col) for col in FLAG_COLS])
+    return lf.select(flags.alias("qa_flags")).select(
+        detected(pl.col("qa_flags")), qualifiers(pl.col("qa_flags"))
+    )
+
+
+def derive_lookup(lf: pl.LazyFrame) -> pl.LazyFrame:
+    return lf.select(detected(pl.col("qa_flags")), qualifiers(pl.col("qa_flags")))
+
+
+def derive_text(lf: pl.LazyFrame) -> pl.LazyFrame:
+    flags = qa_flags_from_qualifiers(pl.col("qualifier"))
+    return (
+        split_result(lf, "result_text")
+        .select(flags.alias("qa_flags"))
+        .select(detected(pl.col("qa_flags")), qualifiers(pl.col("qa_flags")))
+    )
+
+
+def run_variant(variant: str, file: Path, out: Path):
+    """Run one variant in this process and print its timing as json"""
+    derive = {
+        "case": derive_case,
+        "bitmask": derive_bitmask,
+        "lookup": derive_lookup,
+        "text": derive_text,
+    }[variant]
+    start = time.perf_counter()
+    df = derive(pl.scan_parquet(file)).collect()
+    seconds = time.perf_counter() - start
+    df.write_parquet(out)
+    report(
+        {
+            "variant": variant,
+            "rows": df.height,
+            "seconds": seconds,
+            "undetected": df.height - int(df["detected"].sum()),
+        }
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--rows",
+        type=int,
+        default=5_000_000,
+        help="rows of the synthetic CTD load (default: 5000000)",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="runs per variant, the fastest is reported",
+    )
+    parser.add_argument("--make", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--variant", choices=VARIANTS, help=argparse.SUPPRESS)
+    parser.add_argument("--file", type=Path, help=argparse.SUPPRESS)
+    parser.add_argument("--out", type=Path, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.make:
+        make_file(args.file, args.rows)
+        return
+    if args.variant:
+        run_variant(args.variant, args.file, args.out)
+        return
+
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO, format="%(message)s")
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        file = tmp / "ctd.parquet"
+        run_child(__file__, "--make", "--file", file, "--rows", args.rows)
+        logging.info(
+            "%s: %d rows, %.1f MB", file.name, args.rows, file.stat().st_size / 1e6
+        )
+
+        outputs = {}
+        for variant in VARIANTS:
+            out = tmp / f"{variant}.parquet"
+            best = best_of(
+                __file__,
+                "--variant",
+                variant,
+                "--file",
+                file,
+                "--out",
+                out,
+                repeat=args.repeat,
+            )
+            outputs[variant] = pl.read_parquet(out)
+            logging.info(
+                "%-8s rows=%d  %.3fs  %.0f rows/s  peak rss %.1f MB",
+                variant,
+                best["rows"],
+                best["seconds"],
+                best["rows"] / best["seconds"],
+                best["peak_rss_mb"],
+            )
+        logging.info(
+            "outputs identical: %s",
+            all(outputs["case"].equals(df) for df in outputs.values()),
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+# Benchmark the CTD export of content/data-management/parquet_export.py with each fetch method:
+#
+#   cursor  the original RealDictCursor path, a python dict per row and a list per column
+#   copy    COPY ... TO STDOUT (FORMAT csv) parsed by pyarrow's streaming CSV reader
+#
+# Needs the database (PG_HOST, PG_DATABASE, PG_USER, PG_PASSWORD, or a .env file like the export).
+# Every method runs in its own python process so the peak RSS reported is for that method only.
+#
+#   python scripts/benchmarks/export_fetch.py --filtered --repeat 1
+
+import argparse
+import logging
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from synthetic import EXPORT_DIR, best_of, report
+
+FETCH_METHODS = ("cursor", "copy")
+
+
+def run_method(fetch: str, outdir: Path, filtered: bool):
+    """Run the CTD export in this process and print its timing as json"""
+    sys.path.insert(0, str(EXPORT_DIR))
+    import parquet_export
+    import pyarrow.parquet as pq
+
+    parquet_export.OUTDIR = outdir
+    start = time.perf_counter()
+    parquet_export.ctd_export(filtered=filtered, fetch=fetch)
+    seconds = time.perf_counter() - start
+    rows = pq.read_metadata(outdir / "CTD" / "_metadata").num_rows
+    report(
+        {
+            "fetch": fetch,
+            "rows": rows,
+            "seconds": seconds,
+            "rows_per_second": rows / seconds,
+        }
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--filtered", action="store_true", help="export only the filtered parameters"
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=1,
+        help="runs per fetch method, the fastest is reported",
+    )
+    parser.add_argument("--fetch", choices=FETCH_METHODS, help=argparse.SUPPRESS)
+    parser.add_argument("--outdir", type=Path, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.fetch:
+        run_method(args.fetch, args.outdir, args.filtered)
+        return
+
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO, format="%(message)s")
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        for fetch in FETCH_METHODS:
+            best = best_of(
+                __file__,
+                "--fetch",
+                fetch,
+                "--outdir",
+                tmp / fetch,
+                *(["--filtered"] if args.filtered else []),
+                repeat=args.repeat,
+            )
+            logging.info(
+                "%-6s rows=%d  %.1fs  %.0f rows/s  peak rss %.1f MB",
+                fetch,
+                best["rows"],
+                best["seconds"],
+                best["rows_per_second"],
+                best["peak_rss_mb"],
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+# Benchmark opening an exported dataset at the start of an analysis notebook session.
+#
+# "parquet" reads the partitioned Parquet dataset like python-analysis.ipynb (ParquetDataset.read),
+# "cache_build" is the first session of a version with content/analysis/arrow_cache.py (converting
+# it to Arrow IPC files), "cache_open" every later session (memory mapping the IPC files) and
+# "cache_polars" a later session scanning them with polars. Every variant then computes the mean
+# result, so only the pages of that column need to be read. Each run is its own python process,
+# like a new notebook kernel, and reports its seconds, peak RSS and the RSS at the end.
+#
+#   python scripts/benchmarks/notebook_startup.py --rows 5000000 --repeat 3
+
+import argparse
+import logging
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import polars as pl
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from synthetic import (
+    REPO_DIR,
+    best_of,
+    export_schema,
+    export_table,
+    report,
+    run_child,
+    write_export_dataset,
+)
+
+sys.path.insert(0, str(REPO_DIR / "content/analysis"))
+import arrow_cache  # noqa: E402
+
+VARIANTS = ("parquet", "cache_build", "cache_open", "cache_polars")
+DATASET = "CTD"
+
+
+def current_rss_mb() -> float:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def run_variant(variant: str, workdir: Path):
+    """Run one variant in this process and print its timing as json"""
+    data_dir = workdir / "data"
+    cache_dir = workdir / "cache"
+    if variant == "cache_build":
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    start = time.perf_counter()
+    if variant == "parquet":
+        table = pq.ParquetDataset(data_dir / DATASET).read()
+        rows, mean = table.num_rows, pc.mean(table["result"]).as_py()
+    elif variant == "cache_polars":
+        df = (
+            arrow_cache.scan(DATASET, data_dir, cache_dir)
+            .select(pl.len(), pl.col("result").mean())
+            .collect()
+        )
+        rows, mean = df.row(0)
+    else:
+        table = arrow_cache.open_table(DATASET, data_dir=data_dir, cache_dir=cache_dir)
+        rows, mean = table.num_rows, pc.mean(table["result"]).as_py()
+    seconds = time.perf_counter() - start
+    report(
+        {
+            "variant": variant,
+            "rows": rows,
+            "mean": mean,
+            "seconds": seconds,
+            "rss_mb": current_rss_mb(),
+        }
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--rows",
+        type=int,
+        default=5_000_000,
+        help="rows of the synthetic CTD dataset (default: 5000000)",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="runs per variant, the fastest is reported",
+    )
+    parser.add_argument("--make", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--variant", choices=VARIANTS, help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", type=Path, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.make:
+        table = export_table(export_schema("ctd"), args.rows)
+        write_export_dataset(table, args.workdir / "data" / DATASET)
+        return
+    if args.variant:
+        run_variant(args.variant, args.workdir)
+        return
+
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO, format="%(message)s")
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        run_child(__file__, "--make", "--workdir", tmp, "--rows", args.rows)
+        size = sum(f.stat().st_size for f in (tmp / "data").rglob("*.parquet"))
+        logging.info("%s: %d rows, %.1f MB of parquet", DATASET, args.rows, size / 1e6)
+
+        means = set()
+        for variant in VARIANTS:
+            best = best_of(
+                __file__, "--variant", variant, "--workdir", tmp, repeat=args.repeat
+            )
+            means.add(round(best["mean"], 9))
+            logging.info(
+                "%-13s rows=%d  %.3fs  peak rss %.1f MB  rss %.1f MB",
+                variant,
+                best["rows"],
+                best["seconds"],
+                best["peak_rss_mb"],
+                best["rss_mb"],
+            )
+        size = sum(f.stat().st_size for f in (tmp / "cache").rglob("*.arrow"))
+        logging.info("cache: %.1f MB of arrow ipc", size / 1e6)
+        logging.info("results identical: %s", len(means) == 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+
+# Benchmark the Salish and export pipelines on synthetic data (see synthetic.py), no database or
+# Salish_Cruises directory is needed:
+#
+#   salish_cfg         header matching, scanning, row counts and cfg files of unxtab_UWSalishData_ZC.py
+#   salish_unxtab      the whole script per file (cfg and native un-xtab into the parquet dataset)
+#   export_copy        copy_batches of parquet_export.py, COPY csv into Arrow record batches
+#   export_cursor      cursor_batches of parquet_export.py, dict rows into Arrow record batches
+#   partitioned_write  PartitionedWriter of parquet_export.py, record batches into the partitioned dataset
+#
+# Every stage runs in its own python process so the peak RSS reported is for that stage only.
+# The results (rows/s, MB/s, peak RSS and files written per stage, with the commit and machine) are
+# written as json to .cache/benchmarks/, --compare prints the change against an earlier results file.
+#
+#   python scripts/benchmarks/pipelines.py --rows 2000000 --salish-rows 200000 --repeat 3
+#   python scripts/benchmarks/pipelines.py --compare .cache/benchmarks/20241001-101500.json
+
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+import pyarrow.parquet as pq
+
+from synthetic import (
+    REPO_DIR,
+    SALISH_DIR,
+    SyntheticConnection,
+    best_of,
+    export_schema,
+    export_table,
+    import_export_module,
+    report,
+    run_child,
+    write_export_source,
+    write_salish_tree,
+)
+
+STAGES = (
+    "salish_cfg",
+    "salish_unxtab",
+    "export_copy",
+    "export_cursor",
+    "partitioned_write",
+)
+EXPORTS = ("ctd", "bottle", "mooring", "species")
+RESULTS_DIR = REPO_DIR / ".cache/benchmarks"
+# Slower (or larger peak RSS) by more than this fraction is reported as a regression
+REGRESSION = 0.10
+
+
+def dir_stats(directory: Path, pattern: str) -> tuple[int, int]:
+    """Number and total size of the files matching pattern under directory"""
+    files = list(directory.rglob(pattern))
+    return len(files), sum(f.stat().st_size for f in files)
+
+
+def run_salish(workdir: Path, cfg_only: bool) -> dict:
+    sys.path.insert(0, str(SALISH_DIR))
+    import unxtab_UWSalishData_ZC as salish
+
+    if cfg_only:
+        # everything up to the cfg file, the un-xtab itself is left out
+        salish.unxtab_file = lambda *args, **kwargs: {"returncode": 0}
+    source = workdir / "salish"
+    parquet_dir = workdir / "salish_parquet"
+    jobs = salish.collect_jobs(source)
+    for func, file in jobs:
+        result = func(file, engine="native", parquet_dir=parquet_dir)
+        if result.get("returncode") != 0:
+            raise RuntimeError(f"{file.name}: {result.get('rejected') or result}")
+    if cfg_only:
+        files, _ = dir_stats(source, "*.cfg")
+    else:
+        files, _ = dir_stats(parquet_dir, "*.parquet")
+    return {"files": files}
+
+
+def run_export(workdir: Path, fetch: str) -> dict:
+    parquet_export = import_export_module()
+    conn = SyntheticConnection(workdir / "source.csv", workdir / "source.parquet")
+    schema = pq.read_schema(workdir / "source.parquet")
+    batches = {
+        "copy": parquet_export.copy_batches,
+        "cursor": parquet_export.cursor_batches,
+    }
+    n_batches = 0
+    for _ in batches[fetch](conn, "SELECT * FROM synthetic", schema):
+        n_batches += 1
+    return {"batches": n_batches, "files": 0}
+
+
+def run_partitioned_write(workdir: Path) -> dict:
+    parquet_export = import_export_module()
+    source = pq.ParquetFile(workdir / "source.parquet")
+    outdir = workdir / "dataset"
+    with parquet_export.PartitionedWriter(
+        outdir,
+        source.schema_arrow,
+        parquet_export.PARTITION_COLS,
+        sorting_columns=parquet_export.SORT_COLS,
+    ) as writer:
+        for batch in source.iter_batches(batch_size=parquet_export.BATCH_SIZE):
+            writer.write_batch(batch)
+    files, size = dir_stats(outdir, "*.parquet")
+    return {"files": files, "output_bytes": size}
+
+
+def run_stage(stage: str, workdir: Path):
+    """Run one stage in this process and print its timing as json"""
+    start = time.perf_counter()
+    if stage in ("salish_cfg", "salish_unxtab"):
+        result = run_salish(workdir, cfg_only=stage == "salish_cfg")
+    elif stage in ("export_copy", "export_cursor"):
+        result = run_export(workdir, stage.split("_")[1])
+    else:
+        result = run_partitioned_write(workdir)
+    result["seconds"] = time.perf_counter() - start
+    report(result)
+
+
+def prepare(workdir: Path, args) -> dict:
+    """Write the synthetic inputs, returns the rows and bytes every stage reads"""
+    salish = write_salish_tree(workdir / "salish", args.salish_rows)
+    table = export_table(export_schema(args.export), args.rows)
+    source = write_export_source(table, workdir)
+    export = {"rows": table.num_rows, "bytes": source["bytes"]}
+    logging.info(
+        "synthetic data: %d salish csvs (%.1f MB), %d %s rows (%.1f MB as csv)",
+        salish["files"],
+        salish["bytes"] / 1e6,
+        table.num_rows,
+        args.export,
+        source["bytes"] / 1e6,
+    )
+    return {
+        "salish_cfg": salish,
+        "salish_unxtab": salish,
+        "export_copy": export,
+        "export_cursor": export,
+        "partitioned_write": export,
+    }
+
+
+def git_commit() -> str | None:
+    proc = subprocess.run(
+        ["git", "rev-parse", "--short", "HEAD"],
+        cwd=REPO_DIR,
+        capture_output=True,
+        text=True,
+    )
+    return proc.stdout.strip() or None
+
+
+def compare(old: dict, new: dict):
+    """Log the change of every stage against an earlier results file"""
+    logging.info("compared with %s (commit %s)", old["created_at"], old.get("commit"))
+    for stage, result in new["stages"].items():
+        before = old["stages"].get(stage)
+        if before is None:
+            continue
+        if before["rows"] != result["rows"]:
+            logging.info("%-18s not comparable, %d rows before", stage, before["rows"])
+            continue
+        speed = result["seconds"] / before["seconds"] - 1
+        rss = result["peak_rss_mb"] / before["peak_rss_mb"] - 1
+        flag = "  REGRESSION" if speed > REGRESSION or rss > REGRESSION else ""
+        logging.info(
+            "%-18s time %+6.1f%%  peak rss %+6.1f%%%s",
+            stage,
+            speed * 100,
+            rss * 100,
+            flag,
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--rows",
+        type=int,
+        default=1_000_000,
+        help="rows of the synthetic export (default: 1000000)",
+    )
+    parser.add_argument(
+        "--salish-rows",
+        type=int,
+        default=100_000,
+        help="data rows per synthetic Salish csv (default: 100000)",
+    )
+    parser.add_argument(
+        "--export",
+        choices=EXPORTS,
+        default="ctd",
+        help="export whose schema the synthetic rows follow (default: ctd)",
+    )
+    parser.add_argument(
+        "--stages",
+        nargs="+",
+        choices=STAGES,
+        default=list(STAGES),
+        help="stages to run (default: all)",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=1,
+        help="runs per stage, the fastest is reported",
+    )
+    parser.add_argument(
+        "--output",
+        type=Path,
+        help="results file (default: .cache/benchmarks/<timestamp>.json)",
+    )
+    parser.add_argument(
+        "--compare", type=Path, help="earlier results file to compare with"
+    )
+    parser.add_argument("--prepare", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--stage", choices=STAGES, help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", type=Path, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.prepare:
+        logging.basicConfig(stream=sys.stderr, level=logging.INFO, format="%(message)s")
+        print(json.dumps(prepare(args.workdir, args)))
+        return
+    if args.stage:
+        run_stage(args.stage, args.workdir)
+        return
+
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO, format="%(message)s")
+    created_at = datetime.now()
+    results = {
+        "created_at": created_at.isoformat(),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "params": {
+            "rows": args.rows,
+            "salish_rows": args.salish_rows,
+            "export": args.export,
+            "repeat": args.repeat,
+        },
+        "stages": {},
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+
+        def clean():
+            # the outputs of the previous run are not reused
+            for path in ("salish_parquet", "dataset"):
+                shutil.rmtree(tmp / path, ignore_errors=True)
+            for cfg in (tmp / "salish").rglob("*.cfg"):
+                cfg.unlink()
+
+        inputs = run_child(
+            __file__,
+            "--prepare",
+            "--workdir",
+            tmp,
+            "--rows",
+            args.rows,
+            "--salish-rows",
+            args.salish_rows,
+            "--export",
+            args.export,
+        )
+        for stage in args.stages:
+            best = best_of(
+                __file__,
+                "--stage",
+                stage,
+                "--workdir",
+                tmp,
+                repeat=args.repeat,
+                setup=clean,
+            )
+            rows, size = inputs[stage]["rows"], inputs[stage]["bytes"]
+            result = {
+                "rows": rows,
+                "bytes": size,
+                "seconds": best["seconds"],
+                "rows_per_second": rows / best["seconds"],
+                "mb_per_second": size / 1e6 / best["seconds"],
+                "peak_rss_mb": best["peak_rss_mb"],
+                "files": best["files"],
+            }
+            results["stages"][stage] = result
+            logging.info(
+                "%-18s rows=%d  %.2fs  %.0f rows/s  %.1f MB/s  peak rss %.1f MB  files=%d",
+                stage,
+                rows,
+                result["seconds"],
+                result["rows_per_second"],
+                result["mb_per_second"],
+                result["peak_rss_mb"],
+                result["files"],
+            )
+
+    output = args.output or RESULTS_DIR / f"{created_at:%Y%m%d-%H%M%S}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=1)
+    logging.info("results written to %s", output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+# Benchmark the Salish CTD metadata step (SECTION 1 of unxtab_UWSalishData_ZC.py).
+#
+# "eager" is the original read_csv / insert_column / strip / head+slice+concat code writing the _m.csv,
+# "lazy" is the scan_csv pipeline used by the script now (literal columns, strip, filter, sink_csv).
+# Every variant runs in its own python process so the peak RSS reported is for that variant only.
+#
+#   python scripts/benchmarks/salish_prepare.py --rows 1000000 --repeat 3
+
+import argparse
+import logging
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import polars as pl
+
+from synthetic import SALISH_DIR, best_of, report
+
+VARIANTS = ("eager", "lazy")
+
+sys.path.insert(0, str(SALISH_DIR))
+from unxtab_UWSalishData_ZC import (  # noqa: E402
+    ROW_INDEX,
+    add_metadata_columns,
+    count_rows,
+    filter_data_rows,
+    scan_source,
+    sink_csv,
+)
+
+
+def make_file(path: Path, rows: int) -> Path:
+    """Write a synthetic pre 2016 downcast csv: 2 units/status rows, then data rows with ~1% 'None' stations"""
+    header = "Cruise,Station,Date,Time,Lat,Lon,Bottle,Pressure,Depth,Temperature,Salinity,Oxygen,Fluorescence\n"
+    units = "-,-,-,-,-,-,-,db,m,C,psu,mg/L,ug/L\n"
+    status = "-,-,-,-,-,-,-,raw,raw,ok,ok,ok,ok\n"
+    with open(path, "w") as f:
+        f.write(header + units + status)
+        for i in range(rows):
+            station = "None" if i % 100 == 0 else f" S{i % 40} "
+            f.write(
+                f"C1,{station},2010-01-01,12:00,48.1,-122.4,{i % 24},{i % 200},{i % 200}.5,"
+                f"10.{i % 10},30.{i % 7},8.{i % 9},1.{i % 5}\n"
+            )
+    return path
+
+
+def prepare_eager(file: Path, out: Path):
+    curr_df = pl.read_csv(file)
+    cast_type = "downcast"
+    curr_df = curr_df.insert_column(
+        0, pl.Series("cast_type", [cast_type] * len(curr_df))
+    )
+    curr_df = curr_df.insert_column(
+        0, pl.Series("source_filename", [file.name] * len(curr_df))
+    )
+    curr_df = curr_df.insert_column(
+        0, pl.Series("source_path", [str(file)] * len(curr_df))
+    )
+    curr_df = curr_df.rename({col: col.strip() for col in curr_df.columns})
+    curr_df = curr_df.with_columns(
+        [pl.col(col).str.strip_chars().alias(col) for col in curr_df.columns]
+    )
+    metadata_rows = curr_df.head(2)
+    curr_df = curr_df.slice(2)
+    curr_df = curr_df.filter(pl.col("Station") != "None")
+    curr_df = pl.concat([metadata_rows, curr_df])
+    n_rows = len(curr_df)
+    curr_df.write_csv(out)
+    return n_rows
+
+
+def prepare_lazy(file: Path, out: Path):
+    curr_lf = scan_source(file)
+    curr_lf = curr_lf.rename(
+        {col: col.strip() for col in curr_lf.collect_schema().names()}
+    )
+    curr_lf = curr_lf.with_columns(pl.exclude(ROW_INDEX).str.strip_chars())
+    curr_lf = filter_data_rows(curr_lf, pl.col("Station") != "None", n_metadata_rows=2)
+    curr_lf = add_metadata_columns(curr_lf, file)
+    n_rows = count_rows(curr_lf)
+    sink_csv(curr_lf, out)
+    return n_rows
+
+
+def run_variant(variant: str, file: Path, out: Path):
+    """Run one variant in this process and print its timing as json"""
+    start = time.perf_counter()
+    n_rows = {"eager": prepare_eager, "lazy": prepare_lazy}[variant](file, out)
+    seconds = time.perf_counter() - start
+    report({"variant": variant, "rows": n_rows, "seconds": seconds})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--rows", type=int, default=1_000_000, help="data rows in the synthetic csv"
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="runs per variant, the fastest is reported",
+    )
+    parser.add_argument(
+        "--file", type=Path, help="benchmark an existing csv instead of a synthetic one"
+    )
+    parser.add_argument("--variant", choices=VARIANTS, help=argparse.SUPPRESS)
+    parser.add_argument("--out", type=Path, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.variant:
+        run_variant(args.variant, args.file, args.out)
+        return
+
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO, format="%(message)s")
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        file = (
+            args.file.resolve()
+            if args.file
+            else make_file(tmp / "Jan2010_downcast.csv", args.rows)
+        )
+        logging.info("%s: %.1f MB", file.name, file.stat().st_size / 1e6)
+
+        outputs = {}
+        for variant in VARIANTS:
+            out = tmp / f"{variant}_m.csv"
+            best = best_of(
+                __file__,
+                "--variant",
+                variant,
+                "--file",
+                file,
+                "--out",
+                out,
+                repeat=args.repeat,
+            )
+            outputs[variant] = out.read_bytes()
+            logging.info(
+                "%-6s rows=%d  %.3fs  peak rss %.1f MB",
+                variant,
+                best["rows"],
+                best["seconds"],
+                best["peak_rss_mb"],
+            )
+        logging.info("outputs identical: %s", outputs["eager"] == outputs["lazy"])
+
+
+if __name__ == "__main__":
+    main()
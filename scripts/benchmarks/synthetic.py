@@ -0,0 +1,446 @@
+#!/usr/bin/env python
+
+# Synthetic inputs and the child process runner of the benchmarks in scripts/benchmarks/, no
+# database or Salish_Cruises directory is needed:
+#
+#   write_salish_tree    a Salish_Cruises like directory with upcast/downcast csvs in each template of
+#                        unxtab_UWSalishData_ZC.py (section1, section2_downcast, section2_upcast)
+#   export_schema        the schema an export function of parquet_export.py writes
+#   export_table         rows of an export schema with realistic providers, years, locations and
+#                        parameters
+#   write_export_source  the rows as COPY ... TO STDOUT (FORMAT csv) writes them and as parquet
+#   write_export_dataset the rows as the partitioned dataset (with _metadata) of an export
+#   SyntheticConnection  a stand-in for the psycopg2 connection of copy_batches and cursor_batches,
+#                        reading what write_export_source wrote
+#   run_child, best_of   run a benchmark script again in a new python process (e.g. with --variant)
+#                        and read the json it prints with report
+
+import json
+import os
+import resource
+import subprocess
+import sys
+from collections.abc import Callable
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+
+REPO_DIR = Path(__file__).resolve().parents[2]
+EXPORT_DIR = REPO_DIR / "content/data-management"
+SALISH_DIR = REPO_DIR / "content/data-management/studies/uw-salish-cruises"
+
+#### SALISH CTD CSVS ####
+
+# Columns before the pressure column, pressure is column 11, 14 and 17 of the metadata version of
+# the file (source_path, source_filename and cast_type are added in front)
+SALISH_TEMPLATES = {
+    "section1": {
+        "leading": ["Cruise", "Station", "Date", "Time", "Lat", "Lon", "Bottle"],
+        "pressure": "Pressure",
+        "depth": "Depth",
+        "values": ["Temperature", "Salinity", "Oxygen", "Fluorescence"],
+        # units and status rows between the header and the data
+        "metadata_rows": [
+            ["db", "m", "C", "psu", "mg/L", "ug/L"],
+            ["raw", "raw", "ok", "ok", "ok", "ok"],
+        ],
+        "station": "Station",
+    },
+    "section2_downcast": {
+        "leading": [
+            "Cruise",
+            "Station",
+            "Cast",
+            "Date",
+            "Time",
+            "Latitude",
+            "Longitude",
+            "Bottom Depth",
+            "Instrument",
+            "Scan",
+        ],
+        "pressure": "prDM: Pressure  Digiquartz",
+        "depth": "depSM: Depth salt water m",
+        "values": [
+            "t090C: Temperature ITS-90",
+            "sal00: Salinity Practical",
+            "sbeox0Mg/L: Oxygen SBE 43",
+            "flECO-AFL: Fluorescence",
+            "par: PAR/Irradiance",
+            "CStarTr0: Beam Transmission",
+        ],
+        "metadata_rows": [["db", "m", "deg C", "PSU", "mg/l", "mg/m^3", "uE", "%"]],
+        "station": "Station",
+    },
+    "section2_upcast": {
+        "leading": [
+            "EXPOCODE",
+            "SECT_ID",
+            "STNNBR",
+            "STATION_NO",
+            "CASTNO",
+            "SAMPNO",
+            "BTLNBR",
+            "DATE",
+            "TIME",
+            "LATITUDE",
+            "LONGITUDE",
+            "DEPTH_BOTTOM",
+            "INSTRUMENT",
+        ],
+        "pressure": "CTDPRS_DBAR",
+        "depth": "CTDDEPTH_M",
+        # pressure + 47 is the last flag/comment row header of the template
+        "values": [f"VAR{i}" for i in range(1, 47)],
+        "metadata_rows": [],
+        "station": "STATION_NO",
+    },
+}
+
+
+def salish_header(template: str) -> list[str]:
+    rules = SALISH_TEMPLATES[template]
+    return rules["leading"] + [rules["pressure"], rules["depth"]] + rules["values"]
+
+
+def write_salish_csv(path: Path, template: str, rows: int, seed: int = 0) -> int:
+    """Write one upcast/downcast csv in a template, returns its size in bytes
+
+    About 1% of the data rows have the station "None" (dropped by the script) and the cells are
+    padded with spaces (stripped by the script) like the source files.
+    """
+    rules = SALISH_TEMPLATES[template]
+    rng = np.random.default_rng(seed)
+    n_leading = len(rules["leading"])
+    n_values = len(rules["values"])
+    station_col = rules["leading"].index(rules["station"])
+
+    i = np.arange(rows)
+    pressure = (i % 200).astype(str)
+    depth = np.char.add((i % 200).astype(str), ".5")
+    values = np.round(rng.normal(10, 3, (rows, n_values)), 4).astype(str)
+    leading = np.empty((rows, n_leading), dtype=object)
+    for col, name in enumerate(rules["leading"]):
+        leading[:, col] = f"{name[:3]}{seed}"
+    station = np.char.add(" S", (i % 40).astype(str))
+    station = np.where(i % 100 == 0, "None", station)
+    leading[:, station_col] = station
+
+    lines = [",".join(salish_header(template))]
+    padding = ["-"] * n_leading
+    lines.extend(",".join(padding + row) for row in rules["metadata_rows"])
+    cells = np.column_stack([leading, pressure, depth, values])
+    lines.extend(",".join(row) for row in cells.tolist())
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    return path.stat().st_size
+
+
+def write_salish_tree(directory: Path, rows: int, cruises: int = 2) -> dict:
+    """A Salish_Cruises like directory: per cruise an upcast and a downcast csv in each section
+
+    Pre 2016 cruises are section1 csvs, 2016+ cruises are section2 csvs (the form the script reads
+    when no workbook is in the folder). Returns the number of files, data rows and bytes written.
+    """
+    files = rows_written = size = 0
+    for k in range(cruises):
+        for year, templates in (
+            (2010 + k, {"downcast": "section1", "upcast": "section1"}),
+            (
+                2016 + k,
+                {"downcast": "section2_downcast", "upcast": "section2_upcast"},
+            ),
+        ):
+            folder = directory / f"Salish-{year}_Data"
+            for cast, template in templates.items():
+                size += write_salish_csv(
+                    folder / f"Jan{year}_{cast}.csv", template, rows, seed=files
+                )
+                files += 1
+                rows_written += rows
+    return {"files": files, "rows": rows_written, "bytes": size}
+
+
+#### EXPORT ROWS ####
+
+PROVIDERS = [
+    "King County",
+    "Washington Department of Ecology",
+    "University of Washington",
+    "Puget Sound Partnership",
+    "NOAA",
+]
+PARAMETERS = [
+    "Chlorophyll",
+    "Chlorophyll Fluorescence",
+    "Turbidity",
+    "Beam Transmission",
+    "Temperature",
+    "Salinity",
+    "Dissolved Oxygen",
+    "Nitrate",
+    "Phosphate",
+    "Silicate",
+    "Ammonium",
+    "pH",
+]
+UNITS = ["ug/L", "mg/L", "NTU", "%", "deg C", "PSU", "uM", "pH units"]
+
+
+def import_export_module():
+    """parquet_export imported without a database, the PG_* settings are only checked at import"""
+    for key in ("PG_HOST", "PG_DATABASE", "PG_USER", "PG_PASSWORD"):
+        os.environ.setdefault(key, "synthetic")
+    sys.path.insert(0, str(EXPORT_DIR))
+    import parquet_export
+
+    return parquet_export
+
+
+def export_schema(export: str = "ctd") -> pa.Schema:
+    """The schema that <export>_export of parquet_export.py passes to postgres_to_parquet"""
+    captured = {}
+
+    def capture(dataset_name, sql, schema, **options):
+        captured["schema"] = schema
+
+    parquet_export = import_export_module()
+    original = parquet_export.postgres_to_parquet
+    parquet_export.postgres_to_parquet = capture
+    try:
+        getattr(parquet_export, f"{export}_export")()
+    finally:
+        parquet_export.postgres_to_parquet = original
+    return captured["schema"]
+
+
+def _column(name: str, type_: pa.DataType, rows: int, rng) -> pa.Array:
+    """Generic values for a column without a generator in export_table, ~5% nulls"""
+    nulls = rng.random(rows) < 0.05
+    if pa.types.is_floating(type_):
+        return pa.array(rng.normal(10, 5, rows), type_, mask=nulls)
+    if pa.types.is_integer(type_):
+        return pa.array(rng.integers(0, 5000, rows), type_, mask=nulls)
+    if pa.types.is_boolean(type_):
+        return pa.array(rng.random(rows) < 0.9, type_, mask=nulls)
+    if pa.types.is_timestamp(type_):
+        seconds = rng.integers(946_684_800, 1_704_067_200, rows)
+        return pa.array(seconds * 1_000_000, pa.int64(), mask=nulls).cast(type_)
+    # dictionary columns get a few values, plain text columns a few thousand
+    distinct = 20 if pa.types.is_dictionary(type_) else 5000
+    values = pa.array([f"{name}_{k}" for k in range(distinct)])
+    strings = values.take(pa.array(rng.integers(0, distinct, rows))).to_numpy(
+        zero_copy_only=False
+    )
+    return pa.array(strings, pa.string(), mask=nulls).cast(type_)
+
+
+def export_table(schema: pa.Schema, rows: int, seed: int = 0) -> pa.Table:
+    """Rows for an export schema, sorted by location_id and sample_date like the export queries
+
+    Providers, years (1999-2023, ~0.5% without a sample date), locations (40 per provider),
+    parameters and units follow the shape of the views, the other columns get generic values.
+    """
+    rng = np.random.default_rng(seed)
+    provider = np.array(PROVIDERS)[
+        rng.choice(len(PROVIDERS), rows, p=[0.4, 0.3, 0.15, 0.1, 0.05])
+    ]
+    provider_key = np.char.replace(provider, " ", "_")
+    location = np.char.add(
+        np.char.add(provider_key, "-"), rng.integers(0, 40, rows).astype(str)
+    )
+    no_date = rng.random(rows) < 0.005
+    seconds = rng.integers(915_148_800, 1_704_067_200, rows)
+    sample_date = pa.array(seconds * 1_000_000, pa.int64(), mask=no_date).cast(
+        pa.timestamp("us")
+    )
+    columns = {
+        "provider": pa.array(provider),
+        "provider_key": pa.array(provider_key),
+        "location_id": pa.array(location),
+        "sample_date": sample_date,
+        "year": pc.year(sample_date).cast(pa.int32()),
+        "parameter": pa.array(
+            np.array(PARAMETERS)[rng.integers(0, len(PARAMETERS), rows)]
+        ),
+        "analyte_name": pa.array(
+            np.array(PARAMETERS)[rng.integers(0, len(PARAMETERS), rows)]
+        ),
+        "units": pa.array(np.array(UNITS)[rng.integers(0, len(UNITS), rows)]),
+        "area_id": pa.array(
+            np.char.add("AREA-", rng.integers(0, 12, rows).astype(str))
+        ),
+        # mostly unflagged, then undetected, estimated, both, rejected and greater than
+        "qa_flags": pa.array(
+            rng.choice(
+                [0, 1, 2, 3, 4, 8], rows, p=[0.9, 0.05, 0.03, 0.01, 0.005, 0.005]
+            )
+        ),
+    }
+    arrays = []
+    for field in schema:
+        if field.name in columns:
+            arrays.append(columns[field.name].cast(field.type))
+        else:
+            arrays.append(_column(field.name, field.type, rows, rng))
+    table = pa.Table.from_arrays(arrays, schema=schema)
+    return table.sort_by(
+        [("location_id", "ascending"), ("sample_date", "ascending")],
+        null_placement="at_end",
+    )
+
+
+def write_export_source(table: pa.Table, directory: Path) -> dict:
+    """Write the rows as COPY (FORMAT csv, HEADER true) output and as parquet
+
+    In the csv NULL is an empty field, strings are quoted (so an empty string is "") and booleans
+    are t/f like PostgreSQL writes them. Returns the paths and the csv size.
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+    csv_table = pa.table(
+        {
+            field.name: (
+                pc.if_else(column, "t", "f")
+                if pa.types.is_boolean(field.type)
+                else (
+                    column.cast(pa.string())
+                    if pa.types.is_dictionary(field.type)
+                    else column
+                )
+            )
+            for field, column in zip(table.schema, table.columns)
+        }
+    )
+    csv_path = directory / "source.csv"
+    parquet_path = directory / "source.parquet"
+    pacsv.write_csv(csv_table, csv_path)
+    pq.write_table(table, parquet_path)
+    return {"csv": csv_path, "parquet": parquet_path, "bytes": csv_path.stat().st_size}
+
+
+def write_export_dataset(
+    table: pa.Table, directory: Path, created_at: str = "2024-01-01T00:00:00"
+) -> dict:
+    """Write the rows as the partitioned dataset postgres_to_parquet writes, with its _metadata
+
+    created_at is stored in the schema metadata like the export does. Returns the rows and the
+    size of the files.
+    """
+    parquet_export = import_export_module()
+    schema = table.schema.with_metadata({"created_at": created_at})
+    with parquet_export.PartitionedWriter(
+        directory,
+        schema,
+        parquet_export.PARTITION_COLS,
+        sorting_columns=parquet_export.SORT_COLS,
+    ) as writer:
+        for batch in table.to_batches(parquet_export.BATCH_SIZE):
+            writer.write_batch(batch)
+    pq.write_metadata(
+        writer.file_schema,
+        directory / "_metadata",
+        metadata_collector=writer.metadata_collector,
+    )
+    size = sum(f.stat().st_size for f in directory.rglob("*.parquet"))
+    return {"rows": table.num_rows, "bytes": size}
+
+
+class SyntheticConnection:
+    """Enough of a psycopg2 connection for copy_batches and cursor_batches of parquet_export.py
+
+    copy_expert streams the COPY csv written by write_export_source, a named (server side) cursor
+    returns the parquet rows as one dict per row like RealDictCursor. The query text is ignored,
+    every query returns all the rows.
+    """
+
+    def __init__(self, csv_path: Path, parquet_path: Path):
+        self.csv_path = Path(csv_path)
+        self.parquet_path = Path(parquet_path)
+
+    def cursor(self, name=None, cursor_factory=None):
+        return SyntheticCursor(self)
+
+    def close(self):
+        pass
+
+
+class SyntheticCursor:
+    def __init__(self, conn: SyntheticConnection):
+        self.conn = conn
+        self.rows = iter(())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def execute(self, sql, params=None):
+        batches = pq.ParquetFile(self.conn.parquet_path).iter_batches(batch_size=10_000)
+        self.rows = (row for batch in batches for row in batch.to_pylist())
+
+    def fetchmany(self, size):
+        rows = []
+        for row in self.rows:
+            rows.append(row)
+            if len(rows) == size:
+                break
+        return rows
+
+    def copy_expert(self, sql, file, size=1 << 20):
+        with open(self.conn.csv_path, "rb") as f:
+            while chunk := f.read(size):
+                file.write(chunk)
+
+
+#### CHILD PROCESSES ####
+
+# Every benchmark run is its own python process so the peak RSS reported is for that run only. The
+# inputs are written by a child process too, the peak RSS of a process is inherited by the
+# processes it starts.
+
+
+def report(result: dict):
+    """Print the result of a run as json with the peak RSS of this process, for run_child"""
+    # ru_maxrss is KiB on linux
+    result["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(json.dumps(result))
+
+
+def run_child(script: str | Path, *args) -> dict | None:
+    """Run a python script with args in a new process, returns the last json line it printed
+
+    None when it printed nothing. stderr is not captured, so its logging and errors are shown.
+    """
+    proc = subprocess.run(
+        [sys.executable, str(script), *[str(arg) for arg in args]],
+        stdout=subprocess.PIPE,
+        text=True,
+        check=True,
+    )
+    lines = proc.stdout.strip().splitlines()
+    return json.loads(lines[-1]) if lines else None
+
+
+def best_of(
+    script: str | Path, *args, repeat: int = 1, setup: Callable | None = None
+) -> dict:
+    """The fastest of repeat run_child runs, with the largest peak RSS (and RSS) of all of them
+
+    setup is called before every run, e.g. to remove the outputs of the previous one.
+    """
+    runs = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        runs.append(run_child(script, *args))
+    best = dict(min(runs, key=lambda r: r["seconds"]))
+    for key in ("peak_rss_mb", "rss_mb"):
+        if key in best:
+            best[key] = max(r[key] for r in runs)
+    return best
@@ -1,123 +1,394 @@
+import hashlib
+import json
 import logging
 import os
+import re
+from contextlib import closing
+from functools import lru_cache
+from pathlib import Path
 
 import polars as pl
+import psycopg2
 
 URI = f'postgresql://{os.getenv("POSTGRES_USER")}:{os.getenv("POSTGRES_PASSWORD")}@{os.getenv("POSTGRES_HOST")}:{os.getenv("POSTGRES_PORT")}/{os.getenv("POSTGRES_DATABASE")}'
 
+# Translations are cached on disk per source as Arrow IPC files, set TRANSLATIONS_CACHE_DIR to move the cache.
+CACHE_DIR = Path(
+    os.getenv(
+        "TRANSLATIONS_CACHE_DIR",
+        Path(__file__).resolve().parent.parent / ".cache" / "translations",
+    )
+)
 
-def get_translations(xlate_source: str) -> dict[str, pl.DataFrame]:
-    logging.info("Querying translations for source %s", xlate_source)
-    translations = {}
-    for xtable in (
-        pl.read_database_uri(
-            """
-            select
-                table_name
-            from information_schema.tables
-            where
-                1=1
-                and table_type = 'BASE TABLE'
-                and table_schema = 'gsidb'
-                and table_name like 'x_%'
-            """,
-            URI,
-            engine="connectorx",
+# One row per x table that has a foreign key to an e table: the first such foreign key,
+# the x table primary key columns and the foreign table columns (minus "rev_time" and "rev_user").
+CATALOG_QUERY = """
+    with xtables as (
+        select
+            table_name
+        from information_schema.tables
+        where
+            1=1
+            and table_type = 'BASE TABLE'
+            and table_schema = 'gsidb'
+            and table_name like 'x_%'
+    ),
+    fks as (
+        select distinct on (kcu.table_name)
+            kcu.table_name,
+            kcu.column_name,
+            ccu.table_name AS foreign_table_name,
+            ccu.column_name AS foreign_column_name
+        FROM
+            information_schema.table_constraints AS tc
+            JOIN information_schema.key_column_usage AS kcu
+            ON tc.constraint_name = kcu.constraint_name
+            JOIN information_schema.constraint_column_usage AS ccu
+            ON ccu.constraint_name = tc.constraint_name
+        WHERE
+            constraint_type = 'FOREIGN KEY'
+            AND left(ccu.table_name, 2) = 'e_'
+        order by kcu.table_name, tc.constraint_name
+    ),
+    pks as (
+        SELECT
+            tc.table_name,
+            string_agg('x.' || kcu.column_name, ',' order by kcu.ordinal_position) as pk_cols
+        FROM
+            information_schema.table_constraints AS tc
+            JOIN information_schema.key_column_usage AS kcu
+            ON tc.constraint_name = kcu.constraint_name
+        WHERE
+            tc.constraint_type = 'PRIMARY KEY'
+        group by tc.table_name
+    ),
+    cols as (
+        select
+            table_name,
+            string_agg('f.' || column_name, ',' order by ordinal_position) as cols
+        from information_schema.columns
+        where table_schema = 'gsidb'
+        and column_name not in ('rev_time', 'rev_user')
+        group by table_name
+    )
+    select
+        xtables.table_name,
+        fks.column_name,
+        fks.foreign_table_name,
+        fks.foreign_column_name,
+        pks.pk_cols,
+        cols.cols as vv_cols
+    from
+        xtables
+        inner join fks on fks.table_name = xtables.table_name
+        inner join pks on pks.table_name = xtables.table_name
+        inner join cols on cols.table_name = fks.foreign_table_name
+    order by xtables.table_name
+"""
+
+
+def get_translation_catalog(conn) -> pl.DataFrame:
+    """Foreign key, primary key and foreign table columns of every x table in one query"""
+    return pl.read_database(CATALOG_QUERY, conn)
+
+
+def get_tables_with_source(conn, xtables: list[str], xlate_source: str) -> list[str]:
+    """The x tables that have translations for the source, checked in one UNION ALL query"""
+    if not xtables:
+        return []
+    query = "\nunion all\n".join(
+        "select '%s' as table_name where exists (select 1 from %s where source = %%(source)s)"
+        % (xtable, xtable)
+        for xtable in xtables
+    )
+    return (
+        pl.read_database(
+            query, conn, execute_options={"parameters": {"source": xlate_source}}
         )
         .to_series()
         .to_list()
+    )
+
+
+def get_translation_fingerprint(conn, catalog: pl.DataFrame, xlate_source: str) -> str:
+    """Cheap fingerprint of everything the translations are built from, in one UNION ALL query
+
+    Row count and checksum of the source's rows in each x table and of each foreign e table,
+    plus a checksum of the x and e table columns so new tables or column changes are noticed.
+    """
+    parts = [
+        """
+        select
+            'information_schema.columns' as name,
+            count(*) as n,
+            sum(hashtext(table_name || '.' || column_name || '.' || data_type)) as checksum
+        from information_schema.columns
+        where
+            table_schema = 'gsidb'
+            and (table_name like 'x_%%' or table_name like 'e_%%')
+        """
+    ]
+    for xtable in catalog["table_name"].to_list():
+        parts.append(
+            "select '%s', count(*), sum(hashtext(x::text)) from %s as x where x.source = %%(source)s"
+            % (xtable, xtable)
+        )
+    for ftable in catalog["foreign_table_name"].unique().sort().to_list():
+        parts.append(
+            "select '%s', count(*), sum(hashtext(f::text)) from %s as f"
+            % (ftable, ftable)
+        )
+    fingerprint = pl.read_database(
+        "\nunion all\n".join(parts),
+        conn,
+        execute_options={"parameters": {"source": xlate_source}},
+    )
+    return hashlib.sha256(fingerprint.sort("name").write_csv().encode()).hexdigest()
+
+
+def cache_path(xlate_source: str) -> Path:
+    return CACHE_DIR / re.sub(r"[^\w.-]", "_", xlate_source)
+
+
+def read_cached_translations(xlate_source: str):
+    """(fingerprint, catalog, translations) from the disk cache, None if the source is not cached"""
+    path = cache_path(xlate_source)
+    try:
+        manifest = json.loads((path / "manifest.json").read_text())
+        catalog = pl.read_ipc(path / "catalog.arrow", memory_map=False)
+        translations = {
+            xtable: pl.read_ipc(path / f"{xtable}.arrow", memory_map=False)
+            for xtable in manifest["tables"]
+        }
+    except (OSError, ValueError, KeyError):
+        return None
+    return manifest["fingerprint"], catalog, translations
+
+
+def write_cached_translations(
+    xlate_source: str,
+    fingerprint: str,
+    catalog: pl.DataFrame,
+    translations: dict[str, pl.DataFrame],
+):
+    """Write the translations to the disk cache, the manifest is written last so a partial cache is never read"""
+    path = cache_path(xlate_source)
+    path.mkdir(parents=True, exist_ok=True)
+    (path / "manifest.json").unlink(missing_ok=True)
+    for stale in path.glob("*.arrow"):
+        stale.unlink()
+    catalog.write_ipc(path / "catalog.arrow")
+    for xtable, df in translations.items():
+        df.write_ipc(path / f"{xtable}.arrow")
+    (path / "manifest.json").write_text(
+        json.dumps({"fingerprint": fingerprint, "tables": list(translations)})
+    )
+
+
+def query_translations(
+    conn, catalog: pl.DataFrame, xlate_source: str
+) -> dict[str, pl.DataFrame]:
+    """Join every x table that has translations for the source with its foreign table"""
+    translations = {}
+    xtables = get_tables_with_source(
+        conn, catalog["table_name"].to_list(), xlate_source
+    )
+    for xtable in catalog.filter(pl.col("table_name").is_in(xtables)).iter_rows(
+        named=True
     ):
-        # Get translations for the x table
-        xlates = pl.read_database_uri(
-            "select * from %s where source = '%s'" % (xtable, xlate_source),
-            URI,
-            engine="connectorx",
+        # Join the x table with the foreign table
+        # This produces a table with all source translations and their valid value definition.
+        df = pl.read_database(
+            """
+            select
+                %s,
+                %s
+            from
+                %s as x
+                inner join %s as f on x.%s = f.%s
+            where x.source = %%(source)s
+            order by %s
+            """
+            % (
+                xtable["pk_cols"],
+                xtable["vv_cols"],
+                xtable["table_name"],
+                xtable["foreign_table_name"],
+                xtable["foreign_column_name"],
+                xtable["column_name"],
+                xtable["pk_cols"],
+            ),
+            conn,
+            execute_options={"parameters": {"source": xlate_source}},
         )
-        if not xlates.is_empty():
-            # Get the foreign keys for the x table
-            fk = pl.read_database_uri(
-                """
-                select
-                    kcu.table_schema,
-                    tc.constraint_name,
-                    kcu.table_name,
-                    kcu.column_name,
-                    ccu.table_name AS foreign_table_name,
-                    ccu.column_name AS foreign_column_name
-                FROM
-                    information_schema.table_constraints AS tc
-                    JOIN information_schema.key_column_usage AS kcu
-                    ON tc.constraint_name = kcu.constraint_name
-                    JOIN information_schema.constraint_column_usage AS ccu
-                    ON ccu.constraint_name = tc.constraint_name
-                WHERE
-                    constraint_type = 'FOREIGN KEY'
-                    AND tc.table_name = '%s'
-                    AND left(ccu.table_name, 2) = 'e_'
-                """
-                % (xtable),
-                URI,
-                engine="connectorx",
-            )
-            if not fk.is_empty():
-                # Get the primary keys for the x table
-                pk_cols = pl.read_database_uri(
-                    """
-                    SELECT
-                        string_agg('x.' || kcu.column_name, ',') as pk_cols
-                    FROM
-                        information_schema.table_constraints AS tc
-                        JOIN information_schema.key_column_usage AS kcu
-                        ON tc.constraint_name = kcu.constraint_name
-                    WHERE
-                        tc.constraint_type = 'PRIMARY KEY'
-                        AND tc.table_name = '%s'
-                    """
-                    % (xtable),
-                    URI,
-                    engine="connectorx",
-                )["pk_cols"][0]
-                # Get all the columns for the foreign table, minus the columns "rev_time" and "rev_user"
-                vv_cols = pl.read_database_uri(
-                    """
-                    select string_agg('f.' || column_name, ',' order by ordinal_position) as cols
-                    from information_schema.columns
-                    where table_name = '%s'
-                    and table_schema = 'gsidb'
-                    and column_name not in ('rev_time', 'rev_user')
-                """
-                    % (fk["foreign_table_name"][0]),
-                    URI,
-                    engine="connectorx",
-                )["cols"][0]
-                # Join the x table with the foreign table
-                # This produces a table with all source translations and their valid value definition.
-                df = pl.read_database_uri(
-                    """
-                    select
-                        %s,
-                        %s
-                    from
-                        %s as x
-                        inner join %s as f on x.%s = f.%s
-                    where x.source = '%s'
-                    order by %s
-                    """
-                    % (
-                        pk_cols,
-                        vv_cols,
-                        xtable,
-                        fk["foreign_table_name"][0],
-                        fk["foreign_column_name"][0],
-                        fk["column_name"][0],
-                        xlate_source,
-                        pk_cols,
-                    ),
-                    URI,
-                    engine="connectorx",
-                )
+        logging.info(
+            "Found %s translations for table %s" % (df.shape[0], xtable["table_name"])
+        )
+        translations[xtable["table_name"]] = df
+    return translations
+
+
+@lru_cache(maxsize=32)
+def _get_translations(
+    xlate_source: str,
+) -> tuple[pl.DataFrame, dict[str, pl.DataFrame]]:
+    logging.info("Querying translations for source %s", xlate_source)
+    # All queries go through one connection. When the fingerprint of the cached catalog still
+    # matches, the translations come from the disk cache and the catalog and joins are skipped.
+    with closing(psycopg2.connect(URI)) as conn:
+        cached = read_cached_translations(xlate_source)
+        if cached is not None:
+            fingerprint, catalog, translations = cached
+            if get_translation_fingerprint(conn, catalog, xlate_source) == fingerprint:
                 logging.info(
-                    "Found %s translations for table %s" % (df.shape[0], xtable)
+                    "Translations for source %s are unchanged, using the cache in %s",
+                    xlate_source,
+                    cache_path(xlate_source),
                 )
-                translations[xtable] = df
-    return translations
+                return catalog, translations
+        catalog = get_translation_catalog(conn)
+        fingerprint = get_translation_fingerprint(conn, catalog, xlate_source)
+        translations = query_translations(conn, catalog, xlate_source)
+    write_cached_translations(xlate_source, fingerprint, catalog, translations)
+    return catalog, translations
+
+
+def get_translations(
+    xlate_source: str, refresh: bool = False
+) -> dict[str, pl.DataFrame]:
+    """Translations for a source keyed by x table, cached in process and on disk
+
+    refresh=True drops the cached copies and queries everything again.
+    """
+    if refresh:
+        _get_translations.cache_clear()
+        (cache_path(xlate_source) / "manifest.json").unlink(missing_ok=True)
+    return dict(_get_translations(xlate_source)[1])
+
+
+def get_translation_keys(xlate_source: str) -> pl.DataFrame:
+    """How each translation table for a source is applied to raw data
+
+    One row per x table returned by get_translations: the key_columns to join the raw data on
+    (the x table primary key without "source") and the value_column of the foreign e table that
+    holds the translated value.
+    """
+    catalog, translations = _get_translations(xlate_source)
+    return catalog.filter(pl.col("table_name").is_in(list(translations))).select(
+        "table_name",
+        pl.col("pk_cols")
+        .str.split(",")
+        .list.eval(pl.element().str.strip_prefix("x."))
+        .list.eval(pl.element().filter(pl.element() != "source"))
+        .alias("key_columns"),
+        pl.col("foreign_column_name").alias("value_column"),
+    )
+
+
+def translate_frame(
+    data: pl.DataFrame | pl.LazyFrame,
+    translations: dict[str, pl.DataFrame],
+    keys: pl.DataFrame,
+    mapping: dict[str, str] | None = None,
+):
+    """Apply translation tables to raw data as left hash joins, see apply_translations
+
+    keys is a get_translation_keys frame for the translations.
+    """
+    mapping = mapping or {}
+    lf = data.lazy()
+    columns = lf.collect_schema()
+    # (table_name, raw data columns, column flagging the rows the table translated)
+    applied = []
+    for table_name, key_columns, value_column in keys.iter_rows():
+        # key columns of the translation table and the raw data columns they are matched with
+        data_columns = [mapping.get(key, key) for key in key_columns]
+        if not key_columns or any(col not in columns for col in data_columns):
+            logging.info(
+                "Skipping %s, the data has no %s column(s)"
+                % (table_name, ", ".join(data_columns))
+            )
+            continue
+        matched = f"__translated_{table_name}"
+        lookup = translations[table_name].select(
+            *key_columns, value_column, pl.lit(True).alias(matched)
+        )
+        join_keys = [f"__{table_name}_{key}" for key in key_columns]
+        lf = (
+            lf.with_columns(
+                # cast the raw codes to the translation key types so e.g. integer codes match text keys
+                pl.col(col).cast(lookup.schema[key], strict=False).alias(join_key)
+                for col, key, join_key in zip(data_columns, key_columns, join_keys)
+            )
+            .join(
+                lookup.rename(dict(zip(key_columns, join_keys))).lazy(),
+                on=join_keys,
+                how="left",
+                suffix="_translated",
+            )
+            .drop(join_keys)
+        )
+        applied.append((table_name, data_columns, matched))
+
+    def untranslated_codes(joined: pl.LazyFrame) -> pl.LazyFrame:
+        checks = [
+            joined.filter(
+                pl.all_horizontal(pl.col(data_columns).is_not_null())
+                & pl.col(matched).is_null()
+            )
+            .group_by(data_columns)
+            .agg(pl.len().alias("n_rows"))
+            .select(
+                pl.lit(table_name).alias("table_name"),
+                pl.lit(",".join(data_columns)).alias("columns"),
+                pl.concat_str(
+                    pl.col(data_columns).cast(pl.String), separator=","
+                ).alias("code"),
+                "n_rows",
+            )
+            for table_name, data_columns, matched in applied
+        ]
+        if not checks:
+            return pl.LazyFrame(
+                schema={
+                    "table_name": pl.String,
+                    "columns": pl.String,
+                    "code": pl.String,
+                    "n_rows": pl.UInt32,
+                }
+            )
+        return pl.concat(checks).sort("table_name", "code")
+
+    matched_columns = [matched for _, _, matched in applied]
+    if isinstance(data, pl.LazyFrame):
+        return lf.drop(matched_columns), untranslated_codes(lf)
+    # join once, the untranslated codes are counted from the joined rows
+    joined = lf.collect()
+    return (
+        joined.drop(matched_columns),
+        untranslated_codes(joined.lazy()).collect(),
+    )
+
+
+def apply_translations(
+    data: pl.DataFrame | pl.LazyFrame,
+    xlate_source: str,
+    mapping: dict[str, str] | None = None,
+):
+    """Translate raw source data with every translation table of the source in one pass
+
+    Each translation table is left joined on its key columns (see get_translation_keys) and adds
+    its value column, suffixed "_translated" if the data already has a column with that name.
+    mapping renames key columns to the raw data columns they are found in, e.g.
+    {"source_parameter": "Parameter"}. Tables whose key columns are not in the data are skipped.
+
+    Returns (translated, untranslated), untranslated has one row per code that is in the data but
+    has no translation: table_name, columns, code and n_rows. DataFrame input is collected in one
+    go, LazyFrame input returns two LazyFrames.
+    """
+    return translate_frame(
+        data,
+        get_translations(xlate_source),
+        get_translation_keys(xlate_source),
+        mapping,
+    )
@@ -3,17 +3,39 @@
 # This script generates the region pages for the inventory section of the website.
 # The output of this script is not rendered in the final website, but is used as input.
 
+import argparse
 import logging
 import os
 import re
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 from pathlib import Path
 
 import jinja2
 import polars as pl
+import psycopg2
+
+sys.path.append(Path(__file__).resolve().parent.parent.as_posix())
+import rollup  # noqa: E402
+
+parser = argparse.ArgumentParser(description="Generate the region inventory pages")
+parser.add_argument(
+    "--regions",
+    nargs="+",
+    help="only generate the pages of these regions (area_id or page slug, e.g. Global)",
+)
+parser.add_argument(
+    "--workers",
+    type=int,
+    default=os.cpu_count(),
+    help="threads used to render the pages",
+)
+args = parser.parse_args()
 
 # https://quarto.org/docs/projects/scripts.html#pre-and-post-render
-if not os.getenv("QUARTO_PROJECT_RENDER_ALL"):
+# Running the script by hand with --regions works outside of a full render
+if not os.getenv("QUARTO_PROJECT_RENDER_ALL") and not args.regions:
     exit()
 
 # Configure logging to print to stdout
@@ -48,7 +70,7 @@ regions = {
     region: re.sub(r"\W+", "-", region.lower().strip())
     for region in (
         pl.read_database_uri(
-            "select area_id from d_area order by area_id;",  # limit 1;", 
+            "select area_id from d_area order by area_id;",  # limit 1;",
             uri,
             engine="connectorx",
         )
@@ -61,6 +83,16 @@ regions = {
 region_order = {region: i + 1 for i, region in enumerate(sorted(regions.keys()))}
 regions["Global"] = "global"
 
+if args.regions:
+    unknown = set(args.regions) - set(regions) - set(regions.values())
+    if unknown:
+        parser.error(f"unknown regions: {', '.join(sorted(unknown))}")
+    regions = {
+        region: region_slug
+        for region, region_slug in regions.items()
+        if region in args.regions or region_slug in args.regions
+    }
+
 
 # Generate data type/grouping tuples (e.g. "(Bottle: ChlorophyllA)", or "(CTD, Temperature)")
 # using the groupings.csv file.
@@ -73,15 +105,89 @@ groupings = [
 ]
 
 
-# Render the region pages
-for region, region_slug in regions.items():
-    logging.info(f"Generating region page for {region}")
-    with open(Path(workdir, f"{region_slug}.qmd"), "w") as f:
-        f.write(
-            template.render(
-                region=region,
-                region_slug=region_slug,
-                groupings=groupings,
-                order=0 if region_slug == "global" else region_order[region],
-            )
+# Measurement counts of every region x grouping come from the rollup cube (scripts/rollup.py),
+# which is brought up to date first. That only reads the catalog unless a view was refreshed since
+# the last run, and then only newly loaded or changed studies are queried.
+logging.info("Updating the inventory rollup in %s", rollup.ROLLUP_DIR)
+with closing(psycopg2.connect(uri)) as conn:
+    rollup.update(conn)
+grouping_sources = pl.read_csv(Path(workdir, "groupings.csv"))
+missing = grouping_sources.join(
+    pl.DataFrame(rollup.SOURCES).select("table", "parameter_col"),
+    on=["table", "parameter_col"],
+    how="anti",
+)
+if not missing.is_empty():
+    raise ValueError(
+        f"groupings.csv uses table/parameter_col pairs that are not in rollup.SOURCES:\n{missing}"
+    )
+counts = (
+    rollup.read_cube()
+    .drop("data_type")
+    .join(grouping_sources.lazy(), on=["table", "parameter_col", "parameter"])
+    .group_by("data_type", "parameter", "area_id", "provider", "year")
+    .agg(pl.col("n_measurements").sum())
+    .collect()
+)
+logging.info("Read %s count rows from the rollup cube", counts.height)
+
+
+def region_counts(region: str) -> dict:
+    """Counts for one region page
+
+    totals: measurement count per (data_type, parameter) grouping
+    providers: the "Data By Provider" rows per grouping as a json array, None when there are none
+    """
+    area = [] if region == "Global" else ["area_id"]
+    data = counts if region == "Global" else counts.filter(pl.col("area_id") == region)
+    data = (
+        data.group_by(["data_type", "parameter", *area, "provider", "year"])
+        .agg(pl.col("n_measurements").sum())
+        .sort(["year", "provider"], nulls_last=True)
+    )
+    totals = {}
+    providers = {}
+    for data_type, parameter, *_ in groupings:
+        group = data.filter(
+            (pl.col("data_type") == data_type) & (pl.col("parameter") == parameter)
+        ).select(*area, "provider", "parameter", "year", "n_measurements")
+        totals[(data_type, parameter)] = int(group["n_measurements"].sum())
+        providers[(data_type, parameter)] = (
+            None if group.is_empty() else group.write_json()
         )
+    return {"totals": totals, "providers": providers}
+
+
+def render_region(region: str, region_slug: str) -> bool:
+    """Render a region page and write it only if it differs from the page on disk
+
+    Leaving unchanged pages untouched keeps Quarto's freeze from re-executing them.
+    Returns True when the page was written.
+    """
+    path = Path(workdir, f"{region_slug}.qmd")
+    page = template.render(
+        region=region,
+        region_slug=region_slug,
+        groupings=groupings,
+        order=0 if region_slug == "global" else region_order[region],
+        **region_counts(region),
+    )
+    if path.exists() and path.read_text() == page:
+        return False
+    path.write_text(page)
+    return True
+
+
+# Render the region pages
+logging.info(
+    f"Generating {len(regions)} region pages with {args.workers} worker threads"
+)
+with ThreadPoolExecutor(max_workers=args.workers) as pool:
+    written = dict(
+        zip(regions, pool.map(render_region, regions.keys(), regions.values()))
+    )
+for region, changed in written.items():
+    logging.info(f"{region}: {'written' if changed else 'unchanged'}")
+logging.info(
+    f"Wrote {sum(written.values())} of {len(written)} region pages, the rest are unchanged"
+)
@@ -0,0 +1,468 @@
+#!/usr/bin/env python
+
+# Incremental rollup of the app.* materialized views for the inventory pages and the summary export.
+#
+# The store lives in ROLLUP_DIR (default .cache/rollup at the repository root):
+#
+#   cube.parquet     measurement counts by data_type, table, parameter_col, provider, study_id,
+#                    area_id, parameter and year
+#   summary.parquet  app.summary_expanded rows (document, years, units and result percentiles by
+#                    provider, data_type and parameter)
+#   studies.parquet  row count and checksum per table and study_id the store was built from
+#   versions.parquet oid, file node and modification count per view the store was built from
+#
+# Every run first reads the version of each view from the catalog, which is cheap. A view is created
+# again or refreshed when studies are loaded (see scripts/sql/), both give it a new file node, so a run
+# with no load in between reads nothing else. Only the views that changed are counted and checksummed
+# per study (the sum of the hashes of the rows, like the partition checksums of parquet_export.py).
+# Only studies that are new, changed or removed are queried again for the cube, and only the
+# (data_type, provider, parameter) groups those studies touch are recomputed for the summary.
+# --full rebuilds everything.
+#
+#   python scripts/rollup.py [--full]
+
+import argparse
+import logging
+import os
+import sys
+from contextlib import closing
+from pathlib import Path
+
+import polars as pl
+import psycopg2
+
+URI = f'postgresql://{os.getenv("POSTGRES_USER")}:{os.getenv("POSTGRES_PASSWORD")}@{os.getenv("POSTGRES_HOST")}:{os.getenv("POSTGRES_PORT")}/{os.getenv("POSTGRES_DATABASE")}'
+
+ROLLUP_DIR = Path(
+    os.getenv(
+        "ROLLUP_DIR",
+        Path(__file__).resolve().parent.parent / ".cache" / "rollup",
+    )
+)
+
+# The rollups kept in the cube. parameter is the sql expression reported as "parameter",
+# summary marks the rollups that make up app.summary / app.summary_expanded (see scripts/sql/).
+# A table can be rolled up on more than one parameter column, the region pages group app.bottle
+# on analyte (see content/inventory/regions/groupings.csv) while the summary uses analyte_name.
+SOURCES = [
+    {
+        "data_type": "Bottle",
+        "table": "app.bottle",
+        "parameter_col": "analyte_name",
+        "parameter": "analyte_name",
+        "summary": True,
+    },
+    {
+        "data_type": "Bottle",
+        "table": "app.bottle",
+        "parameter_col": "analyte",
+        "parameter": "analyte",
+        "summary": False,
+    },
+    {
+        "data_type": "Species Abundance/Biovolume/Community",
+        "table": "app.sp_abund",
+        "parameter_col": "parameter - species",
+        "parameter": "parameter || ' - ' || species",
+        "summary": True,
+    },
+    {
+        "data_type": "CTD",
+        "table": "app.ctd",
+        "parameter_col": "parameter",
+        "parameter": "parameter",
+        "summary": True,
+    },
+    {
+        "data_type": "Mooring",
+        "table": "app.mooring",
+        "parameter_col": "parameter",
+        "parameter": "parameter",
+        "summary": True,
+    },
+]
+
+STUDIES_SCHEMA = {
+    "table": pl.String,
+    "study_id": pl.String,
+    "n_rows": pl.Int64,
+    "checksum": pl.Int64,
+}
+VERSIONS_SCHEMA = {
+    "table": pl.String,
+    "oid": pl.Int64,
+    "filenode": pl.Int64,
+    "n_modified": pl.Int64,
+}
+CUBE_SCHEMA = {
+    "data_type": pl.String,
+    "table": pl.String,
+    "parameter_col": pl.String,
+    "provider": pl.String,
+    "study_id": pl.String,
+    "area_id": pl.String,
+    "parameter": pl.String,
+    "year": pl.Int32,
+    "n_measurements": pl.Int64,
+}
+# Column order of app.summary_expanded
+SUMMARY_SCHEMA = {
+    "provider": pl.String,
+    "data_type": pl.String,
+    "document_title": pl.String,
+    "document_files": pl.String,
+    "years_sampled": pl.String,
+    "coll_scheme": pl.String,
+    "parameter": pl.String,
+    "units": pl.String,
+    "n_measurements": pl.Int64,
+    "min": pl.Float64,
+    "max": pl.Float64,
+    "25th_percentile": pl.Float64,
+    "median": pl.Float64,
+    "75th_percentile": pl.Float64,
+}
+
+CUBE_QUERY = """
+    select
+        provider,
+        study_id::text as study_id,
+        area_id,
+        %(parameter)s as parameter,
+        extract(year from sample_date)::int as year,
+        count(*) as n_measurements
+    from %(table)s
+    where %(where)s
+    group by
+        provider, study_id, area_id, %(parameter)s, extract(year from sample_date)
+"""
+
+# One data type of scripts/sql/summary_expanded.sql
+SUMMARY_QUERY = """
+    select
+        provider,
+        sampdocs.document_title,
+        sampdocs.files as document_files,
+        string_agg(
+            distinct extract(year from sample_date)::text,
+            '; ' order by extract(year from sample_date)::text
+        ) as years_sampled,
+        string_agg(
+            distinct coll_scheme, '; ' order by coll_scheme
+        ) as coll_scheme,
+        %(parameter)s as parameter,
+        string_agg(
+            distinct units, '; ' order by units
+        ) as units,
+        count(*) as n_measurements,
+        min(result) as "min",
+        max(result) as "max",
+        PERCENTILE_CONT(0.25) WITHIN GROUP(ORDER BY result) as "25th_percentile",
+        PERCENTILE_CONT(0.5) WITHIN GROUP(ORDER BY result) as "median",
+        PERCENTILE_CONT(0.75) WITHIN GROUP(ORDER BY result) as "75th_percentile"
+    from %(table)s as s
+    left join (
+        select
+            sd.study_id, sd.sample_id,
+            df.document_title, df.files
+        from d_sampdoc as sd
+        left join (
+            select
+                doc.doc_id,
+                doc.title as document_title,
+                string_agg(distinct f.original_filename, '; ' order by f.original_filename) as files
+            from d_document as doc
+            left join d_docfile as docf on doc.doc_id=docf.doc_id
+            left join d_file as f on docf.filename=f.filename
+            group by
+                doc.doc_id, doc.title
+        ) as df on sd.doc_id=df.doc_id
+    ) as sampdocs on s.study_id=sampdocs.study_id and s.sample_id=sampdocs.sample_id
+    where %(where)s
+    group by
+        provider,
+        %(parameter)s,
+        sampdocs.document_title,
+        sampdocs.files
+"""
+
+
+def query_versions(conn) -> pl.DataFrame:
+    """Catalog version of every table in SOURCES, without reading any of their rows
+
+    A drop and create gives the view a new oid and a plain refresh a new file node. A concurrent
+    refresh keeps both but updates the rows, which shows in the inserted, updated and deleted
+    tuple counts (a reset of the statistics only causes one needless check of the studies).
+    """
+    tables = sorted({source["table"] for source in SOURCES})
+    query = "\nunion all\n".join(
+        """select '%s' as "table", oid::bigint as oid,
+            pg_relation_filenode(oid)::bigint as filenode,
+            pg_stat_get_tuples_inserted(oid) + pg_stat_get_tuples_updated(oid)
+                + pg_stat_get_tuples_deleted(oid) as n_modified
+        from (select '%s'::regclass::oid as oid) as t"""
+        % (table, table)
+        for table in tables
+    )
+    return pl.read_database(query, conn, schema_overrides=VERSIONS_SCHEMA).cast(
+        VERSIONS_SCHEMA
+    )
+
+
+def query_studies(conn, tables: list[str] | None = None) -> pl.DataFrame:
+    """Row count and checksum per study of the tables in SOURCES (all by default), in one UNION ALL query
+
+    The checksum is the sum of the hashes of the rows, so any changed, added or removed row of a
+    study changes it, even when its row count stays the same.
+    """
+    if tables is None:
+        tables = sorted({source["table"] for source in SOURCES})
+    query = "\nunion all\n".join(
+        """select '%s' as "table", study_id::text as study_id, count(*) as n_rows,
+            sum(hashtext(t::text)) as checksum
+        from %s as t group by study_id"""
+        % (table, table)
+        for table in tables
+    )
+    return pl.read_database(query, conn, schema_overrides=STUDIES_SCHEMA).cast(
+        STUDIES_SCHEMA
+    )
+
+
+def query_cube(conn, source: dict, study_ids: list[str] | None = None) -> pl.DataFrame:
+    """Cube rows of one source, limited to the given studies unless study_ids is None"""
+    where = "1=1" if study_ids is None else "study_id::text = any(%(study_ids)s)"
+    df = pl.read_database(
+        CUBE_QUERY
+        % {"table": source["table"], "parameter": source["parameter"], "where": where},
+        conn,
+        execute_options={"parameters": {"study_ids": study_ids}},
+    )
+    return df.select(
+        pl.lit(source["data_type"]).alias("data_type"),
+        pl.lit(source["table"]).alias("table"),
+        pl.lit(source["parameter_col"]).alias("parameter_col"),
+        *df.columns,
+    ).cast(CUBE_SCHEMA)
+
+
+def query_summary(
+    conn, source: dict, groups: pl.DataFrame | None = None
+) -> pl.DataFrame:
+    """app.summary_expanded rows of one source, limited to the (provider, parameter) groups unless groups is None"""
+    # "is not distinct from" so groups with a null provider or parameter are matched too
+    where = (
+        "1=1"
+        if groups is None
+        else """exists (
+            select 1
+            from unnest(%%(providers)s::text[], %%(parameters)s::text[]) as g(g_provider, g_parameter)
+            where g_provider is not distinct from s.provider and g_parameter is not distinct from %s
+        )"""
+        % source["parameter"]
+    )
+    parameters = {}
+    if groups is not None:
+        parameters = {
+            "providers": groups["provider"].to_list(),
+            "parameters": groups["parameter"].to_list(),
+        }
+    df = pl.read_database(
+        SUMMARY_QUERY
+        % {"table": source["table"], "parameter": source["parameter"], "where": where},
+        conn,
+        execute_options={"parameters": parameters},
+    )
+    return df.with_columns(data_type=pl.lit(source["data_type"])).select(
+        [pl.col(name).cast(dtype) for name, dtype in SUMMARY_SCHEMA.items()]
+    )
+
+
+def read_store(name: str, schema: dict) -> pl.DataFrame:
+    path = ROLLUP_DIR / f"{name}.parquet"
+    if not path.exists():
+        return pl.DataFrame(schema=schema)
+    return pl.read_parquet(path)
+
+
+def write_store(name: str, df: pl.DataFrame):
+    """Replace a store file, written to a temporary file first so readers never see a partial file"""
+    path = ROLLUP_DIR / f"{name}.parquet"
+    tmp = path.with_suffix(".parquet.tmp")
+    df.write_parquet(tmp, compression="zstd")
+    tmp.replace(path)
+
+
+def update(conn, full: bool = False) -> pl.DataFrame:
+    """Bring the rollup store up to date with the database, returns the studies that were refreshed
+
+    The studies of a view are only counted and checksummed when its catalog version changed since
+    the last update. The studies and versions files are written last, an interrupted update is redone
+    on the next run.
+    """
+    ROLLUP_DIR.mkdir(parents=True, exist_ok=True)
+    versions = query_versions(conn)
+    known = (
+        pl.DataFrame(schema=STUDIES_SCHEMA)
+        if full
+        else read_store("studies", STUDIES_SCHEMA)
+    )
+    if known.columns != list(STUDIES_SCHEMA):
+        # written before the studies had checksums, rebuilt from scratch
+        known = pl.DataFrame(schema=STUDIES_SCHEMA)
+    full = full or known.is_empty()
+    known_versions = (
+        pl.DataFrame(schema=VERSIONS_SCHEMA)
+        if full
+        else read_store("versions", VERSIONS_SCHEMA)
+    )
+    if known_versions.columns != list(VERSIONS_SCHEMA):
+        known_versions = pl.DataFrame(schema=VERSIONS_SCHEMA)
+    tables = versions.join(
+        known_versions, on=list(VERSIONS_SCHEMA), how="anti", join_nulls=True
+    )["table"].to_list()
+    if not tables:
+        logging.info("Rollup in %s is up to date", ROLLUP_DIR)
+        return pl.DataFrame(schema={"table": pl.String, "study_id": pl.String})
+    logging.info("Checking the studies of %s", ", ".join(tables))
+
+    # New or changed (row count or checksum) studies, and studies that are gone, of the views that
+    # changed. The studies of the other views are kept as they are.
+    studies = query_studies(conn, tables)
+    known_tables = known.filter(pl.col("table").is_in(tables))
+    changed = pl.concat(
+        [
+            studies.join(
+                known_tables, on=["table", "study_id", "n_rows", "checksum"], how="anti"
+            ),
+            known_tables.join(studies, on=["table", "study_id"], how="anti"),
+        ]
+    ).select("table", "study_id")
+    studies = pl.concat([known.filter(~pl.col("table").is_in(tables)), studies])
+    if changed.is_empty():
+        logging.info("Rollup in %s is up to date", ROLLUP_DIR)
+        write_store("versions", versions)
+        return changed
+    logging.info(
+        "Refreshing the rollup for %s studies%s",
+        changed.height,
+        " (full rebuild)" if full else "",
+    )
+
+    cube = pl.DataFrame(schema=CUBE_SCHEMA) if full else read_store("cube", CUBE_SCHEMA)
+    summary = read_store("summary", SUMMARY_SCHEMA)
+    stale = cube.join(changed, on=["table", "study_id"], how="semi")
+    cube = cube.join(changed, on=["table", "study_id"], how="anti")
+
+    fresh = []
+    for source in SOURCES:
+        study_ids = changed.filter(pl.col("table") == source["table"])[
+            "study_id"
+        ].to_list()
+        if full or study_ids:
+            fresh.append(query_cube(conn, source, None if full else study_ids))
+    fresh = pl.concat(fresh)
+    cube = pl.concat([cube, fresh]).sort(
+        "table", "parameter_col", "provider", "study_id", "area_id", "parameter", "year"
+    )
+
+    # Summary groups that lost or gained rows are recomputed, the rest are kept as they are
+    touched = (
+        pl.concat([stale, fresh])
+        .select("data_type", "table", "parameter_col", "provider", "parameter")
+        .unique()
+    )
+    parts = []
+    for source in SOURCES:
+        if not source["summary"]:
+            continue
+        if full:
+            parts.append(query_summary(conn, source))
+            continue
+        groups = touched.filter(
+            (pl.col("table") == source["table"])
+            & (pl.col("parameter_col") == source["parameter_col"])
+        )
+        if groups.is_empty():
+            continue
+        summary = summary.join(
+            groups.select("data_type", "provider", "parameter"),
+            on=["data_type", "provider", "parameter"],
+            how="anti",
+            join_nulls=True,
+        )
+        parts.append(query_summary(conn, source, groups))
+    summary = pl.concat(
+        [pl.DataFrame(schema=SUMMARY_SCHEMA) if full else summary, *parts]
+    ).sort("provider", "data_type", "document_title", "parameter", nulls_last=True)
+
+    write_store("cube", cube)
+    write_store("summary", summary)
+    write_store("studies", studies)
+    write_store("versions", versions)
+    logging.info(
+        "Wrote %s cube rows and %s summary rows to %s",
+        cube.height,
+        summary.height,
+        ROLLUP_DIR,
+    )
+    return changed
+
+
+def read_cube() -> pl.LazyFrame:
+    """Measurement counts by data_type, table, parameter_col, provider, study_id, area_id, parameter and year"""
+    return pl.scan_parquet(ROLLUP_DIR / "cube.parquet")
+
+
+def read_summary_expanded() -> pl.DataFrame:
+    """The app.summary_expanded rows"""
+    return pl.read_parquet(ROLLUP_DIR / "summary.parquet")
+
+
+def read_summary() -> pl.DataFrame:
+    """The app.summary rows, aggregated from the cube"""
+    summary_sources = pl.DataFrame(
+        [source for source in SOURCES if source["summary"]]
+    ).select("table", "parameter_col")
+    return (
+        read_cube()
+        .join(summary_sources.lazy(), on=["table", "parameter_col"])
+        .group_by("provider", "data_type", "parameter")
+        .agg(
+            years_sampled=pl.col("year")
+            .drop_nulls()
+            .unique()
+            .sort()
+            .cast(pl.String)
+            .str.join("; "),
+            n_measurements=pl.col("n_measurements").sum(),
+        )
+        .with_columns(
+            years_sampled=pl.when(pl.col("years_sampled") != "").then("years_sampled")
+        )
+        .select("provider", "data_type", "years_sampled", "parameter", "n_measurements")
+        .sort("provider", "data_type", "parameter", nulls_last=True)
+        .collect()
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Update the inventory rollup store from the project database"
+    )
+    parser.add_argument(
+        "--full", action="store_true", help="rebuild the store from scratch"
+    )
+    args = parser.parse_args()
+    logging.basicConfig(
+        stream=sys.stdout,
+        level=logging.INFO,
+        format="[%(asctime)s] %(message)s",
+        datefmt="%Y-%m-%d %I:%M:%S",
+    )
+    with closing(psycopg2.connect(URI)) as conn:
+        update(conn, full=args.full)
+
+
+if __name__ == "__main__":
+    main()
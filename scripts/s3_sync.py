@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+
+# Sync a local folder of Parquet datasets (e.g. phyto-indicator-data) with an S3 prefix.
+#
+# Both sides are listed once. The remote objects come from list_objects_v2 (size and ETag), the
+# local files from their stat and a manifest kept next to the folder (<folder>.s3-manifest.json)
+# with the size, mtime and ETag of every file, so a file is only hashed again after it changed.
+# A file is transferred only when its size or ETag differs from the other side, unchanged
+# partitions are never sent again. Transfers run on a pool of --workers threads, files larger than
+# --multipart-threshold MB are transferred in --multipart-chunksize MB parts, --part-workers parts
+# of a file at a time.
+#
+#   python scripts/s3_sync.py upload phyto-indicator-data phyto-indicator --prefix data/
+#   python scripts/s3_sync.py download local-dir phyto-indicator --prefix data/
+#
+# --delete also removes what is no longer on the source side. --endpoint-url points the client at
+# another S3 implementation, e.g. a moto server or MinIO for testing.
+
+import argparse
+import hashlib
+import json
+import logging
+import math
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+
+MB = 1024 * 1024
+
+WORKERS = 8
+PART_WORKERS = 4
+# boto3's defaults, so the ETags of files uploaded by s3.ipynb match without a transfer
+MULTIPART_THRESHOLD = 8
+MULTIPART_CHUNKSIZE = 8
+# Part sizes in MB tried for objects uploaded with another part size: the S3 minimum and
+# common choices of other tools
+COMMON_PART_SIZES = [5, 8, 16, 32, 64, 100, 128]
+
+REGION = "us-west-2"
+
+
+def manifest_path(local_dir: Path) -> Path:
+    return local_dir.with_name(local_dir.name + ".s3-manifest.json")
+
+
+def read_manifest(local_dir: Path) -> dict:
+    """Relative path -> {"size", "mtime_ns", "etags": {part size: ETag}} of the local files"""
+    path = manifest_path(local_dir)
+    if not path.exists():
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(local_dir: Path, manifest: dict):
+    """Replace the manifest, written to a temporary file first so it is never left partial"""
+    path = manifest_path(local_dir)
+    tmp = path.with_suffix(".json.tmp")
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    tmp.replace(path)
+
+
+def file_etag(path: Path, part_size: int) -> str:
+    """The ETag S3 gives the file when it is uploaded in parts of part_size bytes
+
+    A part_size of 0 is a single part upload, the ETag is the md5 of the file. A multipart
+    ETag is the md5 of the md5s of the parts followed by the number of parts.
+    """
+    if part_size == 0:
+        md5 = hashlib.md5()
+        with open(path, "rb") as f:
+            while chunk := f.read(MB):
+                md5.update(chunk)
+        return md5.hexdigest()
+    digests = []
+    with open(path, "rb") as f:
+        while chunk := f.read(part_size):
+            digests.append(hashlib.md5(chunk).digest())
+    return f"{hashlib.md5(b''.join(digests)).hexdigest()}-{len(digests)}"
+
+
+def etag_part_sizes(size: int, etag: str | None, config: TransferConfig) -> list[int]:
+    """Part sizes to hash a file with to compare it to an ETag, 0 is a single part
+
+    Without an ETag it is the part size an upload with config uses. A multipart ETag only
+    tells the number of parts, the part sizes that give that many parts are tried: the
+    configured one, COMMON_PART_SIZES and the smallest whole MB.
+    """
+    if etag is None:
+        return [config.multipart_chunksize if size >= config.multipart_threshold else 0]
+    if "-" not in etag:
+        return [0]
+    parts = int(etag.rsplit("-", 1)[1])
+    sizes = [
+        config.multipart_chunksize,
+        *(n * MB for n in COMMON_PART_SIZES),
+        math.ceil(size / parts / MB) * MB,
+    ]
+    return list(dict.fromkeys(s for s in sizes if math.ceil(size / s) == parts))
+
+
+def list_local(local_dir: Path) -> dict[str, os.stat_result]:
+    """stat of every file in the folder, by path relative to the folder"""
+    files = {}
+    for root, _, names in os.walk(local_dir):
+        for name in names:
+            path = Path(root) / name
+            files[path.relative_to(local_dir).as_posix()] = path.stat()
+    return files
+
+
+def list_remote(s3_client, bucket: str, prefix: str) -> dict[str, dict]:
+    """Size and ETag of every object under the prefix, by key relative to the prefix"""
+    objects = {}
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            if obj["Key"].endswith("/"):
+                continue
+            objects[obj["Key"][len(prefix) :]] = {
+                "size": obj["Size"],
+                "etag": obj["ETag"].strip('"'),
+            }
+    return objects
+
+
+def local_etag(
+    manifest: dict,
+    local_dir: Path,
+    name: str,
+    stat: os.stat_result,
+    remote_etag: str | None,
+    config: TransferConfig,
+) -> str | None:
+    """ETag of a local file comparable to remote_etag, from the manifest while the file is unchanged
+
+    None when no part size gives the number of parts of remote_etag.
+    """
+    entry = manifest.get(name)
+    if (
+        entry is None
+        or entry["size"] != stat.st_size
+        or entry["mtime_ns"] != stat.st_mtime_ns
+    ):
+        entry = manifest[name] = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "etags": {},
+        }
+    etag = None
+    for part_size in etag_part_sizes(stat.st_size, remote_etag, config):
+        if str(part_size) not in entry["etags"]:
+            entry["etags"][str(part_size)] = file_etag(local_dir / name, part_size)
+        etag = entry["etags"][str(part_size)]
+        if etag == remote_etag:
+            break
+    return etag
+
+
+def sync(
+    s3_client,
+    direction: str,
+    local_dir: Path,
+    bucket: str,
+    prefix: str = "",
+    workers: int = WORKERS,
+    config: TransferConfig | None = None,
+    delete: bool = False,
+) -> dict[str, int]:
+    """Upload or download the files whose size or ETag differ between local_dir and the prefix
+
+    Returns the number of files transferred, skipped and deleted.
+    """
+    config = config or TransferConfig()
+    local_dir = Path(local_dir)
+    local_dir.mkdir(parents=True, exist_ok=True)
+    manifest = read_manifest(local_dir)
+    local = list_local(local_dir)
+    remote = list_remote(s3_client, bucket, prefix)
+    # Entries of files that are gone would only grow the manifest
+    for name in set(manifest) - set(local):
+        del manifest[name]
+
+    if direction == "upload":
+        source, target = local, remote
+    else:
+        source, target = remote, local
+    transfers = []
+    skipped = 0
+    for name in sorted(source):
+        if name in local and name in remote:
+            stat = local[name]
+            etag = remote[name]["etag"]
+            if stat.st_size == remote[name]["size"] and etag == local_etag(
+                manifest, local_dir, name, stat, etag, config
+            ):
+                skipped += 1
+                continue
+        transfers.append(name)
+    deletes = sorted(set(target) - set(source)) if delete else []
+    logging.info(
+        f"{direction}: {len(transfers)} to transfer, {skipped} unchanged"
+        + (f", {len(deletes)} to delete" if delete else "")
+    )
+
+    def transfer(name: str) -> str:
+        path = local_dir / name
+        key = prefix + name
+        if direction == "upload":
+            s3_client.upload_file(
+                Filename=str(path), Bucket=bucket, Key=key, Config=config
+            )
+        else:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            s3_client.download_file(
+                Bucket=bucket, Key=key, Filename=str(path), Config=config
+            )
+        return name
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(transfer, name) for name in transfers]
+            try:
+                for i, future in enumerate(as_completed(futures), 1):
+                    name = future.result()
+                    # Both sides now hold the same bytes, remember the ETag without hashing
+                    # a download again (an upload was hashed when it was compared, or is now)
+                    stat = (local_dir / name).stat()
+                    if direction == "download":
+                        etag = remote[name]["etag"]
+                        part_sizes = etag_part_sizes(stat.st_size, etag, config)
+                        manifest[name] = {
+                            "size": stat.st_size,
+                            "mtime_ns": stat.st_mtime_ns,
+                            # the first part size tried is the one stored, it may not be
+                            # the one the object was uploaded with but the ETag matches it
+                            "etags": {str(part_sizes[0]): etag} if part_sizes else {},
+                        }
+                    else:
+                        local_etag(manifest, local_dir, name, stat, None, config)
+                    logging.info(f"[{i}/{len(transfers)}] {name}")
+            except BaseException:
+                # Do not start the remaining transfers of a failed sync
+                for future in futures:
+                    future.cancel()
+                raise
+    finally:
+        # Transfers that finished are not repeated by the next run
+        write_manifest(local_dir, manifest)
+
+    if direction == "upload":
+        keys = [{"Key": prefix + name} for name in deletes]
+        for start in range(0, len(keys), 1000):
+            s3_client.delete_objects(
+                Bucket=bucket, Delete={"Objects": keys[start : start + 1000]}
+            )
+    else:
+        for name in deletes:
+            (local_dir / name).unlink()
+            manifest.pop(name, None)
+        if deletes:
+            write_manifest(local_dir, manifest)
+    for name in deletes:
+        logging.info(f"deleted {name}")
+
+    return {"transferred": len(transfers), "skipped": skipped, "deleted": len(deletes)}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Sync a local folder of Parquet datasets with an S3 prefix, only files that changed are transferred"
+    )
+    parser.add_argument("direction", choices=["upload", "download"])
+    parser.add_argument("local_dir", type=Path, help="local folder")
+    parser.add_argument("bucket", help="S3 bucket")
+    parser.add_argument(
+        "--prefix", default="data/", help="key prefix in the bucket (default: data/)"
+    )
+    parser.add_argument(
+        "--delete",
+        action="store_true",
+        help="delete files that are not on the source side",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=WORKERS,
+        help=f"files transferred at a time (default: {WORKERS})",
+    )
+    parser.add_argument(
+        "--part-workers",
+        type=int,
+        default=PART_WORKERS,
+        help=f"parts of a multipart file transferred at a time (default: {PART_WORKERS})",
+    )
+    parser.add_argument(
+        "--multipart-threshold",
+        type=int,
+        default=MULTIPART_THRESHOLD,
+        help=f"size in MB from which files are transferred in parts (default: {MULTIPART_THRESHOLD})",
+    )
+    parser.add_argument(
+        "--multipart-chunksize",
+        type=int,
+        default=MULTIPART_CHUNKSIZE,
+        help=f"part size in MB (default: {MULTIPART_CHUNKSIZE})",
+    )
+    parser.add_argument("--endpoint-url", help="S3 endpoint, e.g. a local S3 server")
+    parser.add_argument(
+        "--region", default=REGION, help=f"AWS region (default: {REGION})"
+    )
+    args = parser.parse_args()
+    logging.basicConfig(
+        stream=sys.stdout,
+        level=logging.INFO,
+        format="[%(asctime)s] %(message)s",
+        datefmt="%Y-%m-%d %I:%M:%S",
+    )
+
+    config = TransferConfig(
+        multipart_threshold=args.multipart_threshold * MB,
+        multipart_chunksize=args.multipart_chunksize * MB,
+        max_concurrency=args.part_workers,
+    )
+    s3_client = boto3.client(
+        "s3",
+        region_name=args.region,
+        endpoint_url=args.endpoint_url,
+        # One connection for every part that can be in flight
+        config=Config(max_pool_connections=args.workers * args.part_workers),
+    )
+    counts = sync(
+        s3_client,
+        args.direction,
+        args.local_dir,
+        args.bucket,
+        args.prefix,
+        workers=args.workers,
+        config=config,
+        delete=args.delete,
+    )
+    logging.info(
+        f"{counts['transferred']} transferred, {counts['skipped']} unchanged, {counts['deleted']} deleted"
+    )
+
+
+if __name__ == "__main__":
+    main()
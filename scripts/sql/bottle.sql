@@ -41,37 +41,11 @@ select
     lr.analyte,
     ea.full_name as analyte_name,
     (lr.meas_value).value as result,
-    case
-        when
-            not (lr.meas_value).undetected
-        and not (lr.meas_value).estimated
-        and not (lr.meas_value).rejected
-        and not (lr.meas_value).greater_than
-        then null
-        else
-            case
-            when (lr.meas_value).undetected then 'U'
-            else ''
-        end
-                || case
-            when (lr.meas_value).estimated then 'J'
-            else ''
-        end
-                || case
-            when (lr.meas_value).rejected then 'R'
-            else ''
-        end
-                || case
-            when (lr.meas_value).greater_than then '>'
-            else ''
-        end
-    end as qualifiers,
+    qf.qualifiers,
+    lr.qa_flags,
     lr.lab_flags,
     lr.validator_flags,
-    case
-        when (lr.meas_value).undetected then 'False'
-        else 'True'
-    end::text as detected,
+    qf.detected,
     lr.detection_limit,
     lr.quantification_limit,
     lr.reporting_limit,
@@ -116,6 +90,8 @@ inner join e_sampmaterial as resmat on
     lr.material_analyzed = resmat.sample_material
 left join e_qalevel as qa on
     lr.qa_level = qa.qa_level
+left join app.qa_flag_codes as qf on
+    lr.qa_flags = qf.qa_flags
 left join e_loctype as lt on
     loc.loc_type = lt.loc_type
 left join e_locmethod as locm on
@@ -184,3 +160,7 @@ order by
     lr.meas_basis,
     lr.fraction
 with data;
+
+-- The Parquet export (content/data-management/parquet_export.py) reads a provider's years in
+-- parallel chunks, this lets each chunk be an index range scan instead of a full scan.
+create index on app.bottle (provider, sample_date);
@@ -32,35 +32,9 @@ select
     cs.replicate,
     (cs.meas_value).value as result,
     cs.units as units,
-    case
-        when (cs.meas_value).undetected then 'False'
-        else 'True'
-        end::text as detected,
-    case
-        when
-            not (cs.meas_value).undetected
-        and not (cs.meas_value).estimated
-        and not (cs.meas_value).rejected
-        and not (cs.meas_value).greater_than
-        then null
-        else
-            case
-            when (cs.meas_value).undetected then 'U'
-            else ''
-        end
-                || case
-            when (cs.meas_value).estimated then 'J'
-            else ''
-        end
-                || case
-            when (cs.meas_value).rejected then 'R'
-            else ''
-        end
-                || case
-            when (cs.meas_value).greater_than then '>'
-            else ''
-        end
-    end as qualifiers,
+    qf.detected,
+    qf.qualifiers,
+    cs.qa_flags,
     cs.validator_flags,
     cs.qa_level,
     cs.data_quality
@@ -122,6 +96,8 @@ left join (
             loc.loc_geom,
             reg.area_geom
     )
+left join app.qa_flag_codes as qf on
+    cs.qa_flags = qf.qa_flags
 left join e_unit as u1 on u1.unit = sm.depth_units
 cross join (select * from e_unit where unit = 'm') as u2
 where
@@ -136,3 +112,7 @@ order by
         fmm.description,
         cs.replicate
 with data;
+
+-- The Parquet export (content/data-management/parquet_export.py) reads a provider's years in
+-- parallel chunks, this lets each chunk be an index range scan instead of a full scan.
+create index on app.ctd (provider, sample_date);
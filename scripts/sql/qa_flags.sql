@@ -0,0 +1,55 @@
+-- QA flags of the field and lab results computed once at load time, run before ctd.sql,
+-- mooring.sql and bottle.sql.
+--
+-- qa_flags packs the flags of the meas_value composite into one smallint, a bit per flag:
+-- 1 undetected, 2 estimated, 4 rejected and 8 greater_than (the bits of
+-- content/data-management/qa_flags.py, which derives them in bulk from the loaded data).
+-- It is a stored generated column, written when a result is inserted or updated instead of
+-- being worked out with nested CASE expressions on every refresh of the views. The views join
+-- app.qa_flag_codes, the detected and qualifiers values of the 16 possible qa_flags.
+--
+-- Adding the columns rewrites d_sampmeas and d_labresult once. A result whose flags are null
+-- now has null qualifiers, the CASE expressions gave an empty string.
+
+alter table d_sampmeas
+    add column if not exists qa_flags smallint generated always as (
+        (
+            case when (meas_value).undetected then 1 else 0 end
+            | case when (meas_value).estimated then 2 else 0 end
+            | case when (meas_value).rejected then 4 else 0 end
+            | case when (meas_value).greater_than then 8 else 0 end
+        )::smallint
+    ) stored;
+
+alter table d_labresult
+    add column if not exists qa_flags smallint generated always as (
+        (
+            case when (meas_value).undetected then 1 else 0 end
+            | case when (meas_value).estimated then 2 else 0 end
+            | case when (meas_value).rejected then 4 else 0 end
+            | case when (meas_value).greater_than then 8 else 0 end
+        )::smallint
+    ) stored;
+
+create table if not exists app.qa_flag_codes (
+    qa_flags smallint primary key,
+    detected text not null,
+    qualifiers text
+);
+
+insert into app.qa_flag_codes
+select
+    flags,
+    case
+        when flags & 1 = 1 then 'False'
+        else 'True'
+    end as detected,
+    nullif(
+        case when flags & 1 = 1 then 'U' else '' end
+        || case when flags & 2 = 2 then 'J' else '' end
+        || case when flags & 4 = 4 then 'R' else '' end
+        || case when flags & 8 = 8 then '>' else '' end,
+        ''
+    ) as qualifiers
+from generate_series(0, 15) as flags
+on conflict (qa_flags) do nothing;
@@ -109,3 +109,7 @@ order by
         abm.description,
         cs.replicate
 with data;
+
+-- The Parquet export (content/data-management/parquet_export.py) reads a provider's years in
+-- parallel chunks, this lets each chunk be an index range scan instead of a full scan.
+create index on app.sp_abund (provider, sample_date);
@@ -1,3 +1,5 @@
+-- The region pages and the summary export read the incremental rollup of scripts/rollup.py,
+-- which computes the same rows without rebuilding this view.
 -- refresh materialized view app.summary with data;
 
 drop materialized view if exists app.summary;